@@ -0,0 +1,286 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'scripts'))
+from instrumentation import peak_rss_bytes, reset_peak_rss
+from synthetic_corpus import SEED, CorpusGenerator, write_annotated_csv, write_article_store
+
+BENCHMARKS_DIR = Path(__file__).parent
+DEFAULT_BASELINE = BENCHMARKS_DIR / 'baselines' / 'baseline.json'
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_REPEAT = 5
+REGRESSION_TOLERANCE = 0.2
+# The compared metrics, with the smallest increase reported as a regression: below it, a relative increase of a tiny
+# measurement is noise (e.g. a 1000 article case taking 10 ms more).
+REGRESSION_FLOORS = {'cpu_seconds': 0.05, 'peak_rss_mb': 10.0}
+STUB_PAGES = 10
+
+
+# Benchmark cases. Each case does its (untimed) setup and returns the function to time, which returns the number
+# of rows (articles) it processed. Cases run in their own process, so their imports and peak memory are isolated.
+def case_remove_punctuation(data: dict):
+    import pandas as pd
+    from token_corpus import remove_punctuation
+    descriptions = pd.read_csv(data['annotated'], usecols=['Description'])['Description'].astype(str).tolist()
+
+    def run():
+        for description in descriptions:
+            remove_punctuation(description)
+        return len(descriptions)
+    return run
+
+
+def case_count_word_freq_per_topic(data: dict):
+    from compute_topic_word_frequency import count_word_freq_per_topic
+
+    def run():
+        count_word_freq_per_topic(data['annotated'])
+        return data['size']
+    return run
+
+
+def case_tfidf_ranking(data: dict):
+    from compute_topic_lang import TopicWordIndex
+    from compute_topic_word_frequency import count_word_freq_per_topic
+    word_freq_by_topic = count_word_freq_per_topic(data['annotated'])
+
+    def run():
+        TopicWordIndex(word_freq_by_topic).top_words(10)
+        return data['size']
+    return run
+
+
+def case_remove_duplicates(data: dict):
+    from delete_duplicates import remove_duplicates
+    output_file = Path(data['work_dir']) / 'articles_deduplicated.csv'
+
+    def run():
+        remove_duplicates(data['articles_csv'], output_file)
+        return data['size']
+    return run
+
+
+def case_build_coverage_network(data: dict):
+    from build_network_topic_coverage_per_movie import build_coverage_network
+
+    def run():
+        build_coverage_network(data['annotated'])
+        return data['size']
+    return run
+
+
+def case_get_news(data: dict):
+    import newsapi
+    newsapi.configure_cache(no_cache=True)
+    server = start_stub_server(data['size'])
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    rate_limiter = newsapi.RateLimiter(requests=10 ** 9, period=1)
+
+    def run():
+        # Checkpointed in the temporary directory, not in the repository's data/checkpoints.
+        articles = newsapi.get_news('benchmark', '/v2/everything', {'q': 'benchmark'}, max_articles=data['size'],
+                                    rate_limiter=rate_limiter, base_url=base_url,
+                                    checkpoint_dir=Path(data['work_dir']) / 'checkpoints')
+        return len(articles)
+    return run
+
+
+CASES = {
+    'remove_punctuation': case_remove_punctuation,
+    'count_word_freq_per_topic': case_count_word_freq_per_topic,
+    'tfidf_ranking': case_tfidf_ranking,
+    'remove_duplicates': case_remove_duplicates,
+    'build_coverage_network': case_build_coverage_network,
+    'get_news': case_get_news
+}
+
+
+def start_stub_server(total_results: int) -> ThreadingHTTPServer:
+    """
+Serve a NewsAPI '/v2/everything' stub on a free local port, in a background thread. The pages are pre-encoded
+from a pool of synthetic articles, so the time spent in the server stays small. The server thread is a daemon, so
+it stops with the benchmark's process.
+    """
+    articles = list(CorpusGenerator(SEED).articles(STUB_PAGES * 100))
+    pages = [json.dumps({'status': 'ok', 'totalResults': total_results,
+                         'articles': articles[i * 100:(i + 1) * 100]}).encode('utf-8') for i in range(STUB_PAGES)]
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            page = int(query.get('page', ['1'])[0])
+            body = pages[(page - 1) % STUB_PAGES]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure_case(case_name: str, data: dict) -> dict:
+    # Runs in a fresh process: stdout is silenced so the scripts' progress messages don't flood the report.
+    sys.stdout = open(os.devnull, 'w')
+    run = CASES[case_name](data)
+    reset_peak_rss()
+    rss_before = peak_rss_bytes()
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    rows = run()
+    wall_seconds, cpu_seconds = time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+    peak_rss = peak_rss_bytes()
+    return {
+        'rows': rows,
+        'wall_seconds': round(wall_seconds, 4),
+        'cpu_seconds': round(cpu_seconds, 4),
+        'rows_per_second': round(rows / wall_seconds, 1) if wall_seconds > 0 else None,
+        'peak_rss_mb': round(peak_rss / 2 ** 20, 1),
+        'rss_growth_mb': round((peak_rss - rss_before) / 2 ** 20, 1)
+    }
+
+
+def prepare_data(size: int, work_dir: Path) -> dict:
+    from json_to_csv import articles_to_csv
+    from article_store import read_articles
+
+    annotated = work_dir / 'annotated.csv'
+    articles_store = work_dir / 'articles.jsonl'
+    articles_csv = work_dir / 'articles.csv'
+    write_annotated_csv(annotated, size)
+    write_article_store(articles_store, size)
+    articles_to_csv(read_articles(articles_store), articles_csv)
+    return {'size': size, 'work_dir': str(work_dir), 'annotated': str(annotated), 'articles_csv': str(articles_csv)}
+
+
+def run_benchmarks(sizes: list[int], case_names: list[str], repeat=DEFAULT_REPEAT) -> dict:
+    """
+Run every case on a synthetic corpus of each size, keeping the run that used the least CPU time of `repeat` runs.
+    :return: The results, by case and size, with a description of the machine they were measured on.
+    """
+    results = {case_name: {} for case_name in case_names}
+    spawn_context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            print(f"benchmarks: Generating {size} synthetic articles...")
+            data = prepare_data(size, Path(work_dir))
+            for case_name in case_names:
+                runs = []
+                for _ in range(repeat):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+                        runs.append(executor.submit(measure_case, case_name, data).result())
+                result = min(runs, key=lambda r: r['cpu_seconds'])
+                results[case_name][str(size)] = result
+                print(f"benchmarks: {case_name:<26} {size:>9} articles: {result['wall_seconds']:>9.3f} s,"
+                      f" {result['cpu_seconds']:>9.3f} s CPU, {result['peak_rss_mb']:>8.1f} MB peak RSS")
+
+    return {
+        'machine': machine_description(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+        'results': results
+    }
+
+
+def machine_description() -> dict:
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance=REGRESSION_TOLERANCE) -> list[str]:
+    # A case regresses if it used more than `tolerance` more CPU time or memory, and more than the metric's floor.
+    # CPU time is compared rather than wall time, which also counts the time the process waited for the machine.
+    regressions = []
+    for case_name, results_by_size in report['results'].items():
+        for size, result in results_by_size.items():
+            baseline_result = baseline['results'].get(case_name, {}).get(size)
+            if baseline_result is None:
+                continue
+            for metric, floor in REGRESSION_FLOORS.items():
+                if result[metric] > max(baseline_result[metric] * (1 + tolerance), baseline_result[metric] + floor):
+                    regressions.append(f"{case_name} ({size} articles): {metric} went from"
+                                       f" {baseline_result[metric]} to {result[metric]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times and memory-profiles the main stages of the project on deterministic synthetic corpora,"
+                    " and saves or compares the results to a baseline.\n\n"
+                    "Example usage:\npython run_benchmarks.py --sizes 1000 10000 --compare",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs='+', default=DEFAULT_SIZES,
+                        help=f"The numbers of articles to benchmark with (up to 1000000). Default is {DEFAULT_SIZES}.")
+    parser.add_argument("--cases", nargs='+', choices=list(CASES), default=list(CASES),
+                        help="The cases to run. Default is all of them.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help=f"Keep the run that used the least CPU time of this many runs."
+                             f" Default is {DEFAULT_REPEAT}.")
+    parser.add_argument("--save", nargs='?', const=DEFAULT_BASELINE, default=None,
+                        help="Save the results as a json baseline to this path. Default is 'baselines/baseline.json'.")
+    parser.add_argument("--compare", nargs='?', const=DEFAULT_BASELINE, default=None,
+                        help="Compare the results to the json baseline at this path."
+                             " Default is 'baselines/baseline.json'.")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                        help=f"The relative slowdown / memory increase reported as a regression."
+                             f" Default is {REGRESSION_TOLERANCE}.")
+    parser.add_argument("--any-machine", action='store_true', default=False,
+                        help="Compare to a baseline measured on another machine (or Python version), with a warning,"
+                             " instead of refusing to.")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        if baseline['machine'] != machine_description():
+            message = (f"benchmarks: The baseline '{args.compare}' was measured on another machine"
+                       f" ({baseline['machine']}, this one is {machine_description()}).")
+            if not args.any_machine:
+                print(f"{message} Measure a baseline here with --save, or compare anyway with --any-machine.")
+                sys.exit(2)
+            print(f"{message} The differences may not be regressions.")
+
+    report = run_benchmarks(args.sizes, args.cases, repeat=args.repeat)
+
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=4)
+        print(f"benchmarks: Results saved to '{args.save}'.")
+
+    if baseline is not None:
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"benchmarks: Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("benchmarks: No regressions compared to the baseline.")
+
+
+if __name__ == '__main__':
+    main()
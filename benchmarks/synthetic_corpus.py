@@ -0,0 +1,183 @@
+import argparse
+import datetime
+import sys
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'scripts'))
+from article_store import write_articles
+
+SEED = 370
+CHUNK_SIZE = 10000
+VOCABULARY_SIZE = 20000
+TOPIC_WORDS = 50
+TOPIC_WORD_RATE = 0.15
+DUPLICATE_RATE = 0.05
+NUM_SOURCES = 300
+NUM_AUTHORS = 2000
+FIRST_PUBLISHED = datetime.datetime(2023, 10, 1, tzinfo=datetime.timezone.utc)
+PUBLISHED_SECONDS = 61 * 24 * 60 * 60
+
+# The movies (ID column) and categories (Annotation column) of 'cleaned data/New annotated.csv'.
+MOVIES = ['Killers of the Flower Moon', 'The Eras Tour', 'Five Nights at Freddy', 'The Exorcist']
+MOVIE_WEIGHTS = [0.46, 0.22, 0.17, 0.15]
+TOPICS = ['Public Reception and Media Coverage', 'Unrelated', 'Cast references unrelated',
+          'Critical Reviews and Ratings', 'Cast and Characters', 'Themes and Messages', 'Comparison to other movies',
+          'Plot and Production']
+TOPIC_WEIGHTS = [0.24, 0.17, 0.14, 0.11, 0.11, 0.08, 0.08, 0.07]
+ANNOTATED_COLUMNS = ['Source', 'ID', 'Author', 'Title', 'Description', 'Annotation']
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'su', 'ta', 'ri', 'vo', 'de', 'ba', 'go', 'pu', 'zen', 'tor', 'mar', 'lin']
+PUNCTUATION = [',', '.', '!', '?', ':', "'s", '…', '&quot;', '’']
+
+
+def synthetic_vocabulary(size=VOCABULARY_SIZE) -> np.ndarray:
+    # Deterministic, distinct pseudo-words: the base-16 digits of the word's index, spelled as syllables.
+    words = []
+    for i in range(size):
+        syllables = []
+        while i or len(syllables) < 2:
+            i, digit = divmod(i, len(SYLLABLES))
+            syllables.append(SYLLABLES[digit])
+        words.append(''.join(syllables))
+    return np.array(words, dtype=object)
+
+
+class CorpusGenerator:
+    """
+Deterministic generator of synthetic articles. Word frequencies follow a Zipf distribution, every topic has its own
+set of frequent words (so TF-IDF has something to find), and a fraction of the articles are near-duplicates of an
+earlier one (same text with one word changed), like syndicated articles.
+The same seed always generates the same articles.
+    """
+
+    def __init__(self, seed=SEED):
+        self.seed = seed
+        self.vocabulary = synthetic_vocabulary()
+        ranks = np.arange(1, len(self.vocabulary) + 1)
+        self.word_weights = 1 / ranks ** 1.1
+        self.word_weights /= self.word_weights.sum()
+        self.sources = np.array([f'Source {i}' for i in range(NUM_SOURCES)], dtype=object)
+        self.source_weights = 1 / np.arange(1, NUM_SOURCES + 1)
+        self.source_weights /= self.source_weights.sum()
+        self.authors = np.array([f'Author {i}' for i in range(NUM_AUTHORS)], dtype=object)
+
+    def rows(self, num_articles: int) -> Iterator[pd.DataFrame]:
+        """
+Generate the articles in chunks of CHUNK_SIZE rows, with the columns of the annotated csv plus the NewsAPI fields
+('url', 'publishedAt', 'content').
+        """
+        for chunk_start in range(0, num_articles, CHUNK_SIZE):
+            chunk_size = min(CHUNK_SIZE, num_articles - chunk_start)
+            yield self._chunk(chunk_start, chunk_size, np.random.RandomState([self.seed, chunk_start]))
+
+    def _chunk(self, start: int, size: int, rng: np.random.RandomState) -> pd.DataFrame:
+        movies = rng.choice(len(MOVIES), size=size, p=MOVIE_WEIGHTS)
+        topics = rng.choice(len(TOPICS), size=size, p=TOPIC_WEIGHTS)
+        sources = rng.choice(NUM_SOURCES, size=size, p=self.source_weights)
+        authors = rng.randint(0, NUM_AUTHORS, size=size)
+        published = rng.randint(0, PUBLISHED_SECONDS, size=size)
+
+        titles = self._texts(rng, topics, movies, rng.randint(6, 13, size=size))
+        descriptions = self._texts(rng, topics, movies, rng.randint(20, 41, size=size))
+
+        # Near-duplicates copy an earlier article of the chunk and change one word.
+        duplicates = np.flatnonzero(rng.random_sample(size) < DUPLICATE_RATE)
+        duplicates = duplicates[duplicates > 0]
+        originals = rng.randint(0, duplicates, size=len(duplicates)) if len(duplicates) else duplicates
+        for duplicate, original in zip(duplicates, originals):
+            words = descriptions[original].split(' ')
+            words[rng.randint(len(words))] = self.vocabulary[rng.randint(len(self.vocabulary))]
+            titles[duplicate] = titles[original]
+            descriptions[duplicate] = ' '.join(words)
+            movies[duplicate], topics[duplicate] = movies[original], topics[original]
+
+        ids = np.arange(start, start + size)
+        source_names = self.sources[sources]
+        return pd.DataFrame({
+            'Source': source_names,
+            'ID': np.array(MOVIES, dtype=object)[movies],
+            'Author': self.authors[authors],
+            'Title': titles,
+            'Description': descriptions,
+            'Annotation': np.array(TOPICS, dtype=object)[topics],
+            'url': [f'https://source{s}.example.com/articles/{i}' for s, i in zip(sources, ids)],
+            'publishedAt': [(FIRST_PUBLISHED + datetime.timedelta(seconds=int(s))).strftime('%Y-%m-%dT%H:%M:%SZ')
+                            for s in published],
+            'content': [f'{d[:200]}… [+{len(d) * 7} chars]' for d in descriptions]
+        })
+
+    def _texts(self, rng: np.random.RandomState, topics: np.ndarray, movies: np.ndarray,
+               lengths: np.ndarray) -> list[str]:
+        # Draw all the words of the chunk at once, then replace some of them with words of the article's topic.
+        word_ids = rng.choice(len(self.vocabulary), size=lengths.sum(), p=self.word_weights)
+        article_of_word = np.repeat(np.arange(len(lengths)), lengths)
+        topic_words = rng.random_sample(len(word_ids)) < TOPIC_WORD_RATE
+        word_ids[topic_words] = (len(self.vocabulary) - 1 - topics[article_of_word[topic_words]] * TOPIC_WORDS
+                                 - rng.randint(0, TOPIC_WORDS, size=topic_words.sum()))
+        words = self.vocabulary[word_ids]
+
+        # Some words get punctuation attached to them.
+        punctuated = np.flatnonzero(rng.random_sample(len(words)) < 0.1)
+        words[punctuated] = words[punctuated] + np.array(PUNCTUATION, dtype=object)[
+            rng.randint(0, len(PUNCTUATION), size=len(punctuated))]
+
+        ends = np.cumsum(lengths)
+        return [f"{MOVIES[movie]} {' '.join(words[end - length:end])}"
+                for movie, end, length in zip(movies, ends, lengths)]
+
+    def articles(self, num_articles: int) -> Iterator[dict]:
+        # The same articles as `rows`, in the NewsAPI json format.
+        for chunk in self.rows(num_articles):
+            for source, author, title, description, url, published_at, content in zip(
+                    chunk['Source'], chunk['Author'], chunk['Title'], chunk['Description'], chunk['url'],
+                    chunk['publishedAt'], chunk['content']):
+                yield {
+                    'source': {'id': None, 'name': source},
+                    'author': author,
+                    'title': title,
+                    'description': description,
+                    'url': url,
+                    'urlToImage': f'{url}.jpg',
+                    'publishedAt': published_at,
+                    'content': content
+                }
+
+
+def write_annotated_csv(filepath, num_articles: int, seed=SEED) -> int:
+    # Same layout as 'New annotated.csv', including its trailing empty column.
+    header = True
+    for chunk in CorpusGenerator(seed).rows(num_articles):
+        chunk = chunk[ANNOTATED_COLUMNS].assign(**{'': ''})
+        chunk.to_csv(filepath, mode='w' if header else 'a', header=header, index=False)
+        header = False
+    return num_articles
+
+
+def write_article_store(filepath, num_articles: int, seed=SEED) -> int:
+    return write_articles(filepath, CorpusGenerator(seed).articles(num_articles))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates a deterministic synthetic corpus: an annotated csv file with the columns of"
+                    " 'New annotated.csv' and the same articles as a NewsAPI jsonl article store.\n\n"
+                    "Example usage:\npython synthetic_corpus.py -n 100000 -o ../data/synthetic",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--num-articles", type=int, required=True, help="The number of articles to generate.")
+    parser.add_argument("-o", "--output-dir", required=True, help="The directory to write the files to.")
+    parser.add_argument("--seed", type=int, default=SEED, help=f"The random seed. Default is {SEED}.")
+    args = parser.parse_args()
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    write_annotated_csv(output_dir / 'annotated.csv', args.num_articles, args.seed)
+    write_article_store(output_dir / 'articles.jsonl', args.num_articles, args.seed)
+    print(f"synthetic_corpus: Saved {args.num_articles} articles to '{output_dir}'.")
+
+
+if __name__ == '__main__':
+    main()
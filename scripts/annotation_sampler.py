@@ -0,0 +1,242 @@
+import argparse
+import json
+import random
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import pandas as pd
+import instrumentation
+from article_store import append_articles, batch_articles, read_articles, write_articles
+from json_to_columnar import read_table_chunks
+from json_to_csv import articles_to_csv
+
+PER_STRATUM = 10
+SEED = 370
+STRATA = ('movie', 'source')
+CHUNK_SIZE = 10000
+
+
+class StratifiedReservoir:
+    """
+A seeded reservoir sample (Algorithm R) of up to `per_stratum` rows for every stratum, or of the number of rows
+`allocation` gives the stratum. The rows are offered one at a time, and only the rows currently in the sample are
+kept, so memory grows with the sample, not with the corpus.
+The same rows offered in the same order always give the same sample.
+    """
+
+    def __init__(self, per_stratum=PER_STRATUM, seed=SEED, allocation: dict[tuple, int] = None):
+        self.per_stratum = per_stratum
+        self.allocation = allocation or {}
+        self.random = random.Random(seed)
+        self.reservoirs: dict[tuple, list[tuple[int, dict]]] = {}
+        self.seen: dict[tuple, int] = {}
+
+    def add(self, stratum: tuple, position: int, row: dict) -> dict | None:
+        """
+Offer a row to the sample of its stratum.
+        :param position: The position of the row in the input, to write the sample in input order.
+        :return: The row left out of the sample: either this row, or the row of the sample it replaced. None if the
+        sample of the stratum is not full yet.
+        """
+        reservoir = self.reservoirs.setdefault(stratum, [])
+        seen = self.seen[stratum] = self.seen.get(stratum, 0) + 1
+        size = self.allocation.get(stratum, self.per_stratum)
+        if len(reservoir) < size:
+            reservoir.append((position, row))
+            return None
+        # Every row seen so far in the stratum is in the sample with the same probability, size / seen.
+        slot = self.random.randrange(seen)
+        if slot >= size:
+            return row
+        replaced = reservoir[slot][1]
+        reservoir[slot] = (position, row)
+        return replaced
+
+    def sample(self) -> list[dict]:
+        return [row for _, row in sorted(entry for reservoir in self.reservoirs.values() for entry in reservoir)]
+
+
+def iter_rows(filepath, chunksize=CHUNK_SIZE) -> Iterator[dict]:
+    # The articles of an article store (.jsonl or legacy .json), or the rows of a csv / Parquet / Arrow table.
+    if Path(filepath).suffix in ('.json', '.jsonl'):
+        yield from read_articles(filepath)
+        return
+    for chunk in read_table_chunks(filepath, chunksize=chunksize):
+        yield from chunk.to_dict('records')
+
+
+def article_stratum(article: dict, strata=STRATA, default_movie=None) -> tuple:
+    """
+The stratum of an article: its movie ('ID' in the annotated files, or `default_movie` for the article stores, which
+hold one keyword set each) and / or its source ('Source' in the annotated files, 'source.name' once flattened to csv).
+    """
+    values = []
+    for stratum in strata:
+        if stratum == 'movie':
+            value = article.get('ID', default_movie)
+        else:
+            value = article.get('Source', article.get('source.name', article.get('source')))
+            if isinstance(value, dict):
+                value = value.get('name')
+        values.append(None if pd.isna(value) else value)
+    return tuple(values)
+
+
+def proportional_allocation(stratum_sizes: dict[tuple, int], total: int, seed=SEED) -> dict[tuple, int]:
+    """
+Split a sample of `total` rows between strata in proportion to their sizes, one stratum level at a time: first
+between the movies, then the share of every movie between its sources. Each split uses the largest remainder method,
+so the shares add up to exactly the total (or to every row, if there are fewer). Equal remainders are broken in a
+seeded random order, so most of the single-article sources are not all taken from the first movies read.
+    """
+    allocation = {}
+    rng = random.Random(seed)
+
+    def allocate(sizes: dict[tuple, int], share: int, level: int):
+        groups = {}
+        for stratum, size in sizes.items():
+            groups.setdefault(stratum[:level + 1], {})[stratum] = size
+        group_shares = largest_remainder({key: sum(group.values()) for key, group in groups.items()}, share, rng)
+        for key, group in groups.items():
+            if len(key) == len(next(iter(group))):
+                allocation[key] = group_shares[key]
+            else:
+                allocate(group, group_shares[key], level + 1)
+
+    if stratum_sizes:
+        allocate(stratum_sizes, total, 0)
+    return allocation
+
+
+def largest_remainder(sizes: dict, total: int, rng: random.Random) -> dict:
+    row_count = sum(sizes.values())
+    if row_count <= total:
+        return dict(sizes)
+    quotas = {key: total * size / row_count for key, size in sizes.items()}
+    shares = {key: int(quota) for key, quota in quotas.items()}
+    keys = list(quotas)
+    rng.shuffle(keys)
+    keys.sort(key=lambda key: quotas[key] - shares[key], reverse=True)
+    for key in keys[:total - sum(shares.values())]:
+        shares[key] += 1
+    return shares
+
+
+def write_rows(rows: Iterable[dict], output_file) -> int:
+    # Written in batches, so the remainder (which is produced while the input is read) is never held in memory.
+    output_file = Path(output_file)
+    if output_file.suffix == '.jsonl':
+        count = write_articles(output_file, [])
+        for batch in batch_articles(rows, CHUNK_SIZE):
+            count += append_articles(output_file, batch)
+        return count
+    return articles_to_csv(rows, output_file, batch_size=CHUNK_SIZE)
+
+
+def file_movie(filepath) -> str:
+    # The movie of an article store, or of a file made from one (e.g. 'x_articles_deduplicated.csv' for 'x').
+    return Path(filepath).stem.removesuffix('_deduplicated').removesuffix('_articles')
+
+
+def sample_articles(input_files, sample_file, remainder_file, per_stratum=PER_STRATUM, strata=STRATA, seed=SEED,
+                    movie=None, total=None) -> dict:
+    """
+Draw a stratified sample of articles to annotate in a single pass over the input (see `total` for the exception),
+and write the sample and the remainder (every other article). The remainder is written while the input is read:
+rows that do not make it into the sample, or that are replaced in it, are written out immediately, so it is not in
+input order. The sample is.
+With a `total`, the input is read twice: once to count the articles of every stratum, to allocate the total to the
+strata in proportion to their sizes, then once to sample them.
+    :param input_files: The article store (.jsonl or .json), or csv / Parquet / Arrow table of articles, or a list
+    of them (e.g. one per movie) to draw a single sample from.
+    :param sample_file: The path to write the sample to (.jsonl, or csv for any other suffix).
+    :param remainder_file: The path to write the remainder to (.jsonl, or csv for any other suffix).
+    :param per_stratum: The number of articles to sample from every stratum (all of them if there are fewer).
+    :param strata: What to stratify by: 'movie', 'source' or both.
+    :param seed: The seed of the sample. The same input and seed always give the same sample.
+    :param movie: The movie of the articles without an 'ID' (e.g. from an article store). Default is the name of
+    their input file without its '_articles' (and '_deduplicated') suffix.
+    :param total: The number of articles to sample in all, instead of `per_stratum` from every stratum.
+    :return: The number of articles read and sampled, and the number of strata.
+    """
+    if isinstance(input_files, (str, Path)):
+        input_files = [input_files]
+
+    def stratified_rows() -> Iterator[tuple[tuple, dict]]:
+        for input_file in input_files:
+            file_default_movie = file_movie(input_file) if movie is None else movie
+            for row in iter_rows(input_file):
+                yield article_stratum(row, strata, file_default_movie), row
+
+    allocation = None
+    if total is not None:
+        stratum_sizes = {}
+        for stratum, _ in stratified_rows():
+            stratum_sizes[stratum] = stratum_sizes.get(stratum, 0) + 1
+        allocation = proportional_allocation(stratum_sizes, total, seed)
+    reservoir = StratifiedReservoir(per_stratum, seed, allocation)
+    read_count = 0
+
+    def remainder() -> Iterator[dict]:
+        nonlocal read_count
+        for stratum, row in stratified_rows():
+            # The position runs on across the files, so the sample keeps the order of the files too.
+            left_out = reservoir.add(stratum, read_count, row)
+            read_count += 1
+            if left_out is not None:
+                yield left_out
+
+    remainder_count = write_rows(remainder(), remainder_file)
+    sample_count = write_rows(reservoir.sample(), sample_file)
+    instrumentation.count('articles_sampled', sample_count)
+    return {'articles': read_count, 'sampled': sample_count, 'remaining': remainder_count,
+            'strata': len(reservoir.reservoirs)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Draws a reproducible sample of articles to annotate, with the same number of articles from every"
+                    " movie and source (or all of them, if there are fewer), or a total number of articles split"
+                    " between them in proportion to their sizes, with memory proportional to the sample. The"
+                    " articles not sampled are written to a remainder file, to sample the next batch from.\n\n"
+                    "Example usage:\npython -m annotation_sampler -f ../data/articles/deduplicated.csv -n 5"
+                    " -o '../cleaned data/sampled_data.csv' -r '../cleaned data/data_remain.csv'\n"
+                    "python -m annotation_sampler -f ../data/articles/deduplicated.csv -t 600"
+                    " -o '../cleaned data/sampled_data_600.csv'",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-f", "--file", required=True, nargs='+',
+                        help="The article store (.jsonl or .json) or csv / Parquet / Arrow file to sample from, or"
+                             " several of them (e.g. one per movie) to draw a single sample from.")
+    parser.add_argument("-o", "--output", required=True, help="The path to write the sample to (csv or .jsonl).")
+    parser.add_argument("-r", "--remainder", default=None,
+                        help="The path to write the articles not sampled to (csv or .jsonl)."
+                             " Default is the output path with a '_remain' suffix.")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("-n", "--per-stratum", type=int, default=PER_STRATUM,
+                      help=f"The number of articles to sample for every stratum. Default is {PER_STRATUM}.")
+    size.add_argument("-t", "--total", type=int, default=None,
+                      help="The number of articles to sample in all, split between the strata in proportion to"
+                           " their number of articles (this reads the input twice).")
+    parser.add_argument("-s", "--seed", type=int, default=SEED, help=f"The seed of the sample. Default is {SEED}.")
+    parser.add_argument("--strata", nargs='+', choices=STRATA, default=list(STRATA),
+                        help="What to stratify the sample by. Default is both the movie and the source.")
+    parser.add_argument("-m", "--movie", default=None,
+                        help="The movie of articles without an 'ID' column, e.g. from an article store."
+                             " Default is the name of their input file.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.instrument('annotation_sampler', args.metrics, args.profile):
+        output_file = Path(args.output)
+        remainder_file = Path(args.remainder) if args.remainder else output_file.with_stem(
+            f'{output_file.stem}_remain')
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        remainder_file.parent.mkdir(parents=True, exist_ok=True)
+        counts = sample_articles(args.file, output_file, remainder_file, per_stratum=args.per_stratum,
+                                 strata=tuple(args.strata), seed=args.seed, movie=args.movie, total=args.total)
+        print(f"annotation_sampler: Sample saved to '{output_file}', remainder saved to '{remainder_file}':"
+              f" {json.dumps(counts)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import instrumentation
+from json_to_columnar import read_table_chunks
+from token_corpus import CHUNK_SIZE, intern, remove_punctuation, tokenize_descriptions
+
+POSTING_DTYPE = np.int32
+
+
+def encode_varints(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+Variable-length encode non-negative integers, 7 bits per byte, least significant first, with the high bit of every
+byte but the last of a value set.
+    :return: The bytes, and the number of bytes of every value.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    bit_lengths = np.zeros(len(values), dtype=np.int64)
+    remaining = values.copy()
+    while remaining.any():
+        bit_lengths += remaining > 0
+        remaining >>= np.uint64(1)
+    byte_counts = np.maximum(1, -(-bit_lengths // 7))
+
+    byte_values = np.repeat(values, byte_counts)
+    ends = np.cumsum(byte_counts)
+    byte_positions = np.arange(len(byte_values)) - np.repeat(ends - byte_counts, byte_counts)
+    encoded = (byte_values >> (np.uint64(7) * byte_positions.astype(np.uint64))) & np.uint64(0x7F)
+    encoded[np.setdiff1d(np.arange(len(encoded)), ends - 1, assume_unique=True)] |= np.uint64(0x80)
+    return encoded.astype(np.uint8), byte_counts
+
+
+def decode_varints(encoded: np.ndarray) -> np.ndarray:
+    encoded = np.asarray(encoded, dtype=np.uint8)
+    if len(encoded) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(encoded < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    byte_positions = np.arange(len(encoded)) - np.repeat(starts, ends - starts + 1)
+    shifted = (encoded & 0x7F).astype(np.uint64) << (np.uint64(7) * byte_positions.astype(np.uint64))
+    return np.add.reduceat(shifted, starts).astype(np.int64)
+
+
+def query_words(text: str) -> list[str]:
+    # The words of a query, split and normalized like the indexed text (see tokenize_descriptions).
+    return remove_punctuation(text).lower().split()
+
+
+class ArticleIndex:
+    """
+Inverted index of the words of the titles and descriptions of annotated articles, stored in a directory as:
+    vocabulary.json: the list of indexed words (the id of a word is its index),
+    document_offsets.npy / documents.npy: the postings of every word: the articles containing it, in increasing order,
+        as varint-encoded gaps (the postings of word i are documents[document_offsets[i]:document_offsets[i + 1]]),
+    frequency_offsets.npy / frequencies.npy: the varint-encoded frequency of the word in each of those articles,
+    topic_ids.npy / topics.json, movie_ids.npy / movies.json: the topic and movie of every article.
+An article is identified by its row number in the indexed file. The arrays are memory mapped when loaded, so a query
+only reads and decodes the postings of its words.
+    """
+
+    def __init__(self, directory, vocabulary: list[str], document_offsets: np.ndarray, documents: np.ndarray,
+                 frequency_offsets: np.ndarray, frequencies: np.ndarray, topic_ids: np.ndarray, topics: list,
+                 movie_ids: np.ndarray, movies: list):
+        self.directory = directory
+        self.vocabulary = vocabulary
+        self.word_ids = {word: word_id for word_id, word in enumerate(vocabulary)}
+        self.document_offsets = document_offsets
+        self.documents = documents
+        self.frequency_offsets = frequency_offsets
+        self.frequencies = frequencies
+        self.topic_ids = topic_ids
+        self.topics = topics
+        self.movie_ids = movie_ids
+        self.movies = movies
+
+    @property
+    def num_articles(self) -> int:
+        return len(self.topic_ids)
+
+    def postings(self, word: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :return: The articles containing a word (in increasing order), and the number of times it occurs in each.
+        """
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        gaps = decode_varints(self.documents[self.document_offsets[word_id]:self.document_offsets[word_id + 1]])
+        frequencies = decode_varints(
+            self.frequencies[self.frequency_offsets[word_id]:self.frequency_offsets[word_id + 1]])
+        return np.cumsum(gaps), frequencies
+
+    def _label_mask(self, articles: np.ndarray, ids: np.ndarray, labels: list, label) -> np.ndarray:
+        if label not in labels:
+            return np.zeros(len(articles), dtype=bool)
+        return ids[articles] == labels.index(label)
+
+    def search(self, words: list[str], topic=None, movie=None) -> pd.DataFrame:
+        """
+Find the articles containing all the given words, optionally only in one topic and / or about one movie.
+        :return: The row, movie and topic of every article found, with the frequency of each word in it.
+        """
+        postings = [self.postings(word) for word in words]
+        articles = postings[0][0] if postings else np.zeros(0, dtype=np.int64)
+        for word_articles, _ in postings[1:]:
+            articles = np.intersect1d(articles, word_articles, assume_unique=True)
+        if topic is not None:
+            articles = articles[self._label_mask(articles, self.topic_ids, self.topics, topic)]
+        if movie is not None:
+            articles = articles[self._label_mask(articles, self.movie_ids, self.movies, movie)]
+
+        results = pd.DataFrame({
+            'row': articles,
+            'movie': np.array(self.movies, dtype=object)[self.movie_ids[articles]],
+            'topic': np.array(self.topics, dtype=object)[self.topic_ids[articles]]
+        })
+        for word, (word_articles, frequencies) in zip(words, postings):
+            results[word] = frequencies[np.searchsorted(word_articles, articles)]
+        return results
+
+    def cooccurrence(self, word_a: str, word_b: str, by='topic') -> pd.DataFrame:
+        """
+Count the articles containing each word, and both, per topic (or per movie with by='movie').
+        :return: The counts, by topic (or movie), with a 'total' row.
+        """
+        ids, labels = (self.topic_ids, self.topics) if by == 'topic' else (self.movie_ids, self.movies)
+        articles_a, _ = self.postings(word_a)
+        articles_b, _ = self.postings(word_b)
+        both = np.intersect1d(articles_a, articles_b, assume_unique=True)
+
+        counts = pd.DataFrame({
+            word_a: np.bincount(ids[articles_a], minlength=len(labels)),
+            word_b: np.bincount(ids[articles_b], minlength=len(labels)),
+            'both': np.bincount(ids[both], minlength=len(labels))
+        }, index=pd.Index(labels, name=by))
+        counts = counts[counts.any(axis=1)]
+        counts.loc['total'] = [len(articles_a), len(articles_b), len(both)]
+        return counts
+
+
+def build_index(articles_filepath, output_dir, chunksize=CHUNK_SIZE) -> ArticleIndex:
+    """
+Index the words of the titles and descriptions of an annotated article file (csv, Parquet or Arrow).
+    :param articles_filepath: The path to the annotated articles (with 'ID', 'Annotation', 'Title' and 'Description'
+    columns).
+    :param output_dir: The directory to save the index to.
+    :return: The index, loaded back from the output directory.
+    """
+    word_ids_by_word: dict[str, int] = {}
+    topic_ids_by_topic: dict = {}
+    movie_ids_by_movie: dict = {}
+    word_chunks, article_chunks, frequency_chunks, topic_id_chunks, movie_id_chunks = [], [], [], [], []
+
+    for chunk in read_table_chunks(articles_filepath, columns=['ID', 'Annotation', 'Title', 'Description'],
+                                   chunksize=chunksize):
+        texts = chunk['Title'].fillna('').astype(str) + ' ' + chunk['Description'].fillna('').astype(str)
+        rows, chunk_word_ids, chunk_vocabulary = tokenize_descriptions(texts)
+        vocabulary_ids = np.array([word_ids_by_word.setdefault(w, len(word_ids_by_word)) for w in chunk_vocabulary],
+                                  dtype=POSTING_DTYPE)
+        # One posting per distinct (word, article) of the chunk, with the number of occurrences.
+        keys, frequencies = np.unique(vocabulary_ids[chunk_word_ids].astype(np.int64) * (1 << 31) + rows,
+                                      return_counts=True)
+        word_chunks.append((keys >> 31).astype(POSTING_DTYPE))
+        article_chunks.append((keys & ((1 << 31) - 1)).astype(POSTING_DTYPE))
+        frequency_chunks.append(frequencies.astype(POSTING_DTYPE))
+        topic_id_chunks.append(intern(chunk['Annotation'], topic_ids_by_topic))
+        movie_id_chunks.append(intern(chunk['ID'], movie_ids_by_movie))
+
+    empty = np.zeros(0, dtype=POSTING_DTYPE)
+    words = np.concatenate(word_chunks or [empty])
+    # Chunks come in article order, so a stable sort by word keeps the articles of every word in increasing order.
+    order = np.argsort(words, kind='stable')
+    words = words[order]
+    articles = np.concatenate(article_chunks or [empty])[order].astype(np.int64)
+    frequencies = np.concatenate(frequency_chunks or [empty])[order]
+
+    word_starts = np.searchsorted(words, np.arange(len(word_ids_by_word) + 1))
+    # Every word has at least one posting, and its first article is stored as is (a gap from 0).
+    gaps = np.diff(articles, prepend=0)
+    gaps[word_starts[:-1]] = articles[word_starts[:-1]]
+    documents, document_bytes = encode_varints(gaps)
+    encoded_frequencies, frequency_bytes = encode_varints(frequencies)
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for name, byte_counts in [('document_offsets', document_bytes), ('frequency_offsets', frequency_bytes)]:
+        byte_offsets = np.concatenate(([0], np.cumsum(byte_counts))).astype(np.int64)
+        np.save(output_dir / f'{name}.npy', byte_offsets[word_starts])
+    np.save(output_dir / 'documents.npy', documents)
+    np.save(output_dir / 'frequencies.npy', encoded_frequencies)
+    np.save(output_dir / 'topic_ids.npy', np.concatenate(topic_id_chunks or [np.zeros(0)]).astype(np.int32))
+    np.save(output_dir / 'movie_ids.npy', np.concatenate(movie_id_chunks or [np.zeros(0)]).astype(np.int32))
+    for filename, values in [('vocabulary.json', word_ids_by_word), ('topics.json', topic_ids_by_topic),
+                             ('movies.json', movie_ids_by_movie)]:
+        with open(output_dir / filename, 'w', encoding='utf-8') as file:
+            json.dump(list(values.keys()), file, ensure_ascii=False)
+
+    instrumentation.count('postings', len(articles))
+    return load_index(output_dir)
+
+
+def load_index(index_dir, mmap=True) -> ArticleIndex:
+    index_dir = Path(index_dir)
+    mmap_mode = 'r' if mmap else None
+    json_files = {}
+    for name in ['vocabulary', 'topics', 'movies']:
+        with open(index_dir / f'{name}.json', 'r', encoding='utf-8') as file:
+            json_files[name] = json.load(file)
+
+    arrays = {name: np.load(index_dir / f'{name}.npy', mmap_mode=mmap_mode)
+              for name in ['document_offsets', 'documents', 'frequency_offsets', 'frequencies', 'topic_ids',
+                           'movie_ids']}
+    return ArticleIndex(index_dir, json_files['vocabulary'], arrays['document_offsets'], arrays['documents'],
+                        arrays['frequency_offsets'], arrays['frequencies'], arrays['topic_ids'],
+                        json_files['topics'], arrays['movie_ids'], json_files['movies'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds an inverted index of the words of the titles and descriptions of annotated articles, to"
+                    " find the articles behind the top words of compute_topic_lang.py without scanning the"
+                    " articles again.\n\n"
+                    "Example usage:\npython -m article_index build -a '../cleaned data/New annotated.csv'"
+                    " -o ../data/article_index\n"
+                    "python -m article_index search -i ../data/article_index osage -t 'Themes and Messages'\n"
+                    "python -m article_index cooccur -i ../data/article_index osage oil",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="Index an annotated articles file.")
+    build_parser.add_argument("-a", "--articles", required=True, help="The path to the annotated articles file.")
+    build_parser.add_argument("-o", "--output", required=True, help="The path to the output index directory.")
+
+    search_parser = subparsers.add_parser('search', help="Find the articles containing all the given words.")
+    search_parser.add_argument("-i", "--index", required=True, help="The path to the index directory.")
+    search_parser.add_argument("words", nargs='+', help="The words to look for.")
+    search_parser.add_argument("-t", "--topic", default=None, help="Only find articles of this topic.")
+    search_parser.add_argument("-m", "--movie", default=None, help="Only find articles about this movie.")
+    search_parser.add_argument("-n", "--limit", type=int, default=20,
+                               help="The number of articles to print (all are counted). Default is 20.")
+
+    cooccur_parser = subparsers.add_parser('cooccur', help="Count the articles containing two words, and both.")
+    cooccur_parser.add_argument("-i", "--index", required=True, help="The path to the index directory.")
+    cooccur_parser.add_argument("word_a", help="The first word.")
+    cooccur_parser.add_argument("word_b", help="The second word.")
+    cooccur_parser.add_argument("--by", choices=['topic', 'movie'], default='topic',
+                                help="Count the articles per topic or per movie. Default is per topic.")
+    for subparser in (build_parser, search_parser, cooccur_parser):
+        instrumentation.add_arguments(subparser)
+    args = parser.parse_args()
+
+    with instrumentation.instrument(f'article_index_{args.command}', args.metrics, args.profile):
+        if args.command == 'build':
+            index = build_index(args.articles, args.output)
+            print(f"article_index: Indexed {index.num_articles} articles and {len(index.vocabulary)} distinct words"
+                  f" to '{args.output}'.")
+            return
+
+        index = load_index(args.index)
+        query_start = time.perf_counter()
+        if args.command == 'search':
+            words = [word for text in args.words for word in query_words(text)]
+            results = index.search(words, topic=args.topic, movie=args.movie)
+        else:
+            words = [query_words(args.word_a), query_words(args.word_b)]
+            if any(len(query) != 1 for query in words):
+                parser.error("cooccur takes two single words.")
+            (word_a,), (word_b,) = words
+            results = index.cooccurrence(word_a, word_b, by=args.by)
+        query_ms = (time.perf_counter() - query_start) * 1000
+
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(results.head(args.limit) if args.command == 'search' else results)
+        print(f"article_index: {len(results) if args.command == 'search' else int(results.loc['total', 'both'])}"
+              f" articles found in {query_ms:.1f} ms.")
+
+
+if __name__ == '__main__':
+    main()
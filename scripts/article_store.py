@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import instrumentation
+
+STORE_SUFFIX = '.jsonl'
+READ_SIZE = 1 << 20
+
+
+def append_articles(store_file, articles: Iterable[dict]) -> int:
+    """
+Append articles to a line-delimited json store, one article per line. All the lines are written with a single
+append, and the file is fsynced before returning, so a crash can at most leave a partial last line behind
+(which `read_articles` skips). That partial line is truncated before the next append, so it is never joined with
+the first new line.
+    :param store_file: The path to the .jsonl store file. It is created if it does not exist.
+    :param articles: The articles to append.
+    :return: The number of articles appended.
+    """
+    lines = [json.dumps(article, ensure_ascii=False) + '\n' for article in articles]
+    if not lines:
+        return 0
+
+    data = ''.join(lines).encode('utf-8')
+    fd = os.open(store_file, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        truncate_partial_line(fd, store_file)
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    instrumentation.count('articles_written', len(lines))
+    return len(lines)
+
+
+def truncate_partial_line(fd: int, store_file, read_size=READ_SIZE):
+    # Cut an interrupted last line (one not ending with a newline) off the store, back to the last newline.
+    size = os.fstat(fd).st_size
+    if size == 0 or os.pread(fd, 1, size - 1) == b'\n':
+        return
+    end = size
+    while end > 0:
+        start = max(0, end - read_size)
+        newline = os.pread(fd, end - start, start).rfind(b'\n')
+        if newline != -1:
+            end = start + newline + 1
+            break
+        end = start
+    os.ftruncate(fd, end)
+    print(f"article_store: Removed a partially written last line ({size - end} bytes) from '{store_file}'.")
+
+
+def write_articles(store_file, articles: Iterable[dict]) -> int:
+    """
+Replace the content of a store with the given articles. The new store is written next to the old one and then
+renamed over it, so readers never see a half-written store.
+    :param store_file: The path to the .jsonl store file.
+    :param articles: The articles to write.
+    :return: The number of articles written.
+    """
+    store_file = Path(store_file)
+    tmp_file = store_file.with_name(store_file.name + '.tmp')
+    tmp_file.unlink(missing_ok=True)
+    count = append_articles(tmp_file, articles)
+    if count == 0:
+        tmp_file.touch()
+    os.replace(tmp_file, store_file)
+    return count
+
+
+def read_articles(store_file) -> Iterator[dict]:
+    """
+Iterate over the articles of a store without loading the whole file. Legacy .json files (a single json list) are
+also accepted, and parsed one article at a time too.
+    :param store_file: The path to the .jsonl (or legacy .json) file.
+    :return: A generator of article dictionaries.
+    """
+    store_file = Path(store_file)
+    if store_file.suffix == '.json':
+        with open(store_file, 'r', encoding='utf-8') as file:
+            for article in iter_json_array(file):
+                instrumentation.count('articles_read')
+                yield article
+        return
+
+    with open(store_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                article = json.loads(line)
+            except json.JSONDecodeError:
+                # Only the last line can be partial (interrupted append), anything else is a corrupt store.
+                if line.endswith('\n'):
+                    raise
+                print(f"article_store: Skipped a partially written last line in '{store_file}'.")
+                continue
+            instrumentation.count('articles_read')
+            yield article
+
+
+def iter_json_array(file, read_size=READ_SIZE) -> Iterator:
+    # Incrementally decode the items of a top-level json array, reading the file `read_size` characters at a time.
+    decoder = json.JSONDecoder()
+    buffer = file.read(read_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError(f"article_store: '{file.name}' does not contain a json list.")
+    buffer = buffer[1:]
+    eof = False
+
+    while True:
+        buffer = buffer.lstrip().removeprefix(',').lstrip()
+        if not buffer and not eof:
+            chunk = file.read(read_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        if buffer.startswith(']') or (eof and not buffer):
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer)
+            # A number at the very end of the buffer may continue in the next read.
+            cut = end == len(buffer) and not eof
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            cut = True
+
+        if cut:
+            # The item is cut by the end of the buffer, so read more before decoding it again.
+            chunk = file.read(read_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+
+        yield item
+        buffer = buffer[end:]
+
+
+def read_articles_from(store_file, offset=0) -> Iterator[tuple[dict, int]]:
+    """
+Iterate over the articles of a .jsonl store from a byte offset, e.g. where it was read to last time, so only the
+articles appended since are read.
+    :param store_file: The path to the .jsonl file.
+    :param offset: The offset to start from, the end of a line.
+    :return: A generator of (article, offset of the end of its line) pairs. A partial last line (interrupted append)
+    is not read, so the offsets are always the end of a complete line.
+    """
+    with open(store_file, 'rb') as file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b'\n'):
+                return
+            offset += len(line)
+            if not line.strip():
+                continue
+            instrumentation.count('articles_read')
+            yield json.loads(line), offset
+
+
+def batch_articles(articles: Iterable[dict], batch_size: int) -> Iterator[list[dict]]:
+    batch = []
+    for article in articles:
+        batch.append(article)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def store_path(json_file) -> Path:
+    return Path(json_file).with_suffix(STORE_SUFFIX)
+
+
+def migrate_json(json_file) -> Path:
+    """
+Convert a legacy .json article file (a single json list) into a .jsonl store next to it. The legacy file is left
+untouched.
+    :param json_file: The path to the legacy .json file.
+    :return: The path to the new .jsonl store.
+    """
+    output_file = store_path(json_file)
+    count = write_articles(output_file, read_articles(json_file))
+    print(f"article_store: Migrated {count} articles from '{json_file}' to '{output_file}'.")
+    return output_file
+
+
+def migrate_legacy_store(store_file):
+    # Move the articles of a legacy .json file into the store before the first append, so no history is lost.
+    legacy_file = Path(store_file).with_suffix('.json')
+    if not Path(store_file).exists() and legacy_file.exists() and os.stat(legacy_file).st_size > 0:
+        migrate_json(legacy_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migrates legacy .json article files into append-only .jsonl article stores.\n\n"
+                    "Example usage:\npython -m article_store ../data/articles/*.json",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs='*',
+                        help="The .json files to migrate. Default is every .json file in 'data/articles'"
+                             " and 'data/headlines'.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.instrument('article_store', args.metrics, args.profile):
+        files = args.files
+        if not files:
+            data_dir = Path(__file__).parent.parent / 'data'
+            files = sorted(data_dir.glob('articles/*.json')) + sorted(data_dir.glob('headlines/*.json'))
+
+        for json_file in files:
+            migrate_json(json_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,33 @@
 import argparse
-from collections import Counter
 import pandas as pd
 from pathlib import Path
 import networkx as nx
 import matplotlib.pyplot as plt
+import instrumentation
+from json_to_columnar import read_table_chunks
 
 
-def build_coverage_network(csv_filepath) -> nx.Graph:
+CHUNK_SIZE = 50000
+
+
+def build_coverage_network(csv_filepath, chunksize=CHUNK_SIZE) -> nx.Graph:
     print(f"Building network from '{Path(csv_filepath).relative_to(Path(csv_filepath).parent.parent)}'...")
-    df = pd.read_csv(csv_filepath, encoding='utf-8')
 
-    movies = sorted(df['ID'].unique())
-    topics = sorted(df['Annotation'].unique())
-    topics.remove('duplicate')
+    # Count the articles of every (movie, topic) pair, one chunk at a time.
+    chunk_counts = []
+    for chunk in read_table_chunks(csv_filepath, columns=['ID', 'Annotation'], chunksize=chunksize):
+        chunk_counts.append(chunk.groupby(['ID', 'Annotation'], sort=False).size())
+    coverage = pd.concat(chunk_counts).groupby(level=[0, 1], sort=False).sum()
+
+    movies = sorted(coverage.index.unique(level=0))
+    topics = sorted(topic for topic in coverage.index.unique(level=1) if topic != 'duplicate')
+    coverage = coverage[coverage.index.get_level_values(1) != 'duplicate']
 
     B = nx.Graph()
     B.name = "Topic Coverage by Movie"
     B.add_nodes_from(movies, bipartite=0)
     B.add_nodes_from(topics, bipartite=1)
-    
-    for index, row in df.iterrows():
-        movie = row['ID']
-        topic = row['Annotation']
-        if topic == 'duplicate':
-            continue
-        
-        if B.has_edge(movie, topic):
-            B[movie][topic]['weight'] += 1
-        else:
-            B.add_edge(movie, topic, weight=1)
+    B.add_weighted_edges_from((movie, topic, int(weight)) for (movie, topic), weight in coverage.items())
 
     print(f"Network '{B.name}' has been built.")
     return B
@@ -38,6 +37,7 @@ def draw_graph(B: nx.Graph, filepath):
     NODE_SIZE_MULTIPLIER = 1100
     EDGE_WIDTH_MULTIPLIER = 60
     MOVIE_COLORS = ['mediumseagreen', 'deepskyblue', 'slateblue', 'hotpink']
+    TOPIC_COLOR = 'sandybrown'
     
     print(f"Drawing graph '{B.name}'...")
     # Set up figure and axis (the axis are changed slightly to make sure the nodes and their labels fit in the figure).
@@ -45,30 +45,29 @@ def draw_graph(B: nx.Graph, filepath):
     plt.axis([-1.3, 0.9, -0.7, 0.7])
 
     movie_nodes = [node for node, bipartite in B.nodes(data='bipartite') if bipartite == 0]
+    movie_colors = {movie: MOVIE_COLORS[i % len(MOVIE_COLORS)] for i, movie in enumerate(movie_nodes)}
     pos = nx.bipartite_layout(B, movie_nodes)
 
-    node_weighted_degrees = B.degree(weight='weight')
-    edge_weights = nx.get_edge_attributes(B, 'weight')
-    max_weight = max(edge_weights.values())
+    node_weighted_degrees = dict(B.degree(weight='weight'))
+    edges = list(B.edges(data='weight'))
+    max_weight = max(weight for _, _, weight in edges)
 
-    # Draw updated graph nodes with colour representing the movie (or a default colour for topic nodes)
+    # Draw all graph nodes at once, with colour representing the movie (or a default colour for topic nodes)
     # and size representing the coverage of that movie/topic relative to the entire set of articles.
-    for node, weighted_deg in node_weighted_degrees:
-        size = weighted_deg * NODE_SIZE_MULTIPLIER
-        color = MOVIE_COLORS[movie_nodes.index(node)] if node in movie_nodes else 'sandybrown'        
-        nx.draw_networkx_nodes(B, pos, nodelist=[node], node_size=size, node_color=color)
-
-    # Draw updated graph edges with colour representing the edge's movie node, and width representing its weight.
-    for edge in B.edges(data='weight'):
-        movie = edge[0]
-        weight = edge[2]
-        width = (weight / max_weight) * EDGE_WIDTH_MULTIPLIER
-        color = MOVIE_COLORS[movie_nodes.index(movie)]
-        nx.draw_networkx_edges(B, pos, edgelist=[edge], width=width, edge_color=color)
-
-    article_total = sum([wdeg for n, wdeg in node_weighted_degrees if n in movie_nodes])
+    nodes = list(node_weighted_degrees.keys())
+    nx.draw_networkx_nodes(B, pos, nodelist=nodes,
+                           node_size=[node_weighted_degrees[n] * NODE_SIZE_MULTIPLIER for n in nodes],
+                           node_color=[movie_colors.get(n, TOPIC_COLOR) for n in nodes])
+
+    # Draw all graph edges at once, with colour representing the edge's movie node, and width representing its weight.
+    edge_movies = [u if u in movie_colors else v for u, v, _ in edges]
+    nx.draw_networkx_edges(B, pos, edgelist=[(u, v) for u, v, _ in edges],
+                           width=[(weight / max_weight) * EDGE_WIDTH_MULTIPLIER for _, _, weight in edges],
+                           edge_color=[movie_colors[movie] for movie in edge_movies])
+
+    article_total = sum(wdeg for n, wdeg in node_weighted_degrees.items() if n in movie_colors)
     print(article_total)
-    labels = {n: f"{n}\n({round(100 * wdeg / article_total, 1)}%)" for n, wdeg in node_weighted_degrees}
+    labels = {n: f"{n}\n({round(100 * wdeg / article_total, 1)}%)" for n, wdeg in node_weighted_degrees.items()}
     nx.draw_networkx_labels(B, pos, labels, font_size=50)
 
     f.savefig(filepath)
@@ -80,13 +79,15 @@ def main():
     parser.add_argument("-a", "--articles", required=True,
                         help="The path to the article csv file.")
     parser.add_argument("-o", "--output", required=True, help="The path to the output graph png file.")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
 
-    output_file = Path(args.output)
-    output_file.parent.mkdir(exist_ok=True, parents=True)
+    with instrumentation.instrument('build_network_topic_coverage_per_movie', args.metrics, args.profile):
+        output_file = Path(args.output)
+        output_file.parent.mkdir(exist_ok=True, parents=True)
 
-    B = build_coverage_network(args.articles)
-    draw_graph(B, output_file)
+        B = build_coverage_network(args.articles)
+        draw_graph(B, output_file)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,11 @@
 import argparse
 import json
-import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from newsapi import fetch_top_headlines
+import instrumentation
+from article_store import append_articles, migrate_legacy_store, write_articles
+from newsapi import MAX_WORKERS, configure_cache, fetch_top_headlines, get_session, print_throughput_summary
 
 data_dir = Path(__file__).parent.parent / 'data'
 if not Path.exists(data_dir):
@@ -12,24 +15,21 @@ if not Path.exists(data_dir / 'headlines'):
     Path.mkdir(data_dir / 'headlines')
 
 
-def collect_top_headlines(api_key: str, country: str, category: str, keywords_file=None, append=True):
+def collect_top_headlines(api_key: str, country: str, category: str, keywords_file=None, append=True, max_articles=None, workers=1):
     # Without keywords
     if keywords_file is None:
-        news = fetch_top_headlines(api_key, country, category)
+        news = fetch_top_headlines(api_key, country, category, max_articles=max_articles)
 
         if news is None:
             return
 
-        output_file = Path(data_dir / 'headlines' / f'all_{category}_headlines.json')
+        output_file = Path(data_dir / 'headlines' / f'all_{category}_headlines.jsonl')
 
-        if append and Path.exists(output_file) and os.stat(output_file).st_size > 0:
-            with open(output_file, 'r', encoding='utf-8') as existing_file:
-                existing_data = json.load(existing_file)
-                existing_data.extend(news)
-                news = existing_data
-
-        with open(output_file, 'w', encoding='utf-8') as json_file:
-            json.dump(news, json_file, ensure_ascii=False, indent=4)
+        if append:
+            migrate_legacy_store(output_file)
+            append_articles(output_file, news)
+        else:
+            write_articles(output_file, news)
 
         print(f"Collected all top {category} headlines in the country '{country}'"
               f" and saved it in {Path(output_file).relative_to(data_dir.parent)}")
@@ -39,26 +39,41 @@ def collect_top_headlines(api_key: str, country: str, category: str, keywords_fi
     with open(keywords_file, 'r', encoding='utf-8') as file:
         keyword_sets = json.load(file)
 
-    for keyword_set in keyword_sets:
-        for set_name, keywords in keyword_set.items():
-            news = fetch_top_headlines(api_key, country, category, keywords)
+    set_items = [item for keyword_set in keyword_sets for item in keyword_set.items()]
+
+    def collect_set(set_name, keywords):
+        started = time.perf_counter()
+        article_count = collect_keyword_set_headlines(api_key, country, category, set_name, keywords,
+                                                      append=append, max_articles=max_articles)
+        return set_name, article_count, time.perf_counter() - started
+
+    # All the workers share the rate limiter and connection pool of the newsapi module.
+    get_session(pool_size=workers * MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda item: collect_set(*item), set_items))
+
+    print_throughput_summary(results)
+
 
-            if news is None:
-                continue
+def collect_keyword_set_headlines(api_key: str, country: str, category: str, set_name: str, keywords: list, append=True, max_articles=None):
+    news = fetch_top_headlines(api_key, country, category, keywords, max_articles=max_articles)
 
-            output_file = Path(data_dir / 'headlines' / f'{set_name}_{category}_headlines.json')
+    if news is None:
+        return 0
 
-            if append and Path.exists(output_file) and os.stat(output_file).st_size > 0:
-                with open(output_file, 'r', encoding='utf-8') as existing_file:
-                    existing_data = json.load(existing_file)
-                    existing_data.extend(news)
-                    news = existing_data
+    article_count = len(news)
 
-            with open(output_file, 'w', encoding='utf-8') as json_file:
-                json.dump(news, json_file, ensure_ascii=False, indent=4)
+    output_file = Path(data_dir / 'headlines' / f'{set_name}_{category}_headlines.jsonl')
 
-            print(f"Collected top {category} headlines for '{set_name}' in the country '{country}'"
-                  f" and saved it in {Path(output_file).relative_to(data_dir.parent)}")
+    if append:
+        migrate_legacy_store(output_file)
+        append_articles(output_file, news)
+    else:
+        write_articles(output_file, news)
+
+    print(f"Collected top {category} headlines for '{set_name}' in the country '{country}'"
+          f" and saved it in {Path(output_file).relative_to(data_dir.parent)}")
+    return article_count
 
 
 def main():
@@ -78,10 +93,32 @@ def main():
                         default=None,
                         help="The JSON file containing the sets of keywords or phrases to search for in"
                              " each article title and description.")
-
+    parser.add_argument("-m", "--max-articles",
+                        type=int,
+                        default=None,
+                        help="The maximum number of articles to fetch for each query."
+                             " If not given, you will be asked for each query.")
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=1,
+                        help="The number of keyword sets to fetch at the same time. Default is 1.")
+    parser.add_argument("--no-cache",
+                        action='store_true',
+                        help="Do not read or write the local cache of NewsAPI responses.")
+    parser.add_argument("--refresh",
+                        action='store_true',
+                        help="Ignore cached NewsAPI responses and fetch them again (the cache is still updated).")
+
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    if args.workers > 1 and args.max_articles is None:
+        parser.error("--workers greater than 1 requires --max-articles.")
+
+    with instrumentation.instrument('collect_entertainment_headlines', args.metrics, args.profile):
+        configure_cache(no_cache=args.no_cache, refresh=args.refresh)
 
-    collect_top_headlines(args.api_key, args.country, 'entertainment', keywords_file=args.keyword_sets)
+        collect_top_headlines(args.api_key, args.country, 'entertainment', keywords_file=args.keyword_sets,
+                              max_articles=args.max_articles, workers=args.workers)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,14 @@
 import argparse
 import datetime
 import json
-import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from newsapi import fetch_news
+import instrumentation
+from article_store import append_articles, migrate_legacy_store, write_articles
+from collection_state import CollectionState
+from keyword_matcher import ARTICLE_FIELDS, REPORT_FILE, KeywordMatcher, route_batch, write_report
+from newsapi import MAX_WORKERS, configure_cache, fetch_news, get_session, print_throughput_summary
 
 data_dir = Path(__file__).parent.parent / 'data'
 if not Path.exists(data_dir):
@@ -13,36 +18,204 @@ if not Path.exists(data_dir / 'articles'):
     Path.mkdir(data_dir / 'articles')
 
 
-def collect_news(api_key: str, start_date: datetime.date, end_date: datetime.date, keywords_file, language='en', search_title_only=False, append=True):
+def collect_news(api_key: str, start_date: datetime.date, end_date: datetime.date, keywords_file, language='en', search_title_only=False, append=True, max_articles=None, workers=1, incremental=False, resume=False, broad=False):
     with open(keywords_file, 'r', encoding='utf-8') as file:
         keyword_sets = json.load(file)
 
-    for keyword_set in keyword_sets:
-        for set_name, keywords in keyword_set.items():
-            print(f"collect_news: Fetching news for '{set_name}'...")
-            news = fetch_news(api_key,
-                              start_date,
-                              end_date,
-                              keywords=keywords,
-                              language=language,
-                              search_title_only=search_title_only)
+    set_items = [item for keyword_set in keyword_sets for item in keyword_set.items()]
 
-            if news is None:
-                continue
+    if broad:
+        started = time.perf_counter()
+        article_counts = collect_broad(api_key, start_date, end_date, dict(set_items), language=language,
+                                       search_title_only=search_title_only, append=append, max_articles=max_articles,
+                                       incremental=incremental, resume=resume)
+        seconds = time.perf_counter() - started
+        print_throughput_summary([(set_name, count, seconds) for set_name, count in article_counts.items()])
+        return
 
-            output_file = Path(data_dir / 'articles' / f'{set_name}_articles.json')
+    def collect_set(set_name, keywords):
+        started = time.perf_counter()
+        article_count = collect_keyword_set(api_key, start_date, end_date, set_name, keywords, language=language,
+                                            search_title_only=search_title_only, append=append,
+                                            max_articles=max_articles, incremental=incremental,
+                                            resume=resume)
+        return set_name, article_count, time.perf_counter() - started
 
-            if append and Path.exists(output_file) and os.stat(output_file).st_size > 0:
-                with open(output_file, 'r', encoding='utf-8') as existing_file:
-                    existing_data = json.load(existing_file)
-                    existing_data.extend(news)
-                    news = existing_data
+    # All the workers share the rate limiter and connection pool of the newsapi module.
+    get_session(pool_size=workers * MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda item: collect_set(*item), set_items))
 
-            with open(output_file, 'w', encoding='utf-8') as json_file:
-                json.dump(news, json_file, ensure_ascii=False, indent=4)
+    print_throughput_summary(results)
 
-            print(f"Collected news for '{set_name}' from {start_date} to {end_date}"
-                  f" and saved it in {Path(output_file).relative_to(data_dir.parent)}")
+
+def collect_keyword_set(api_key: str, start_date: datetime.date, end_date: datetime.date, set_name: str, keywords: list, language='en', search_title_only=False, append=True, max_articles=None, incremental=False, resume=False):
+    output_file = Path(data_dir / 'articles' / f'{set_name}_articles.jsonl')
+    if append or incremental:
+        migrate_legacy_store(output_file)
+
+    # In incremental mode, only ask for articles published since the newest one already stored for this set (or for
+    # the articles a previous, truncated run could not get).
+    state = None
+    published_after = published_before = None
+    if incremental:
+        state = CollectionState.load(output_file)
+        query_range = incremental_range([state], start_date, end_date)
+        if query_range is None:
+            print(f"collect_news: '{set_name}' is already up to date for {start_date} to {end_date}.")
+            return 0
+        published_after, published_before = query_range
+
+    print(f"collect_news: Fetching news for '{set_name}'{describe_range(published_after, published_before)}...")
+    query_info = {}
+    news = fetch_news(api_key,
+                      start_date,
+                      end_date,
+                      keywords=keywords,
+                      language=language,
+                      search_title_only=search_title_only,
+                      max_articles=max_articles,
+                      published_after=published_after,
+                      published_before=published_before,
+                      resume=resume,
+                      query_info=query_info)
+
+    if news is None:
+        if state is None or query_info.get('total_results') != 0:
+            return 0
+        # Nothing was published in the range, so it is complete.
+        news = []
+
+    complete = query_complete(set_name, query_info, incremental)
+    return save_set_articles(set_name, output_file, news, start_date, end_date, state=state, append=append,
+                             fetched=news, complete=complete)
+
+
+def incremental_range(states: list[CollectionState], start_date: datetime.date,
+                      end_date: datetime.date) -> tuple[str | None, str | None] | None:
+    """
+The publication range to query for the keyword sets of the given collection states: from their high-water mark,
+and up to the oldest article fetched so far if a previous query was truncated (see CollectionState).
+    :return: The 'from' and 'to' timestamps (None to use the start and end dates), or None if the sets are up to date.
+    """
+    marks = [state.newest_published_at for state in states]
+    gaps = [state.gap_before for state in states if state.gap_before]
+    published_after = None
+    if None not in marks and min(marks)[:10] >= str(start_date):
+        published_after = min(marks).removesuffix('Z')
+    if gaps:
+        return published_after, max(gaps).removesuffix('Z')
+    if None not in marks and min(marks)[:10] > str(end_date):
+        return None
+    return published_after, None
+
+
+def describe_range(published_after: str | None, published_before: str | None) -> str:
+    return (f"{f' published after {published_after}' if published_after else ''}"
+            f"{f' published before {published_before}' if published_before else ''}")
+
+
+def query_complete(name: str, query_info: dict, incremental: bool) -> bool:
+    # Whether a query returned all its results, warning about the articles left out in incremental mode.
+    total_results, total_to_get = query_info.get('total_results', 0), query_info.get('total_to_get', 0)
+    if total_to_get >= total_results:
+        return True
+    if incremental:
+        print(f"collect_news: Only the newest {total_to_get} of the {total_results} articles were fetched for"
+              f" '{name}'. The older ones will be fetched by the next incremental runs.")
+    return False
+
+
+def collect_broad(api_key: str, start_date: datetime.date, end_date: datetime.date, keyword_sets: dict[str, list], language='en', search_title_only=False, append=True, max_articles=None, incremental=False, resume=False) -> dict[str, int]:
+    """
+Collect the articles of all the keyword sets with a single query for all their keywords, then route every article to
+the sets whose keywords it actually contains (see keyword_matcher.py). Articles matching several sets are saved in
+each of them, the ones matching none in 'unmatched_articles.jsonl', and the matches of every article (and whether it
+is ambiguous) are reported in 'routing_report.csv'.
+    :return: The number of new articles saved for each keyword set, and for 'unmatched'.
+    """
+    matcher = KeywordMatcher(keyword_sets)
+    output_files = {set_name: Path(data_dir / 'articles' / f'{set_name}_articles.jsonl')
+                    for set_name in [*keyword_sets, 'unmatched']}
+    for output_file in output_files.values():
+        if append or incremental:
+            migrate_legacy_store(output_file)
+
+    # In incremental mode, ask for the articles published since the oldest of the sets' newest articles, so no set
+    # misses any (the ones a set already has are dropped by its collection state).
+    states = {}
+    published_after = published_before = None
+    if incremental:
+        states = {set_name: CollectionState.load(output_file) for set_name, output_file in output_files.items()}
+        # The unmatched store only uses its state to drop the articles it already has.
+        query_range = incremental_range([states[set_name] for set_name in keyword_sets], start_date, end_date)
+        if query_range is None:
+            print(f"collect_news: All the keyword sets are already up to date for {start_date} to {end_date}.")
+            return {set_name: 0 for set_name in output_files}
+        published_after, published_before = query_range
+
+    keywords = [keyword for set_keywords in keyword_sets.values() for keyword in set_keywords]
+    print(f"collect_news: Fetching news for {len(keyword_sets)} keyword sets with one query"
+          f"{describe_range(published_after, published_before)}...")
+    query_info = {}
+    news = fetch_news(api_key,
+                      start_date,
+                      end_date,
+                      keywords=keywords,
+                      language=language,
+                      search_title_only=search_title_only,
+                      max_articles=max_articles,
+                      published_after=published_after,
+                      published_before=published_before,
+                      resume=resume,
+                      query_info=query_info)
+
+    if news is None:
+        if not states or query_info.get('total_results') != 0:
+            return {set_name: 0 for set_name in output_files}
+        news = []
+
+    routed, report = route_batch(news, matcher, fields=('title',) if search_title_only else ARTICLE_FIELDS)
+    report_file = data_dir / 'articles' / REPORT_FILE
+    write_report(report, report_file, append=(append or incremental) and report_file.exists()
+                 and report_file.stat().st_size > 0)
+    ambiguous_count = sum(row['ambiguous'] for row in report)
+    print(f"collect_news: Routed {len(news)} articles: {ambiguous_count} matched several keyword sets,"
+          f" {len(routed.get('unmatched', []))} matched none (kept in 'unmatched'). The matches are reported in"
+          f" {report_file.relative_to(data_dir.parent)}.")
+
+    # The query covered every set, so the marks of every set move with all the articles it returned.
+    complete = query_complete('all keyword sets', query_info, incremental)
+    return {set_name: save_set_articles(set_name, output_file, routed.get(set_name, []), start_date, end_date,
+                                        state=states.get(set_name), append=append, fetched=news, complete=complete)
+            for set_name, output_file in output_files.items()}
+
+
+def save_set_articles(set_name: str, output_file: Path, news: list, start_date: datetime.date, end_date: datetime.date, state: CollectionState = None, append=True, fetched: list = None, complete=True) -> int:
+    """
+Save the new articles of a keyword set. In incremental mode, the set's collection state is updated with all the
+`fetched` articles of the query (default is `news`), and whether the query was `complete`.
+    """
+    if state is not None:
+        fetched_count = len(news)
+        news = state.filter_new(news)
+        print(f"collect_news: Dropped {fetched_count - len(news)} already collected articles for '{set_name}'.")
+
+    article_count = len(news)
+
+    if append or state is not None:
+        append_articles(output_file, news)
+    else:
+        write_articles(output_file, news)
+
+    if state is not None:
+        state.add(news)
+        state.record_fetch(news if fetched is None else fetched, complete)
+        state.save()
+
+    print(f"Collected news for '{set_name}' from {start_date} to {end_date}"
+          f" and saved it in {Path(output_file).relative_to(data_dir.parent)}")
+    return article_count
 
 
 def main():
@@ -72,15 +245,57 @@ def main():
     parser.add_argument("-t", "--title-only",
                         action='store_true',
                         help="Only search for the keywords in the article title.")
+    parser.add_argument("-m", "--max-articles",
+                        type=int,
+                        default=None,
+                        help="The maximum number of articles to fetch for each keyword set."
+                             " If not given, you will be asked for each query.")
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=1,
+                        help="The number of keyword sets to fetch at the same time. Default is 1.")
+    parser.add_argument("--no-cache",
+                        action='store_true',
+                        help="Do not read or write the local cache of NewsAPI responses.")
+    parser.add_argument("-r", "--resume",
+                        action='store_true',
+                        help="Continue the queries of a previous, interrupted run from their last fetched page. The"
+                             " queries must be the same, so pass the same --end-date if the run was interrupted on"
+                             " a previous day.")
+    parser.add_argument("-i", "--incremental",
+                        action='store_true',
+                        help="Only fetch articles newer than the newest one already collected for each keyword set,"
+                             " and skip articles whose URL was already collected. If more than --max-articles are"
+                             " found, the older ones are fetched by the next incremental runs.")
+    parser.add_argument("--refresh",
+                        action='store_true',
+                        help="Ignore cached NewsAPI responses and fetch them again (the cache is still updated).")
+    parser.add_argument("-b", "--broad",
+                        action='store_true',
+                        help="Fetch all the keyword sets with a single query, and route the articles to their sets"
+                             " locally by matching the keywords in their title, description and content. Articles"
+                             " matching no set are kept in 'unmatched_articles.jsonl', and the matches of every"
+                             " article are reported in 'routing_report.csv'.")
 
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    if args.workers > 1 and args.max_articles is None:
+        parser.error("--workers greater than 1 requires --max-articles.")
+
+    with instrumentation.instrument('collect_news', args.metrics, args.profile):
+        configure_cache(no_cache=args.no_cache, refresh=args.refresh)
 
-    collect_news(args.api_key,
-                 datetime.datetime.strptime(args.start_date, '%Y-%m-%d').date(),
-                 datetime.datetime.strptime(args.end_date, '%Y-%m-%d').date(),
-                 args.keyword_sets,
-                 language=args.language,
-                 search_title_only=args.title_only)
+        collect_news(args.api_key,
+                     datetime.datetime.strptime(args.start_date, '%Y-%m-%d').date(),
+                     datetime.datetime.strptime(args.end_date, '%Y-%m-%d').date(),
+                     args.keyword_sets,
+                     language=args.language,
+                     search_title_only=args.title_only,
+                     max_articles=args.max_articles,
+                     workers=args.workers,
+                     incremental=args.incremental,
+                     resume=args.resume,
+                     broad=args.broad)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+import json
+import os
+from pathlib import Path
+from article_store import read_articles
+
+
+class CollectionState:
+    """
+The incremental collection state of one keyword set: the high-water mark (every article published up to it has been
+collected) and the set of article URLs already stored.
+NewsAPI returns the newest articles first, so a query truncated by `max_articles` misses the oldest ones. The mark
+then stays where it was, and the range still missing (published after the mark and before the oldest article
+fetched, `gap_before`) is fetched backwards by the next runs. Once it is complete, the mark moves to the newest
+article of the truncated query (`gap_newest`).
+The marks are saved in `{set_name}_state.json` and the seen URLs in the append-only `{set_name}_seen_urls.txt`,
+one URL per line, both next to the set's article store.
+    """
+
+    def __init__(self, store_file):
+        store_file = Path(store_file)
+        set_file_stem = store_file.name.removesuffix('_articles.jsonl')
+        self.store_file = store_file
+        self.state_file = store_file.with_name(f'{set_file_stem}_state.json')
+        self.urls_file = store_file.with_name(f'{set_file_stem}_seen_urls.txt')
+        self.newest_published_at: str | None = None
+        self.gap_newest: str | None = None
+        self.gap_before: str | None = None
+        self.seen_urls: set[str] = set()
+
+    @classmethod
+    def load(cls, store_file) -> 'CollectionState':
+        state = cls(store_file)
+        if not state.state_file.exists():
+            # No state was saved for this set yet, so rebuild it from the articles already stored.
+            if state.store_file.exists():
+                articles = list(read_articles(state.store_file))
+                state.add(articles)
+                state.record_fetch(articles, complete=True)
+                state.save()
+            return state
+
+        with open(state.state_file, 'r', encoding='utf-8') as file:
+            marks = json.load(file)
+        state.newest_published_at = marks.get('newest_published_at')
+        state.gap_newest = marks.get('gap_newest')
+        state.gap_before = marks.get('gap_before')
+
+        if state.urls_file.exists():
+            with open(state.urls_file, 'r', encoding='utf-8') as file:
+                state.seen_urls = {line.rstrip('\n') for line in file if line.strip()}
+
+        return state
+
+    def filter_new(self, articles: list[dict]) -> list[dict]:
+        # Drop already-seen URLs, including duplicates within the batch itself.
+        new_articles = []
+        batch_urls = set()
+        for article in articles:
+            url = article.get('url')
+            if url in self.seen_urls or url in batch_urls:
+                continue
+            batch_urls.add(url)
+            new_articles.append(article)
+        return new_articles
+
+    def add(self, articles: list[dict]):
+        new_urls = list(dict.fromkeys(a['url'] for a in articles if a.get('url') and a['url'] not in self.seen_urls))
+        self.seen_urls.update(new_urls)
+
+        if new_urls:
+            with open(self.urls_file, 'a', encoding='utf-8') as file:
+                file.write(''.join(url + '\n' for url in new_urls))
+                file.flush()
+                os.fsync(file.fileno())
+
+    def record_fetch(self, fetched: list[dict], complete: bool):
+        """
+Move the marks after a query from the high-water mark (to the end date, or to `gap_before` if there is a gap).
+        :param fetched: All the articles the query returned, including the ones already collected.
+        :param complete: Whether the query returned all its results (it was not truncated by `max_articles`).
+        """
+        # ISO 8601 UTC timestamps compare correctly as strings.
+        published_ats = [a['publishedAt'] for a in fetched if a.get('publishedAt')]
+        if complete:
+            newest = max(published_ats + [self.gap_newest or '', self.newest_published_at or '']) or None
+            self.newest_published_at = newest
+            self.gap_newest = self.gap_before = None
+        elif published_ats:
+            if self.gap_before is None:
+                self.gap_newest = max(published_ats)
+            self.gap_before = min(published_ats + ([self.gap_before] if self.gap_before else []))
+
+    def save(self):
+        tmp_file = self.state_file.with_name(self.state_file.name + '.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as file:
+            json.dump({'newest_published_at': self.newest_published_at, 'gap_newest': self.gap_newest,
+                       'gap_before': self.gap_before}, file)
+        os.replace(tmp_file, self.state_file)
@@ -1,7 +1,12 @@
 import argparse
+import heapq
 import json
 import math
-from collections import Counter
+
+import numpy as np
+import instrumentation
+from compute_topic_word_frequency import count_corpus_word_freq
+from token_corpus import load_corpus
 
 
 # tfidf(word, topic, word_freq_by_topic) = tf(word, topic) * idf(word, articles)
@@ -20,34 +25,84 @@ def tfidf(word: str, topic: str, word_freq_by_topic: dict[str, dict[str, int]])
     return tf * idf
 
 
+class TopicWordIndex:
+    """
+Topic x vocabulary matrix of word frequencies in CSR form (`indptr`, `word_ids`, `counts`), with the document
+frequency of every word (the number of topics that used it) computed once.
+Within a topic's row, words keep the order of the topic's word frequency dictionary.
+    """
+
+    def __init__(self, word_freq_by_topic: dict[str, dict[str, int]]):
+        self.topics = list(word_freq_by_topic.keys())
+        self.word_ids: dict[str, int] = {}
+
+        indptr = [0]
+        word_ids = []
+        counts = []
+        for topic_word_freq in word_freq_by_topic.values():
+            for word, freq in topic_word_freq.items():
+                word_ids.append(self.word_ids.setdefault(word, len(self.word_ids)))
+                counts.append(freq)
+            indptr.append(len(word_ids))
+
+        self.vocabulary = list(self.word_ids.keys())
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(word_ids, dtype=np.int64)
+        self.counts = np.array(counts, dtype=np.float64)
+        self.document_frequency = np.bincount(self.indices, minlength=len(self.vocabulary))
+
+    def tfidf_scores(self) -> np.ndarray:
+        # idf only depends on the document frequency, so it is computed once per possible value (with math.log, so
+        # the scores are the same as the ones of `tfidf`).
+        num_topics = len(self.topics)
+        idf_by_df = np.array([0.0] + [math.log(num_topics / df) for df in range(1, num_topics + 1)])
+        return self.counts * idf_by_df[self.document_frequency[self.indices]]
+
+    def top_words(self, num_words: int) -> dict[str, dict[str, float]]:
+        scores = self.tfidf_scores()
+        top_words_by_topic = {}
+        for row, topic in enumerate(self.topics):
+            start, end = self.indptr[row], self.indptr[row + 1]
+            row_scores = scores[start:end].tolist()
+            # heapq.nlargest keeps ties in their original order, like Counter.most_common.
+            top_positions = heapq.nlargest(num_words, range(len(row_scores)), key=row_scores.__getitem__)
+            top_words_by_topic[topic] = {self.vocabulary[self.indices[start + i]]: row_scores[i]
+                                         for i in top_positions}
+        return top_words_by_topic
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-c", "--topic-counts", required=True,
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-c", "--topic-counts",
                         help="The path to the json file containing the word frequency for each topic.")
+    source.add_argument("--corpus",
+                        help="The path to a token corpus directory built by token_corpus.py, to count the word"
+                             " frequencies from instead of a json file.")
     parser.add_argument("-n", "--num-words", required=True, type=int,
                         help="The number of words by highest TF-IDF score to output for each topic.")
     parser.add_argument("--show-scores", action='store_true', default=False,
                         help="Show the tf-idf score for each word.")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
 
-    # Load word frequency json file back into a nested dictionary.
-    with open(args.topic_counts, 'r') as file:
-        word_freq_by_topic: dict[str, dict[str, int]] = json.load(file)
+    with instrumentation.instrument('compute_topic_lang', args.metrics, args.profile) as metrics:
+        if args.corpus:
+            word_freq_by_topic = count_corpus_word_freq(load_corpus(args.corpus))
+        else:
+            # Load word frequency json file back into a nested dictionary.
+            with open(args.topic_counts, 'r') as file:
+                word_freq_by_topic: dict[str, dict[str, int]] = json.load(file)
 
-    # Compute tfidf scores for all words and then store top n words in output dictionary.
-    top_words_by_topic: dict[str, [dict[str, float] | str]] = {}
-    for topic, topic_word_freq in word_freq_by_topic.items():
-        tfidf_scores: dict[str, float] = {}
-        for word in topic_word_freq.keys():
-            tfidf_scores[word] = tfidf(word, topic, word_freq_by_topic)
-
-        top_words = dict(Counter(tfidf_scores).most_common(args.num_words))
+        # Compute tfidf scores for all words and then store top n words in output dictionary.
+        index = TopicWordIndex(word_freq_by_topic)
+        metrics.count('topics', len(index.topics))
+        metrics.count('words', len(index.vocabulary))
+        top_words_by_topic: dict[str, [dict[str, float] | str]] = index.top_words(args.num_words)
         if not args.show_scores:
-            top_words = list(top_words.keys())
-
-        top_words_by_topic[topic] = top_words
+            top_words_by_topic = {topic: list(top_words.keys()) for topic, top_words in top_words_by_topic.items()}
 
-    print(json.dumps(top_words_by_topic, indent=4))
+        print(json.dumps(top_words_by_topic, indent=4))
 
 
 if __name__ == '__main__':
@@ -1,66 +1,133 @@
 import argparse
 import json
-import re
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from collections import Counter, defaultdict
+import instrumentation
+from json_to_columnar import read_table_chunks
+from ngram_sketch import DELTA, EPSILON, TOP_K, TopicNgramCounter
+from token_corpus import TokenCorpus, load_corpus, tokenize_descriptions
 
 THRESHOLD_FREQUENCY = 1
-
-
-def remove_punctuation(article_description: str) -> str:
-    # Replace punctuation with a space.
-    article_description = article_description.replace('&quot;', '')
-    article_description = re.sub('‘', "'", article_description)
-    article_description = re.sub('’', "'", article_description)
-    article_description = re.sub('“', '"', article_description)
-    article_description = re.sub('”', '"', article_description)
-    chars_to_replace = '()[],-.?!:;#&/"—'
-    for c in chars_to_replace:
-        if c in article_description:
-            article_description = article_description.replace(c, ' ')
-
-    article_description = re.sub('…', '...', article_description)
-    return article_description
-
-
-def count_word_freq_per_topic(csv_filepath) -> dict[int, dict[str, int]]:
-    df = pd.read_csv(csv_filepath, encoding='utf-8')
-    word_freq_by_topic = {}
-
-    df.reset_index()
-    for index, row in df.iterrows():
-        try:
-            #topic = TOPICS[int(row['Annotation']) - 1]
-            topic = row['Annotation']
-        except ValueError:
-            topic = "null/duplicate"
-
-        try:
-            description = str(row['Description'])
-        except ValueError:
-            description = ''
-
-        if topic not in word_freq_by_topic:
-            word_freq_by_topic[topic] = defaultdict(int)
-
-        description = remove_punctuation(description)
-        words = description.lower().split()
-        description_word_freq = Counter(words).most_common()
-
-        for word, freq in description_word_freq:
-            word_freq_by_topic[topic][word] += freq
-
+CHUNK_SIZE = 50000
+
+def count_chunk_words(chunk: pd.DataFrame) -> pd.DataFrame:
+    rows, word_ids, vocabulary = tokenize_descriptions(chunk['Description'])
+    return count_token_words(rows, word_ids, vocabulary, chunk['Annotation'])
+
+
+def count_token_words(rows: np.ndarray, word_ids: np.ndarray, vocabulary: list[str],
+                      row_topics: pd.Series) -> pd.DataFrame:
+    """
+Count the words of each topic in a set of tokenized articles.
+Along with each (topic, word) count, this keeps the position where the word was first counted for its topic: the row,
+then the word's rank in that row's description (most frequent first, ties by first occurrence). Sorting ties in the
+final counts by that position gives the same word order as counting the descriptions one by one.
+    :param rows: The row label of every token, in the order of the articles and of the words in their description.
+    :param word_ids: The word id of every token.
+    :param vocabulary: The word of each word id.
+    :param row_topics: The topic of each row, indexed by row label.
+    """
+    tokens = pd.DataFrame({'row': rows, 'word': word_ids})
+    tokens['position'] = tokens.groupby('row').cumcount()
+
+    row_counts = (tokens.groupby(['row', 'word'], sort=False)
+                  .agg(count=('position', 'size'), position=('position', 'min'))
+                  .reset_index())
+    row_counts['rank'] = -row_counts['count']
+    row_counts['topic'] = row_topics.loc[row_counts['row']].to_numpy()
+
+    word_counts = merge_word_counts([row_counts])
+    word_counts['word'] = np.array(vocabulary, dtype=object)[word_counts['word'].to_numpy()]
+    return word_counts
+
+
+def merge_word_counts(partial_counts: list[pd.DataFrame]) -> pd.DataFrame:
+    counts = pd.concat(partial_counts, ignore_index=True)
+    totals = counts.groupby(['topic', 'word'], sort=False, dropna=False)['count'].sum()
+    first_seen = (counts.sort_values(['row', 'rank', 'position'], kind='stable')
+                  .drop_duplicates(['topic', 'word'])
+                  .set_index(['topic', 'word'])[['row', 'rank', 'position']])
+    return first_seen.join(totals).reset_index()
+
+
+def count_word_freq_per_topic(csv_filepath, chunksize=CHUNK_SIZE, workers=1) -> dict[int, dict[str, int]]:
+    """
+Count the word frequencies in the article descriptions of each topic. The csv (or Parquet / Arrow) file is read in
+chunks, and with `workers` > 1 the chunks are counted in parallel processes before their counts are merged.
+    """
+    chunks = read_table_chunks(csv_filepath, columns=['Annotation', 'Description'], chunksize=chunksize)
+
+    if workers > 1:
+        partial_counts = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for chunk in chunks:
+                pending.append(executor.submit(count_chunk_words, chunk))
+                # Only keep a few chunks in flight, so memory stays bounded by the chunk size.
+                if len(pending) >= 2 * workers:
+                    partial_counts.append(merge_word_counts([f.result() for f in pending]))
+                    pending = []
+            partial_counts.extend(f.result() for f in pending)
+    else:
+        partial_counts = [count_chunk_words(chunk) for chunk in chunks]
+
+    return word_counts_by_topic(merge_word_counts(partial_counts))
+
+
+def count_corpus_word_freq(corpus: TokenCorpus, chunksize=CHUNK_SIZE) -> dict[int, dict[str, int]]:
+    """
+Count the word frequencies of each topic from an already tokenized corpus (see token_corpus.py), without
+tokenizing the descriptions again. Gives the same result as `count_word_freq_per_topic` on the corpus' articles.
+    """
+    row_topics = pd.Series(corpus.topic_labels(), dtype=object)
+    partial_counts = []
+    for start in range(0, corpus.num_articles, chunksize):
+        end = min(start + chunksize, corpus.num_articles)
+        rows, word_ids = corpus.tokens(start, end)
+        partial_counts.append(count_token_words(rows, word_ids, corpus.vocabulary, row_topics))
+    return word_counts_by_topic(merge_word_counts(partial_counts))
+
+
+def count_ngram_freq_per_topic(csv_filepath, ngram_sizes: tuple[int, ...], epsilon=EPSILON, delta=DELTA, top_k=TOP_K,
+                               chunksize=CHUNK_SIZE) -> dict:
+    """
+Estimate the frequencies of the n-grams (phrases of `ngram_sizes` words, like "box office") in the article
+descriptions of each topic, with a count-min sketch per topic, and keep the `top_k` most frequent of each topic,
+plus the ones of the other topics it also uses, for their document frequency (see ngram_sketch.py). Unlike exact
+counts, the memory used does not grow with the corpus.
+    """
+    counter = TopicNgramCounter(ngram_sizes, epsilon=epsilon, delta=delta, top_k=top_k)
+    for chunk in read_table_chunks(csv_filepath, columns=['Annotation', 'Description'], chunksize=chunksize):
+        rows, word_ids, vocabulary = tokenize_descriptions(chunk['Description'])
+        counter.add_tokens(rows, word_ids, vocabulary, chunk['Annotation'])
+    instrumentation.count('sketch_bytes', counter.nbytes)
+    return counter.phrase_freq_by_topic()
+
+
+def count_corpus_ngram_freq(corpus: TokenCorpus, ngram_sizes: tuple[int, ...], epsilon=EPSILON, delta=DELTA,
+                            top_k=TOP_K, chunksize=CHUNK_SIZE) -> dict:
+    # Like count_ngram_freq_per_topic, from an already tokenized corpus.
+    counter = TopicNgramCounter(ngram_sizes, epsilon=epsilon, delta=delta, top_k=top_k)
+    row_topics = pd.Series(corpus.topic_labels(), dtype=object)
+    for start in range(0, corpus.num_articles, chunksize):
+        rows, word_ids = corpus.tokens(start, min(start + chunksize, corpus.num_articles))
+        counter.add_tokens(rows, word_ids, corpus.vocabulary, row_topics)
+    instrumentation.count('sketch_bytes', counter.nbytes)
+    return counter.phrase_freq_by_topic()
+
+
+def word_counts_by_topic(word_counts: pd.DataFrame) -> dict[int, dict[str, int]]:
     # Remove words with frequencies below the threshold.
-    for topic_word_freq in word_freq_by_topic.values():
-        for word, freq in dict(topic_word_freq).items():
-            if freq < THRESHOLD_FREQUENCY:
-                del topic_word_freq[word]
+    word_counts = word_counts[word_counts['count'] >= THRESHOLD_FREQUENCY]
 
     # Sort topics alphabetically, and sort words by frequency (decreasing).
-    word_freq_by_topic = dict(sorted(word_freq_by_topic.items(), key=lambda i: i[0]))
-    for topic, topic_word_freq in word_freq_by_topic.items():
-        word_freq_by_topic[topic] = dict(sorted(topic_word_freq.items(), key=lambda i: i[1], reverse=True))
+    word_counts = word_counts.sort_values(['count', 'row', 'rank', 'position'], ascending=[False, True, True, True],
+                                          kind='stable')
+    word_freq_by_topic = {}
+    for topic, topic_counts in word_counts.groupby('topic', sort=True, dropna=False):
+        word_freq_by_topic[topic] = dict(zip(topic_counts['word'], topic_counts['count'].astype(int).tolist()))
 
     return word_freq_by_topic
 
@@ -68,16 +135,44 @@ def count_word_freq_per_topic(csv_filepath) -> dict[int, dict[str, int]]:
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-o", "--output", required=True, help="The path to the output json file.")
-    parser.add_argument("-a", "--articles", required=True, help="The path to the articles csv file.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-a", "--articles", help="The path to the articles csv file.")
+    source.add_argument("-c", "--corpus",
+                        help="The path to a token corpus directory built by token_corpus.py, used instead of"
+                             " tokenizing the articles again.")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="The number of processes counting chunks of articles in parallel. Default is 1.")
+    parser.add_argument("-n", "--ngrams", type=int, nargs='+', default=None,
+                        help="Count phrases of these numbers of words (e.g. 2 3) instead of single words. The counts"
+                             " are estimated in fixed memory, and only the --top-k most frequent phrases of each"
+                             " topic are output (with the ones of other topics it also uses, for their TF-IDF).")
+    parser.add_argument("--epsilon", type=float, default=EPSILON,
+                        help=f"The error bound of the phrase counts, as a fraction of the number of phrases of the"
+                             f" topic. Default is {EPSILON}.")
+    parser.add_argument("--delta", type=float, default=DELTA,
+                        help=f"The probability of a phrase count exceeding the error bound. Default is {DELTA}.")
+    parser.add_argument("--top-k", type=int, default=TOP_K,
+                        help=f"The number of most frequent phrases to keep for each topic. Default is {TOP_K}.")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
 
-    word_frequencies = count_word_freq_per_topic(args.articles)
-
-    output_file = Path(args.output)
-    output_file.parent.mkdir(exist_ok=True, parents=True)
-
-    with open(output_file, 'w', encoding='utf-8') as file:
-        json.dump(word_frequencies, file, indent=4)
+    with instrumentation.instrument('compute_topic_word_frequency', args.metrics, args.profile):
+        if args.ngrams:
+            options = {'epsilon': args.epsilon, 'delta': args.delta, 'top_k': args.top_k}
+            if args.corpus:
+                word_frequencies = count_corpus_ngram_freq(load_corpus(args.corpus), tuple(args.ngrams), **options)
+            else:
+                word_frequencies = count_ngram_freq_per_topic(args.articles, tuple(args.ngrams), **options)
+        elif args.corpus:
+            word_frequencies = count_corpus_word_freq(load_corpus(args.corpus))
+        else:
+            word_frequencies = count_word_freq_per_topic(args.articles, workers=args.workers)
+
+        output_file = Path(args.output)
+        output_file.parent.mkdir(exist_ok=True, parents=True)
+
+        with open(output_file, 'w', encoding='utf-8') as file:
+            json.dump(word_frequencies, file, indent=4)
 
 
 if __name__ == '__main__':
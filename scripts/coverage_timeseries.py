@@ -0,0 +1,358 @@
+import argparse
+import os
+import zlib
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import instrumentation
+from annotation_sampler import STRATA, article_stratum, iter_rows
+from article_store import batch_articles, read_articles_from
+
+BATCH_SIZE = 10000
+# The number of bytes before the point a store was read to that are checked before reading on from it.
+CHECK_SIZE = 4096
+GRANULARITIES = {'hour': 3600, 'day': 86400}
+DIMENSIONS = ('movie', 'topic', 'source')
+UNANNOTATED = 'unannotated'
+UNKNOWN = 'unknown'
+# Annotations that are not topics (see build_network_topic_coverage_per_movie.py).
+EXCLUDED_LABELS = ['duplicate']
+
+
+class CoverageSeries:
+    """
+Article counts per time bucket (an hour or a day, in UTC) x movie x topic x source, pre-aggregated and stored as
+parallel arrays sorted by (bucket, movie, topic, source): only the combinations that have articles are stored, so
+the size grows with the coverage, not with the number of sources times the number of buckets.
+The hashes of the URLs of the counted articles are kept too, so adding the same articles again counts nothing, and
+so is the point every input file was read to (see new_rows), so an update only reads what was appended since.
+Batches of articles are staged, then deduplicated and merged into the sorted arrays all at once (see merge_staged).
+    """
+
+    def __init__(self, granularity='day'):
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"coverage_timeseries: Unknown granularity '{granularity}', expected one of"
+                             f" {list(GRANULARITIES)}.")
+        self.granularity = granularity
+        self.labels: dict[str, list] = {dimension: [] for dimension in DIMENSIONS}
+        self.buckets = np.zeros(0, dtype=np.int64)
+        self.ids = {dimension: np.zeros(0, dtype=np.int32) for dimension in DIMENSIONS}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.seen_urls = np.zeros(0, dtype=np.uint64)
+        # The (offset, check) every input file was read to, by resolved path.
+        self.file_offsets: dict[str, tuple[int, int]] = {}
+        self.staged: list[dict[str, np.ndarray]] = []
+
+    @property
+    def bucket_seconds(self) -> int:
+        return GRANULARITIES[self.granularity]
+
+    def bucket_of(self, timestamp) -> int:
+        return int(pd.Timestamp(timestamp, tz='UTC').timestamp() // self.bucket_seconds)
+
+    def _intern(self, dimension: str, values: list) -> np.ndarray:
+        # Labels are kept as strings, like save stores them, so e.g. a numeric topic is the same label once loaded.
+        label_ids = {label: label_id for label_id, label in enumerate(self.labels[dimension])}
+        codes, uniques = pd.factorize(np.array([str(value) for value in values], dtype=object))
+        unique_ids = [label_ids.setdefault(value, len(label_ids)) for value in uniques]
+        self.labels[dimension] = list(label_ids)
+        return np.array(unique_ids, dtype=np.int32)[codes]
+
+    def add_articles(self, articles: list[dict], default_movie=None) -> int:
+        """
+Count a batch of articles (article store dictionaries or table rows) that were not counted before. The topic of an
+article is its 'Annotation' (or the 'Predicted Annotation' of topic_classifier.py), or 'unannotated'. Articles
+annotated as duplicates, or without a valid 'publishedAt', are not counted.
+        :param default_movie: The movie of articles without an 'ID' (see annotation_sampler.article_stratum).
+        :return: The number of articles counted.
+        """
+        self.stage_articles(articles, default_movie)
+        return int(self.merge_staged().sum())
+
+    def stage_articles(self, articles: list[dict], default_movie=None, tag=0):
+        """
+Prepare a batch of articles to be counted by merge_staged (see add_articles), without deduplicating them yet.
+        :param tag: A number to count the articles by in merge_staged, e.g. the position of their file.
+        """
+        urls = pd.Series([article.get('url') for article in articles], dtype=object)
+        topics = []
+        for article in articles:
+            topic = article.get('Annotation', article.get('Predicted Annotation'))
+            topics.append(UNANNOTATED if topic is None or pd.isna(topic) else topic)
+        topics = np.array(topics, dtype=object)
+        published_at = pd.to_datetime(pd.Series([article.get('publishedAt') for article in articles], dtype=object),
+                                      utc=True, errors='coerce')
+        countable = published_at.notna().to_numpy() & ~np.isin(topics, EXCLUDED_LABELS)
+
+        staged = {'url_hashes': pd.util.hash_pandas_object(urls, index=False).to_numpy(),
+                  'has_url': urls.notna().to_numpy(),
+                  'countable': countable,
+                  'buckets': np.zeros(len(articles), dtype=np.int64),
+                  'tags': np.full(len(articles), tag, dtype=np.int64),
+                  **{dimension: np.zeros(len(articles), dtype=np.int32) for dimension in DIMENSIONS}}
+        if countable.any():
+            countable_articles = [article for article, counted in zip(articles, countable) if counted]
+            movies, sources = zip(*(article_stratum(article, STRATA, default_movie)
+                                    for article in countable_articles))
+            seconds = published_at[countable].to_numpy(dtype='datetime64[s]').astype(np.int64)
+            staged['buckets'][countable] = seconds // self.bucket_seconds
+            staged['movie'][countable] = self._intern('movie', [UNKNOWN if m is None else m for m in movies])
+            staged['topic'][countable] = self._intern('topic', list(topics[countable]))
+            staged['source'][countable] = self._intern('source', [UNKNOWN if s is None else s for s in sources])
+        self.staged.append(staged)
+
+    def merge_staged(self) -> np.ndarray:
+        """
+Count the staged articles that were not counted before, with a single sort of the counts, whatever the number of
+batches staged.
+        :return: The number of articles counted for each tag.
+        """
+        if not self.staged:
+            return np.zeros(0, dtype=np.int64)
+        staged = {key: np.concatenate([batch[key] for batch in self.staged]) for key in self.staged[0]}
+        self.staged = []
+
+        # New URLs only, and the first occurrence of each. Articles without a URL are always new.
+        url_hashes, has_url = staged['url_hashes'], staged['has_url']
+        first = np.zeros(len(url_hashes), dtype=bool)
+        first[np.unique(url_hashes, return_index=True)[1]] = True
+        new = ~has_url | (first & ~np.isin(url_hashes, self.seen_urls))
+        self.seen_urls = np.union1d(self.seen_urls, url_hashes[new & has_url])
+
+        keep = new & staged['countable']
+        if keep.any():
+            self._merge(staged['buckets'][keep], {dimension: staged[dimension][keep] for dimension in DIMENSIONS},
+                        np.ones(int(keep.sum()), dtype=np.int64))
+        return np.bincount(staged['tags'][keep], minlength=int(staged['tags'].max()) + 1)
+
+    def new_rows(self, articles_file) -> Iterator[dict]:
+        """
+Iterate over the articles of a file added since it was last read, and remember where it was read to. A .jsonl store
+is read on from the byte offset it was read to, after checking that the bytes before it did not change. Other files
+are read in full, but the rows that were already read are skipped. A file rewritten since (different bytes before
+the offset, or fewer rows) is read again from the start: the seen URLs keep its articles from being counted twice.
+        """
+        key = str(Path(articles_file).resolve())
+        offset, check = self.file_offsets.get(key, (0, 0))
+        if Path(articles_file).suffix == '.jsonl':
+            if offset and (os.path.getsize(articles_file) < offset or tail_check(articles_file, offset) != check):
+                print(f"coverage_timeseries: '{articles_file}' changed before the point it was read to, so it is"
+                      f" read again from the start.")
+                offset = 0
+            for article, offset in read_articles_from(articles_file, offset):
+                yield article
+            self.file_offsets[key] = (offset, tail_check(articles_file, offset))
+            return
+
+        row_count = 0
+        for row in iter_rows(articles_file):
+            row_count += 1
+            if row_count > offset:
+                yield row
+        if row_count < offset:
+            print(f"coverage_timeseries: '{articles_file}' has fewer rows than when it was read, so it is read again"
+                  f" from the start.")
+            self.file_offsets[key] = (0, 0)
+            yield from self.new_rows(articles_file)
+            return
+        self.file_offsets[key] = (row_count, 0)
+
+    def _merge(self, buckets: np.ndarray, ids: dict[str, np.ndarray], counts: np.ndarray):
+        # Concatenate the new counts, sort by (bucket, movie, topic, source) and sum the counts of equal keys.
+        buckets = np.concatenate((self.buckets, buckets))
+        ids = {dimension: np.concatenate((self.ids[dimension], ids[dimension])) for dimension in DIMENSIONS}
+        counts = np.concatenate((self.counts, counts))
+        order = np.lexsort((ids['source'], ids['topic'], ids['movie'], buckets))
+        keys = [buckets[order]] + [ids[dimension][order] for dimension in DIMENSIONS]
+        changed = np.zeros(len(order), dtype=bool)
+        changed[:1] = True
+        for key in keys:
+            changed[1:] |= key[1:] != key[:-1]
+        starts = np.flatnonzero(changed)
+
+        self.buckets = keys[0][starts]
+        self.ids = {dimension: key[starts] for dimension, key in zip(DIMENSIONS, keys[1:])}
+        self.counts = np.add.reduceat(counts[order], starts) if len(starts) else np.zeros(0, dtype=np.int64)
+
+    def _select(self, start=None, end=None, **filters) -> np.ndarray:
+        # The positions of the entries from `start` (included) to `end` (excluded), matching the label filters.
+        first = np.searchsorted(self.buckets, self.bucket_of(start)) if start is not None else 0
+        last = np.searchsorted(self.buckets, self.bucket_of(end)) if end is not None else len(self.buckets)
+        positions = np.arange(first, last)
+        for dimension, values in filters.items():
+            if values is None:
+                continue
+            values = {str(value) for value in (values if pd.api.types.is_list_like(values) else [values])}
+            wanted = [label_id for label_id, label in enumerate(self.labels[dimension]) if label in values]
+            positions = positions[np.isin(self.ids[dimension][positions], wanted)]
+        return positions
+
+    def _group_labels(self, by, positions: np.ndarray) -> pd.DataFrame:
+        return pd.DataFrame({dimension: np.array(self.labels[dimension], dtype=object)[self.ids[dimension][positions]]
+                             for dimension in by})
+
+    def rollup(self, by=('movie',), start=None, end=None, **filters) -> pd.Series:
+        """
+Total the articles of a time range per group, e.g. per movie and topic with by=('movie', 'topic').
+        :param start: The first day / hour of the range (anything pd.Timestamp accepts). Default is the first bucket.
+        :param end: The end of the range (excluded). Default is after the last bucket.
+        :param filters: Only count the given movie(s), topic(s) and / or source(s), e.g. movie='The Eras Tour'.
+        :return: The number of articles of each group.
+        """
+        positions = self._select(start, end, **filters)
+        groups = self._group_labels(by, positions)
+        groups['articles'] = self.counts[positions]
+        return groups.groupby(list(by), sort=True)['articles'].sum().sort_values(ascending=False, kind='stable')
+
+    def series(self, by=('movie',), start=None, end=None, every=1, **filters) -> pd.DataFrame:
+        """
+The number of articles of every group over time, one row per `every` buckets (e.g. every=7 for weekly counts of a
+daily series). Buckets without articles are included, with counts of 0.
+        :return: A DataFrame with the start time of every row as index and one column per group.
+        """
+        positions = self._select(start, end, **filters)
+        if len(positions) == 0:
+            return pd.DataFrame()
+        first = self.bucket_of(start) if start is not None else self.buckets[positions[0]]
+        last = self.bucket_of(end) if end is not None else self.buckets[positions[-1]] + 1
+        rows = (self.buckets[positions] - first) // every
+
+        groups = self._group_labels(by, positions)
+        groups['row'] = rows
+        groups['articles'] = self.counts[positions]
+        table = groups.pivot_table(index='row', columns=list(by), values='articles', aggfunc='sum', fill_value=0)
+        table = table.reindex(np.arange(-(-(last - first) // every)), fill_value=0)
+        table.index = pd.to_datetime((first + table.index * every) * self.bucket_seconds, unit='s', utc=True)
+        table.index.name = 'time'
+        return table
+
+    def save(self, coverage_file):
+        # Written next to the file and renamed over it, so an interrupted update never leaves a broken file.
+        coverage_file = Path(coverage_file)
+        tmp_file = coverage_file.with_name(coverage_file.name + '.tmp.npz')
+        np.savez_compressed(tmp_file, granularity=self.granularity, buckets=self.buckets, counts=self.counts,
+                            seen_urls=self.seen_urls,
+                            offset_files=np.array(list(self.file_offsets), dtype=str),
+                            offsets=np.array([offset for offset, _ in self.file_offsets.values()], dtype=np.int64),
+                            offset_checks=np.array([check for _, check in self.file_offsets.values()], dtype=np.int64),
+                            **{f'{dimension}_ids': self.ids[dimension] for dimension in DIMENSIONS},
+                            **{f'{dimension}_labels': np.array(self.labels[dimension], dtype=str)
+                               for dimension in DIMENSIONS})
+        os.replace(tmp_file, coverage_file)
+
+    @classmethod
+    def load(cls, coverage_file) -> 'CoverageSeries':
+        with np.load(coverage_file) as arrays:
+            series = cls(str(arrays['granularity']))
+            series.buckets = arrays['buckets']
+            series.counts = arrays['counts']
+            series.seen_urls = arrays['seen_urls']
+            series.ids = {dimension: arrays[f'{dimension}_ids'] for dimension in DIMENSIONS}
+            series.labels = {dimension: arrays[f'{dimension}_labels'].tolist() for dimension in DIMENSIONS}
+            # Coverage files saved before the offsets were kept read every file from the start once.
+            if 'offset_files' in arrays:
+                series.file_offsets = {key: (int(offset), int(check)) for key, offset, check in zip(
+                    arrays['offset_files'].tolist(), arrays['offsets'], arrays['offset_checks'])}
+        return series
+
+
+def tail_check(store_file, offset: int, size=CHECK_SIZE) -> int:
+    # The crc32 of the `size` bytes before an offset of a file, to tell whether they changed since it was read.
+    with open(store_file, 'rb') as file:
+        file.seek(max(0, offset - size))
+        return zlib.crc32(file.read(min(offset, size)))
+
+
+def update_coverage(coverage_file, articles_files: list, granularity='day', movie=None) -> CoverageSeries:
+    """
+Add the articles of article stores (.jsonl or .json) or tables (csv, Parquet or Arrow) to a coverage series,
+creating it if it does not exist. Only articles not counted before are added, so the same files can be added again
+as they grow: each file is only read from where the last update left it (see CoverageSeries.new_rows), and all the
+new articles are merged into the series at once.
+    :param movie: The movie of the articles without an 'ID'. Default is the name of each file without its
+    '_articles' suffix, like for the article stores of collect_news.py.
+    """
+    coverage_file = Path(coverage_file)
+    if coverage_file.exists():
+        series = CoverageSeries.load(coverage_file)
+        if series.granularity != granularity:
+            raise ValueError(f"coverage_timeseries: '{coverage_file}' counts articles per {series.granularity},"
+                             f" not per {granularity}.")
+    else:
+        series = CoverageSeries(granularity)
+
+    for tag, articles_file in enumerate(articles_files):
+        file_movie = movie if movie is not None else Path(articles_file).stem.removesuffix('_articles')
+        for batch in batch_articles(series.new_rows(articles_file), BATCH_SIZE):
+            series.stage_articles(batch, file_movie, tag)
+
+    added_counts = series.merge_staged()
+    for tag, articles_file in enumerate(articles_files):
+        added = int(added_counts[tag]) if tag < len(added_counts) else 0
+        instrumentation.count('articles_counted', added)
+        print(f"coverage_timeseries: Counted {added} new articles from '{articles_file}'.")
+
+    coverage_file.parent.mkdir(parents=True, exist_ok=True)
+    series.save(coverage_file)
+    return series
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keeps hourly or daily article counts per movie, topic and source, updated incrementally from"
+                    " the collected articles, to follow the coverage of the movies over time without reading the"
+                    " articles again.\n\n"
+                    "Example usage:\npython -m coverage_timeseries update -c ../data/coverage.npz"
+                    " -f ../data/articles/*_articles.jsonl\n"
+                    "python -m coverage_timeseries query -c ../data/coverage.npz --start 2023-10-01"
+                    " --end 2023-11-01 --by movie --every 7",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update_parser = subparsers.add_parser('update', help="Count new articles.")
+    update_parser.add_argument("-c", "--coverage", required=True, help="The path to the coverage file (.npz).")
+    update_parser.add_argument("-f", "--files", nargs='+', required=True,
+                               help="The article stores (.jsonl or .json) or csv / Parquet / Arrow files to count.")
+    update_parser.add_argument("-g", "--granularity", choices=list(GRANULARITIES), default='day',
+                               help="The size of the time buckets of a new coverage file. Default is a day.")
+    update_parser.add_argument("-m", "--movie", default=None,
+                               help="The movie of articles without an 'ID' column. Default is the name of each file.")
+
+    query_parser = subparsers.add_parser('query', help="Print the coverage over a time range.")
+    query_parser.add_argument("-c", "--coverage", required=True, help="The path to the coverage file (.npz).")
+    query_parser.add_argument("--start", default=None, help="The first day (or hour) to count. Default is the first.")
+    query_parser.add_argument("--end", default=None,
+                              help="The day (or hour) to stop at, excluded. Default is after the last.")
+    query_parser.add_argument("--by", nargs='+', choices=DIMENSIONS, default=['movie'],
+                              help="What to group the counts by. Default is the movie.")
+    query_parser.add_argument("--every", type=int, default=1,
+                              help="Add up the counts of this many buckets per row, e.g. 7 for weekly counts."
+                                   " Default is 1.")
+    query_parser.add_argument("--total", action='store_true', help="Print the totals of the range instead.")
+    for dimension in DIMENSIONS:
+        query_parser.add_argument(f"--{dimension}", nargs='+', default=None,
+                                  help=f"Only count the articles of these {dimension}s.")
+    for subparser in (update_parser, query_parser):
+        instrumentation.add_arguments(subparser)
+    args = parser.parse_args()
+
+    with instrumentation.instrument(f'coverage_timeseries_{args.command}', args.metrics, args.profile):
+        if args.command == 'update':
+            series = update_coverage(args.coverage, args.files, granularity=args.granularity, movie=args.movie)
+            print(f"coverage_timeseries: '{args.coverage}' holds {int(series.counts.sum())} articles in"
+                  f" {len(series.counts)} (bucket, movie, topic, source) counts.")
+            return
+
+        series = CoverageSeries.load(args.coverage)
+        filters = {dimension: getattr(args, dimension) for dimension in DIMENSIONS}
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+            if args.total:
+                print(series.rollup(tuple(args.by), args.start, args.end, **filters))
+            else:
+                print(series.series(tuple(args.by), args.start, args.end, every=args.every, **filters))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,110 @@
 import argparse
 import pandas as pd
+from pathlib import Path
+import instrumentation
+from article_store import batch_articles, read_articles, write_articles, append_articles
+from json_to_columnar import read_table_chunks
+from json_to_csv import articles_to_csv
+from near_duplicates import DEFAULT_THRESHOLD, NearDuplicateIndex
+
+CHUNK_SIZE = 10000
+
+
+def remove_duplicates(input_file, output_file, threshold=DEFAULT_THRESHOLD, exact=False):
+    """
+Remove duplicate articles, keeping the first occurrence. Articles with the same title are always duplicates, and
+unless `exact` is set, articles whose title and description are near-duplicates (MinHash similarity of at least
+`threshold`) are removed too, and the clusters found are reported in a '_clusters.csv' file next to the output.
+    """
+    if exact:
+        remove_exact_duplicates(input_file, output_file)
+        return
+
+    index = NearDuplicateIndex(threshold=threshold)
+    seen_titles = {}
+    clusters: dict[int, list[tuple[int, float, str]]] = {}
+    kept_titles: dict[int, str] = {}
+    row_number = 0
+
+    def keep_mask(titles, descriptions) -> list[bool]:
+        nonlocal row_number
+        mask = []
+        for title, description in zip(titles, descriptions):
+            title = '' if pd.isna(title) else str(title)
+            description = '' if pd.isna(description) else str(description)
+
+            if title in seen_titles:
+                duplicate_of, similarity = seen_titles[title], 1.0
+            else:
+                match = index.add(row_number, f"{title} {description}")
+                duplicate_of, similarity = match if match is not None else (None, None)
+
+            if duplicate_of is None:
+                seen_titles[title] = row_number
+                kept_titles[row_number] = title
+                mask.append(True)
+            else:
+                clusters.setdefault(duplicate_of, []).append((row_number, similarity, title))
+                mask.append(False)
+            row_number += 1
+        return mask
+
+    output_file = Path(output_file)
+    kept_count = 0
+    if Path(input_file).suffix in ('.json', '.jsonl'):
+        def unique_articles():
+            for batch in batch_articles(read_articles(input_file), CHUNK_SIZE):
+                mask = keep_mask([a.get('title') for a in batch], [a.get('description') for a in batch])
+                yield from (article for article, keep in zip(batch, mask) if keep)
+
+        if output_file.suffix == '.jsonl':
+            kept_count = write_articles(output_file, [])
+            for batch in batch_articles(unique_articles(), CHUNK_SIZE):
+                kept_count += append_articles(output_file, batch)
+        else:
+            kept_count = articles_to_csv(unique_articles(), output_file)
+    else:
+        header = True
+        for chunk in read_table_chunks(input_file, chunksize=CHUNK_SIZE):
+            title_column = find_column(chunk, 'title')
+            description_column = find_column(chunk, 'description')
+            descriptions = chunk[description_column] if description_column else [''] * len(chunk)
+            chunk = chunk[keep_mask(chunk[title_column], descriptions)]
+            chunk.to_csv(output_file, mode='w' if header else 'a', header=header, index=False)
+            header = False
+            kept_count += len(chunk)
+
+    report_file = output_file.with_name(f'{output_file.stem}_clusters.csv')
+    write_cluster_report(clusters, kept_titles, report_file)
+    print(f"{row_number - kept_count} duplicate rows removed in {len(clusters)} clusters."
+          f" Output saved to {output_file}, cluster report saved to {report_file}")
+
+
+def find_column(df: pd.DataFrame, name: str) -> str | None:
+    # The collected articles use 'title', the annotated files use 'Title'.
+    for column in df.columns:
+        if column.lower() == name:
+            return column
+    return None
+
+
+def write_cluster_report(clusters: dict[int, list[tuple[int, float, str]]], kept_titles: dict[int, str], report_file):
+    rows = []
+    for cluster_id, (kept_row, duplicates) in enumerate(sorted(clusters.items())):
+        rows.append({'cluster': cluster_id, 'row': kept_row, 'kept': True, 'similarity': 1.0,
+                     'title': kept_titles[kept_row]})
+        for row, similarity, title in duplicates:
+            rows.append({'cluster': cluster_id, 'row': row, 'kept': False, 'similarity': round(similarity, 3),
+                         'title': title})
+
+    pd.DataFrame(rows, columns=['cluster', 'row', 'kept', 'similarity', 'title']).to_csv(report_file, index=False)
+
+
+def remove_exact_duplicates(input_file, output_file):
+    if Path(input_file).suffix in ('.json', '.jsonl'):
+        remove_duplicate_articles(input_file, output_file)
+        return
 
-def remove_duplicates(input_file, output_file):
     df = pd.read_csv(input_file)
 
     # Remove rows with duplicate titles, keeping the first occurrence
@@ -12,10 +115,40 @@ def remove_duplicates(input_file, output_file):
     print(f"Rows with duplicate titles removed. Output saved to {output_file}")
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Remove rows with duplicate titles from a CSV file')
-    parser.add_argument('-input', type=str, help='Input CSV file name')
-    parser.add_argument('-output', type=str, help='Output CSV file name')
+def remove_duplicate_articles(input_file, output_file):
+    # Stream the articles of an article store, keeping the first occurrence of each title
+    seen_titles = set()
+
+    def unique_articles():
+        for article in read_articles(input_file):
+            title = article.get('title')
+            if title in seen_titles:
+                continue
+            seen_titles.add(title)
+            yield article
+
+    if Path(output_file).suffix == '.jsonl':
+        write_articles(output_file, unique_articles())
+    else:
+        articles_to_csv(unique_articles(), output_file)
+    print(f"Articles with duplicate titles removed. Output saved to {output_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove duplicate and near-duplicate articles from a CSV file or'
+                                                 ' article store')
+    parser.add_argument('-input', type=str, help='Input CSV, JSON or JSONL file name')
+    parser.add_argument('-output', type=str, help='Output CSV or JSONL file name')
+    parser.add_argument('-threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'Minimum estimated similarity of the title and description for two articles to be'
+                             f' near-duplicates. Default is {DEFAULT_THRESHOLD}')
+    parser.add_argument('-exact', action='store_true', help='Only remove rows with exactly the same title')
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
 
-    remove_duplicates(args.input, args.output)
+    with instrumentation.instrument('delete_duplicates', args.metrics, args.profile):
+        remove_duplicates(args.input, args.output, threshold=args.threshold, exact=args.exact)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+PROFILE_TOP_ENTRIES = 30
+
+# The stages currently being instrumented (innermost last). Counters are added to all of them.
+_active_stages: list['StageMetrics'] = []
+
+
+class StageMetrics:
+    """
+Counters of one instrumented stage (rows processed, HTTP requests, seconds spent waiting...). Thread-safe, since
+e.g. the NewsAPI pages are fetched from several threads.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.counters: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+def count(name: str, value: float = 1):
+    """
+Add to a counter of the running stages. Does nothing if no stage is instrumented, so library functions can count
+what they process whether or not they are called from an instrumented main().
+    """
+    for metrics in _active_stages:
+        metrics.count(name, value)
+
+
+def add_arguments(parser):
+    # The command line options every script's main() passes on to `instrument`.
+    parser.add_argument("--metrics", default=None,
+                        help="Append the metrics of the run (as a json line) to this file instead of printing them"
+                             " to stderr.")
+    parser.add_argument("--profile", default=None,
+                        help="Write cProfile and tracemalloc snapshots of the run to this directory.")
+
+
+def peak_rss_bytes() -> int:
+    # VmHWM is the peak RSS of this process only (ru_maxrss survives exec on Linux, so a spawned process would report
+    # its parent's peak).
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def reset_peak_rss():
+    # Reset VmHWM to the current RSS, so the next peak measured only covers what follows (Linux only).
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+@contextmanager
+def instrument(stage: str, metrics_file=None, profile_dir=None):
+    """
+Measure a stage: wall time, CPU time (of this process and of its finished child processes), peak RSS and the
+counters added with `count` while it runs. The metrics are emitted as one json object when the stage ends, even if it
+fails.
+    :param stage: The name of the stage (usually the script's name).
+    :param metrics_file: Append the metrics to this file (one json object per line). Default is to print them to stderr.
+    :param profile_dir: If given, profile the stage with cProfile and tracemalloc and write the snapshots (.prof and
+    .tracemalloc files, plus a text summary of the hottest functions and allocations) to this directory.
+    :return: The StageMetrics of the stage, to add counters to directly.
+    """
+    metrics = StageMetrics(stage)
+    _active_stages.append(metrics)
+
+    profiler = None
+    if profile_dir is not None:
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    status = 'ok'
+    started_at = time.time()
+    wall_start, cpu_start, children_start = time.perf_counter(), time.process_time(), os.times()
+    try:
+        yield metrics
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        wall_seconds, cpu_seconds = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        children_end = os.times()
+        _active_stages.remove(metrics)
+
+        if profiler is not None:
+            profiler.disable()
+            metrics.counters['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            write_profile(stage, profiler, tracemalloc.take_snapshot(), Path(profile_dir))
+            tracemalloc.stop()
+
+        emit_metrics({
+            'stage': stage,
+            'status': status,
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started_at)),
+            'wall_seconds': round(wall_seconds, 4),
+            'cpu_seconds': round(cpu_seconds, 4),
+            'children_cpu_seconds': round(max(0.0, children_end.children_user + children_end.children_system
+                                              - children_start.children_user - children_start.children_system), 4),
+            'peak_rss_mb': round(peak_rss_bytes() / 2 ** 20, 1),
+            **{name: round(value, 4) if isinstance(value, float) else value
+               for name, value in sorted(metrics.counters.items())}
+        }, metrics_file)
+
+
+def emit_metrics(record: dict, metrics_file=None):
+    line = json.dumps(record)
+    if metrics_file is None:
+        print(line, file=sys.stderr)
+        return
+    with open(metrics_file, 'a', encoding='utf-8') as file:
+        file.write(line + '\n')
+
+
+def write_profile(stage: str, profiler: cProfile.Profile, snapshot: tracemalloc.Snapshot, profile_dir: Path):
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    name = f"{stage}_{time.strftime('%Y%m%d_%H%M%S')}"
+    profiler.dump_stats(profile_dir / f'{name}.prof')
+    snapshot.dump(str(profile_dir / f'{name}.tracemalloc'))
+
+    # A readable summary of the hot functions (by cumulative time) and the lines that allocated the most memory.
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_TOP_ENTRIES)
+    summary.write(f"Top {PROFILE_TOP_ENTRIES} allocations still held at the end of '{stage}':\n")
+    for statistic in snapshot.statistics('lineno')[:PROFILE_TOP_ENTRIES]:
+        summary.write(f"{statistic}\n")
+    with open(profile_dir / f'{name}.txt', 'w', encoding='utf-8') as file:
+        file.write(summary.getvalue())
+    print(f"instrumentation: Profile of '{stage}' saved to '{profile_dir / name}.*'.", file=sys.stderr)
@@ -0,0 +1,169 @@
+import argparse
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import pandas as pd
+import instrumentation
+from article_store import batch_articles, read_articles
+from json_to_csv import ARTICLE_FIELDS, SOURCE_FIELDS, articles_to_csv
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+ROW_GROUP_SIZE = 10000
+COLUMNAR_SUFFIXES = ('.parquet', '.arrow')
+CSV_CHUNK_SIZE = 50000
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("json_to_columnar: pyarrow is required for Parquet/Arrow files (pip install pyarrow).")
+
+
+def article_schema(flatten_source=True) -> 'pa.Schema':
+    # The fields of a NewsAPI article (json_to_csv.ARTICLE_FIELDS), all stored as (nullable) strings.
+    require_pyarrow()
+    article_fields = [pa.field(name, pa.string()) for name in ARTICLE_FIELDS]
+    if flatten_source:
+        # Same columns, in the same order, as pd.json_normalize.
+        return pa.schema(article_fields + [pa.field(f'source.{name}', pa.string()) for name in SOURCE_FIELDS])
+
+    source_field = pa.field('source', pa.struct([pa.field(name, pa.string()) for name in SOURCE_FIELDS]))
+    return pa.schema([source_field] + article_fields)
+
+
+def articles_to_record_batch(articles: list[dict], schema: 'pa.Schema', flatten_source=True) -> 'pa.RecordBatch':
+    columns = {}
+    if flatten_source:
+        for name in SOURCE_FIELDS:
+            columns[f'source.{name}'] = [(a.get('source') or {}).get(name) for a in articles]
+    else:
+        columns['source'] = [{name: (a.get('source') or {}).get(name) for name in SOURCE_FIELDS} for a in articles]
+    for name in ARTICLE_FIELDS:
+        columns[name] = [a.get(name) for a in articles]
+    return pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
+def articles_to_columnar(articles: Iterable[dict], output_file, flatten_source=True,
+                         row_group_size=ROW_GROUP_SIZE) -> int:
+    """
+Write articles to a Parquet (.parquet) or Arrow IPC (.arrow) file, one row group / record batch of `row_group_size`
+articles at a time, so only one batch of articles is held in memory.
+    :param articles: The articles to write (e.g. the generator returned by `read_articles`).
+    :param output_file: The path to the output file. Its suffix selects the format.
+    :param flatten_source: Store the article source as 'source.id' / 'source.name' columns instead of a struct column.
+    :param row_group_size: The number of articles per row group / record batch.
+    :return: The number of articles written.
+    """
+    output_file = Path(output_file)
+    schema = article_schema(flatten_source)
+    if output_file.suffix == '.parquet':
+        writer = pq.ParquetWriter(output_file, schema)
+    elif output_file.suffix == '.arrow':
+        writer = pa.ipc.new_file(output_file, schema)
+    else:
+        raise ValueError(f"json_to_columnar: Unsupported output format '{output_file.suffix}'.")
+
+    count = 0
+    with writer:
+        for batch in batch_articles(articles, row_group_size):
+            record_batch = articles_to_record_batch(batch, schema, flatten_source)
+            if output_file.suffix == '.parquet':
+                writer.write_batch(record_batch, row_group_size=row_group_size)
+            else:
+                writer.write_batch(record_batch)
+            count += len(batch)
+    return count
+
+
+def read_columnar(filepath, columns: list[str] = None) -> pd.DataFrame:
+    """
+Load only the given columns of a Parquet or Arrow IPC file. Both are memory mapped, so Arrow IPC columns are read
+without copies.
+    """
+    require_pyarrow()
+    filepath = Path(filepath)
+    if filepath.suffix == '.parquet':
+        table = pq.read_table(filepath, columns=columns, memory_map=True)
+    else:
+        with pa.memory_map(str(filepath), 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+            if columns is not None:
+                table = table.select(columns)
+    return table.to_pandas()
+
+
+def read_table_chunks(filepath, columns: list[str] = None, chunksize=CSV_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+Iterate over a table of articles in chunks of rows, loading only the given columns. The file can be a csv file, or a
+Parquet / Arrow IPC file (which is memory mapped).
+Rows are labelled with their position in the whole file, like with pd.read_csv(chunksize=...).
+    """
+    filepath = Path(filepath)
+    if filepath.suffix not in COLUMNAR_SUFFIXES:
+        for chunk in pd.read_csv(filepath, encoding='utf-8', usecols=columns, chunksize=chunksize):
+            instrumentation.count('rows', len(chunk))
+            yield chunk
+        return
+
+    require_pyarrow()
+    start = 0
+    if filepath.suffix == '.parquet':
+        batches = pq.ParquetFile(filepath, memory_map=True).iter_batches(batch_size=chunksize, columns=columns)
+        for batch in batches:
+            chunk = batch.to_pandas()
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            instrumentation.count('rows', len(chunk))
+            yield chunk
+        return
+
+    with pa.memory_map(str(filepath), 'r') as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            chunk = (batch.select(columns) if columns is not None else batch).to_pandas()
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            instrumentation.count('rows', len(chunk))
+            yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Converts a json or jsonl article file into a columnar Parquet or Arrow IPC file, streaming the"
+                    " articles one at a time.\n\n"
+                    "Example usage:\npython -m json_to_columnar -f ../data/articles/Killers_articles.jsonl --csv",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-f", "--file", required=True, help="The json or jsonl file containing the articles.")
+    parser.add_argument("-o", "--output", default=None,
+                        help="The path to the output file. Default is the input file with the format's suffix.")
+    parser.add_argument("--format", choices=['parquet', 'arrow'], default='parquet',
+                        help="The columnar format to write, when no output path is given. Default is 'parquet'.")
+    parser.add_argument("--nested-source", action='store_true',
+                        help="Keep the article source as a struct column instead of 'source.id' and 'source.name'.")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE,
+                        help=f"The number of articles per row group / record batch. Default is {ROW_GROUP_SIZE}.")
+    parser.add_argument("--csv", action='store_true',
+                        help="Also write a csv file next to the output file.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.instrument('json_to_columnar', args.metrics, args.profile):
+        output_file = Path(args.output) if args.output else Path(args.file).with_suffix(f'.{args.format}')
+        count = articles_to_columnar(read_articles(args.file), output_file, flatten_source=not args.nested_source,
+                                     row_group_size=args.row_group_size)
+        print(f"json_to_columnar: Saved {count} articles to '{output_file}'.")
+
+        if args.csv:
+            csv_file = output_file.with_suffix('.csv')
+            articles_to_csv(read_articles(args.file), csv_file)
+            print(f"json_to_columnar: Saved {count} articles to '{csv_file}'.")
+
+
+if __name__ == '__main__':
+    main()
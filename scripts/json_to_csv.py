@@ -1,18 +1,65 @@
-import pandas as pd
-import argparse
-import json
-
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--file", required=True, help='json file with data')
-    args = parser.parse_args()
-    filename = args.file
-    with open(filename, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    df = pd.json_normalize(data)
-    filename = ".."+filename.strip(".json")
-    # Save DataFrame to CSV file
-    df.to_csv(filename + '.csv', index=False)
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
+import pandas as pd
+import argparse
+from pathlib import Path
+from typing import Iterable
+import instrumentation
+from article_store import batch_articles, read_articles
+
+BATCH_SIZE = 10000
+
+# The fields of a NewsAPI article (also the schema of json_to_columnar), and the columns pd.json_normalize flattens
+# them to.
+SOURCE_FIELDS = ['id', 'name']
+ARTICLE_FIELDS = ['author', 'title', 'description', 'url', 'urlToImage', 'publishedAt', 'content']
+ARTICLE_COLUMNS = ARTICLE_FIELDS + [f'source.{name}' for name in SOURCE_FIELDS]
+
+
+def articles_to_csv(articles: Iterable[dict], output_file, batch_size=BATCH_SIZE,
+                    columns: list[str] = None) -> int:
+    """
+Flatten and write articles (or table rows) to a csv file in batches, so only one batch is held in memory at a time.
+The columns are all the fields of all the articles: when a batch has fields the earlier ones did not, the rows
+written so far are rewritten with the new columns (empty for them), which only happens once per new field.
+    :param columns: The first columns, in this order. Default is the columns of the first batch, or ARTICLE_COLUMNS
+    if there are no articles, so the file always has a header.
+    :return: The number of articles written.
+    """
+    output_file = Path(output_file)
+    columns = list(columns or [])
+    count = 0
+    for batch in batch_articles(articles, batch_size):
+        df = pd.json_normalize(batch)
+        known_columns = set(columns)
+        new_columns = [column for column in df.columns if column not in known_columns]
+        if new_columns and count:
+            add_csv_columns(output_file, columns + new_columns)
+        columns += new_columns
+        df.reindex(columns=columns).to_csv(output_file, mode='a' if count else 'w', header=not count, index=False)
+        count += len(df)
+
+    if count == 0:
+        pd.DataFrame(columns=columns or ARTICLE_COLUMNS).to_csv(output_file, index=False)
+    return count
+
+
+def add_csv_columns(csv_file: Path, columns: list[str], chunk_size=BATCH_SIZE):
+    # Rewrite a csv file with more (empty) columns, a chunk at a time, then replace it.
+    tmp_file = csv_file.with_name(csv_file.name + '.tmp')
+    chunks = pd.read_csv(csv_file, dtype=str, keep_default_na=False, chunksize=chunk_size)
+    for i, chunk in enumerate(chunks):
+        chunk.reindex(columns=columns).to_csv(tmp_file, mode='a' if i else 'w', header=not i, index=False)
+    tmp_file.replace(csv_file)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", required=True, help='json or jsonl file with data')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    with instrumentation.instrument('json_to_csv', args.metrics, args.profile):
+        filename = args.file
+        # Save articles to a CSV file next to the input file
+        output_file = Path(filename).with_suffix('.csv')
+        articles_to_csv(read_articles(filename), output_file)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import argparse
+import json
+import re
+from collections import deque
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+
+import pandas as pd
+import instrumentation
+from article_store import append_articles, batch_articles, read_articles, write_articles
+
+ARTICLE_FIELDS = ('title', 'description', 'content')
+BATCH_SIZE = 10000
+REPORT_FILE = 'routing_report.csv'
+REPORT_COLUMNS = ['url', 'title', 'sets', 'ambiguous', 'matches']
+
+# Words, with inner apostrophes kept (so "Freddy's" is one word), like NewsAPI matches them.
+WORD_PATTERN = re.compile(r"\w+(?:['’]\w+)*")
+
+
+class KeywordMatch(NamedTuple):
+    set_name: str
+    keyword: str
+    start: int
+    end: int
+
+
+def normalize_word(word: str) -> str:
+    return word.lower().replace('’', "'")
+
+
+class KeywordMatcher:
+    """
+Aho-Corasick automaton over the words of every keyword of every keyword set, so a text is scanned once whatever the
+number of keywords. Matching works on whole words and ignores case and punctuation, so "Taylor Swift: The Eras Tour"
+matches "taylor swift - the eras tour", but "Moon" does not match "Moonlight". The last word of a keyword also
+matches its possessive, so "Barbie's opening" matches "Barbie".
+    """
+
+    def __init__(self, keyword_sets: dict[str, list[str]]):
+        self.patterns: list[tuple[str, str, int]] = []
+        self.goto: list[dict[str, int]] = [{}]
+        self.outputs: list[list[int]] = [[]]
+
+        for set_name, keywords in keyword_sets.items():
+            for keyword in keywords:
+                words = [normalize_word(word) for word in WORD_PATTERN.findall(keyword)]
+                if not words:
+                    continue
+                state = 0
+                for word in words:
+                    if word not in self.goto[state]:
+                        self.goto[state][word] = len(self.goto)
+                        self.goto.append({})
+                        self.outputs.append([])
+                    state = self.goto[state][word]
+                self.outputs[state].append(len(self.patterns))
+                self.patterns.append((set_name, keyword, len(words)))
+
+        # Breadth-first, so the failure state of every state is computed before the states below it.
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(word, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+        self.words = set(word for transitions in self.goto for word in transitions)
+
+    @classmethod
+    def from_file(cls, keywords_file) -> 'KeywordMatcher':
+        # keyword_sets.json holds a list of {set name: [keywords]} dictionaries.
+        with open(keywords_file, 'r', encoding='utf-8') as file:
+            keyword_sets = json.load(file)
+        return cls({name: keywords for keyword_set in keyword_sets for name, keywords in keyword_set.items()})
+
+    def find(self, text: str) -> Iterator[KeywordMatch]:
+        """
+Find every occurrence of every keyword in a text, including overlapping ones.
+        :return: The matches, with the character span of each occurrence in the text.
+        """
+        goto, fail, outputs, words = self.goto, self.fail, self.outputs, self.words
+        # Normalize the whole text at once, unless lower-casing changes its length (then the spans would be off).
+        normalized_text = normalize_word(text)
+        per_word = len(normalized_text) != len(text)
+        state = 0
+        word_starts = []
+        for match in WORD_PATTERN.finditer(text if per_word else normalized_text):
+            word = normalize_word(match.group()) if per_word else match.group()
+            word_starts.append(match.start())
+            if word.endswith("'s") and word[:-2] in words:
+                # A possessive ends the keywords ending with the word it is made from (no keyword goes on past it).
+                possessive_state = state
+                while possessive_state and word[:-2] not in goto[possessive_state]:
+                    possessive_state = fail[possessive_state]
+                for pattern in outputs[goto[possessive_state].get(word[:-2], 0)]:
+                    set_name, keyword, length = self.patterns[pattern]
+                    yield KeywordMatch(set_name, keyword, word_starts[-length], match.end() - 2)
+            if word not in words:
+                # No keyword contains this word, so no partial match can continue through it.
+                state = 0
+                continue
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+            for pattern in outputs[state]:
+                set_name, keyword, length = self.patterns[pattern]
+                yield KeywordMatch(set_name, keyword, word_starts[-length], match.end())
+
+    def match_article(self, article: dict, fields=ARTICLE_FIELDS) -> dict[str, list[tuple[str, int, int, str]]]:
+        """
+Scan the given fields of an article once.
+        :return: The (field, start, end, keyword) matches of the article, by keyword set. An article matching more
+        than one keyword set is ambiguous.
+        """
+        matches_by_set = {}
+        for field in fields:
+            text = article.get(field)
+            if not text:
+                continue
+            for match in self.find(text):
+                matches_by_set.setdefault(match.set_name, []).append((field, match.start, match.end, match.keyword))
+        return matches_by_set
+
+
+def route_batch(articles: list[dict], matcher: KeywordMatcher, fields=ARTICLE_FIELDS) -> tuple[dict, list[dict]]:
+    """
+Match a batch of articles against every keyword set.
+    :return: The articles of every set they match (the ones matching no set under 'unmatched'), and the report row
+    of every article: the sets it matches, whether it is ambiguous and its (field, start, end, keyword) matches.
+    """
+    routed = {}
+    report = []
+    for article in articles:
+        matches_by_set = matcher.match_article(article, fields)
+        for set_name in matches_by_set or ['unmatched']:
+            routed.setdefault(set_name, []).append(article)
+        report.append({
+            'url': article.get('url'),
+            'title': article.get('title'),
+            'sets': ';'.join(matches_by_set),
+            'ambiguous': len(matches_by_set) > 1,
+            'matches': json.dumps({set_name: [list(m) for m in matches]
+                                   for set_name, matches in matches_by_set.items()}, ensure_ascii=False)
+        })
+    return routed, report
+
+
+def write_report(report: list[dict], report_file, append=False):
+    # The header is only written when the report is started.
+    pd.DataFrame(report, columns=REPORT_COLUMNS).to_csv(report_file, mode='a' if append else 'w', header=not append,
+                                                        index=False)
+
+
+def route_articles(articles: Iterable[dict], matcher: KeywordMatcher, output_dir, fields=ARTICLE_FIELDS) -> dict:
+    """
+Split articles into one article store per keyword set (an article goes to every set it matches), plus
+'unmatched_articles.jsonl', and write a 'routing_report.csv' with the matches of every article and whether it is
+ambiguous.
+    :return: The number of articles routed to each set (and to 'unmatched'), and the number of ambiguous articles.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    set_names = list(dict.fromkeys(set_name for set_name, _, _ in matcher.patterns))
+    store_files = {set_name: output_dir / f'{set_name}_articles.jsonl' for set_name in set_names + ['unmatched']}
+    for store_file in store_files.values():
+        write_articles(store_file, [])
+
+    counts = {set_name: 0 for set_name in store_files}
+    counts['ambiguous'] = 0
+    report_file = output_dir / REPORT_FILE
+    append = False
+    for batch in batch_articles(articles, BATCH_SIZE):
+        routed, report = route_batch(batch, matcher, fields)
+        for set_name, set_articles in routed.items():
+            counts[set_name] += append_articles(store_files[set_name], set_articles)
+        counts['ambiguous'] += sum(row['ambiguous'] for row in report)
+        write_report(report, report_file, append)
+        append = True
+        instrumentation.count('rows', len(batch))
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Routes collected articles to keyword sets locally: every article's title, description and"
+                    " content are scanned once for all the keywords, and the article is saved in the store of every"
+                    " set it matches. Articles matching several sets are flagged as ambiguous in the report.\n\n"
+                    "Example usage:\npython -m keyword_matcher -f ../data/articles/broad_articles.jsonl"
+                    " -k keyword_sets.json -o ../data/routed",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-f", "--file", required=True, help="The json or jsonl file containing the articles.")
+    parser.add_argument("-k", "--keyword-sets", required=True,
+                        help="The JSON file containing the sets of keywords or phrases to match.")
+    parser.add_argument("-o", "--output-dir", required=True, help="The directory to write the routed stores to.")
+    parser.add_argument("-t", "--title-only", action='store_true', help="Only match the keywords in the title.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.instrument('keyword_matcher', args.metrics, args.profile):
+        matcher = KeywordMatcher.from_file(args.keyword_sets)
+        counts = route_articles(read_articles(args.file), matcher, args.output_dir,
+                                fields=('title',) if args.title_only else ARTICLE_FIELDS)
+        print(f"keyword_matcher: Routed articles to '{args.output_dir}': {json.dumps(counts, ensure_ascii=False)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import re
+import zlib
+
+import numpy as np
+
+NUM_PERM = 64
+SHINGLE_SIZE = 2
+DEFAULT_THRESHOLD = 0.8
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def shingles(text: str, shingle_size=SHINGLE_SIZE) -> set[str]:
+    words = _WORD_PATTERN.findall(text.lower())
+    if len(words) < shingle_size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)}
+
+
+def lsh_bands(num_perm: int, threshold: float) -> tuple[int, int]:
+    # Pick the (bands, rows) split whose S-curve midpoint (1/b)^(1/r) is closest to the threshold.
+    splits = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold))
+
+
+class NearDuplicateIndex:
+    """
+MinHash signatures of word shingles, indexed with locality-sensitive hashing (banding). Each new text is only compared
+with the texts that share at least one band bucket with it, so finding near-duplicates stays sub-quadratic.
+Only the texts that were not duplicates are indexed, so every duplicate points to the first text of its cluster.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+        self.buckets: list[dict[bytes, list]] = [{} for _ in range(self.bands)]
+        self.signatures: dict = {}
+
+    def signature(self, text: str) -> np.ndarray:
+        text_shingles = shingles(text, self.shingle_size)
+        if not text_shingles:
+            return np.full(len(self.a), _MAX_HASH, dtype=np.uint64)
+
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in text_shingles), dtype=np.uint64,
+                             count=len(text_shingles))
+        permuted = (np.outer(self.a, hashes) + self.b[:, None]) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=1)
+
+    def add(self, item_id, text: str) -> tuple | None:
+        """
+Look up a text and index it if it is not a near-duplicate of an indexed text.
+        :param item_id: The identifier of the text (e.g. its row number).
+        :param text: The text to look up.
+        :return: (id of the text it duplicates, estimated similarity) or None if it is not a duplicate.
+        """
+        signature = self.signature(text)
+        band_keys = [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+        best_match = None
+        checked = set()
+        for band, key in enumerate(band_keys):
+            for candidate_id in self.buckets[band].get(key, ()):
+                if candidate_id in checked:
+                    continue
+                checked.add(candidate_id)
+                similarity = float(np.mean(self.signatures[candidate_id] == signature))
+                if similarity >= self.threshold and (best_match is None or similarity > best_match[1]):
+                    best_match = (candidate_id, similarity)
+
+        if best_match is not None:
+            return best_match
+
+        self.signatures[item_id] = signature
+        for band, key in enumerate(band_keys):
+            self.buckets[band].setdefault(key, []).append(item_id)
+        return None
@@ -1,10 +1,265 @@
+import email.utils
+import hashlib
+import json
+import os
+import random
+import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
+import instrumentation
 
+NEWSAPI_URL = 'https://newsapi.org'
+PAGE_SIZE = 100  # max allowed by NewsAPI
+MAX_WORKERS = 4
 
-def fetch_news(api_key: str, start_date: datetime.date, end_date: datetime.date, keywords: list, language='en', search_title_only=False):
+CACHE_DIR = Path(__file__).parent.parent / 'data' / 'cache' / 'newsapi'
+CACHE_TTL_SECONDS = 60 * 60
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CHECKPOINT_DIR = Path(__file__).parent.parent / 'data' / 'checkpoints' / 'newsapi'
+
+REQUEST_TIMEOUT_SECONDS = 30
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+
+# Request quota of the NewsAPI plan in use (the free developer plan allows 100 requests per day).
+QUOTA_REQUESTS = 100
+QUOTA_PERIOD_SECONDS = 24 * 60 * 60
+
+
+class RateLimiter:
+    """
+Thread-safe token bucket. Holds up to `capacity` tokens and refills at `requests` tokens per `period` seconds.
+    """
+
+    def __init__(self, requests: int, period: float, capacity: int = None):
+        self.rate = requests / period
+        self.capacity = capacity if capacity is not None else requests
+        self.tokens = float(self.capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+Block until a token is available, then consume it.
+        :return: The number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+
+default_rate_limiter = RateLimiter(QUOTA_REQUESTS, QUOTA_PERIOD_SECONDS)
+
+
+class NewsAPIError(Exception):
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"NewsAPI responded with status {status_code}")
+        self.status_code = status_code
+        self.text = text
+
+
+def normalize_params(params: dict) -> dict[str, str]:
+    normalized = {k: str(v).strip() for k, v in params.items() if k != 'apiKey' and v is not None}
+    normalized.setdefault('page', '1')
+    return dict(sorted(normalized.items()))
+
+
+def request_key(endpoint: str, params: dict) -> str:
+    # Identifies a request independently of the api key used and of the order of its parameters.
+    key_source = json.dumps([endpoint, normalize_params(params)], ensure_ascii=False)
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+On-disk cache of successful NewsAPI responses, one json file per request. Entries are keyed by the endpoint and the
+normalized request parameters (without the api key), and the least recently used entries are evicted once the
+cache grows over `max_bytes`.
+Responses for a date window that closed before today cannot change, so they are kept without expiry; any other
+response expires after `ttl` seconds.
+    """
+
+    def __init__(self, directory: Path = CACHE_DIR, ttl: float = CACHE_TTL_SECONDS, max_bytes: int = CACHE_MAX_BYTES,
+                 refresh=False):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.refresh = refresh  # If set, entries are never read but still written.
+        self.lock = threading.Lock()
+        self._entry_sizes = None
+
+    def key(self, endpoint: str, params: dict) -> str:
+        return request_key(endpoint, params)
+
+    def expires_at(self, params: dict) -> float | None:
+        to_date = params.get('to')
+        if to_date is not None:
+            to_date = datetime.strptime(str(to_date)[:10], '%Y-%m-%d').date()
+            if to_date < datetime.today().date():
+                return None
+        return time.time() + self.ttl
+
+    def get(self, endpoint: str, params: dict) -> dict | None:
+        if self.refresh:
+            return None
+
+        path = self.directory / f'{self.key(endpoint, params)}.json'
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if entry['expires_at'] is not None and entry['expires_at'] < time.time():
+            return None
+
+        # The modification time records when the entry was last used, for LRU eviction.
+        os.utime(path)
+        return entry['response']
+
+    def put(self, endpoint: str, params: dict, response: dict):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f'{self.key(endpoint, params)}.json'
+        entry = {
+            'endpoint': endpoint,
+            'params': normalize_params(params),
+            'expires_at': self.expires_at(params),
+            'response': response
+        }
+
+        tmp_path = path.with_name(f'{path.name}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(entry, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            entry_sizes = self._load_entry_sizes()
+            entry_sizes[path] = path.stat().st_size
+            self._evict(entry_sizes)
+
+    def _load_entry_sizes(self) -> dict[Path, int]:
+        if self._entry_sizes is None:
+            self._entry_sizes = {p: p.stat().st_size for p in self.directory.glob('*.json')}
+        return self._entry_sizes
+
+    def _evict(self, entry_sizes: dict[Path, int]):
+        total_bytes = sum(entry_sizes.values())
+        if total_bytes <= self.max_bytes:
+            return
+
+        def last_used(path):
+            try:
+                return path.stat().st_mtime
+            except OSError:
+                return 0
+
+        for path in sorted(entry_sizes, key=last_used):
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= entry_sizes.pop(path)
+            path.unlink(missing_ok=True)
+
+
+response_cache = ResponseCache()
+
+
+def configure_cache(no_cache=False, refresh=False):
+    """
+Apply the --no-cache / --refresh command line options to the module's response cache.
+    :param no_cache: Neither read nor write cached responses.
+    :param refresh: Ignore cached responses, but store the new ones.
+    """
+    global response_cache
+    if no_cache:
+        response_cache = None
+    elif response_cache is not None:
+        response_cache.refresh = refresh
+
+class Checkpoint:
+    """
+On-disk progress of one paged query: the number of articles to get, and the response of every page fetched so far
+(one json file per page). A checkpoint is removed once all of its pages have been fetched.
+    """
+
+    def __init__(self, endpoint: str, params: dict, directory: Path = CHECKPOINT_DIR):
+        query_params = {k: v for k, v in params.items() if k != 'page'}
+        self.directory = Path(directory) / request_key(endpoint, query_params)
+
+    def exists(self) -> bool:
+        return (self.directory / 'meta.json').exists()
+
+    def load_total_to_get(self) -> int | None:
+        try:
+            with open(self.directory / 'meta.json', 'r', encoding='utf-8') as file:
+                return json.load(file)['total_to_get']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save_total_to_get(self, total_to_get: int):
+        self._write_json('meta.json', {'total_to_get': total_to_get})
+
+    def load_page(self, page: int) -> dict | None:
+        try:
+            with open(self.directory / f'page_{page}.json', 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def save_page(self, page: int, news_data: dict):
+        self._write_json(f'page_{page}.json', news_data)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write_json(self, filename: str, data):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / filename
+        tmp_path = path.with_name(f'{filename}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+_session = None
+_session_pool_size = 0
+
+
+def get_session(pool_size=MAX_WORKERS) -> requests.Session:
+    """
+Get the session shared by all the fetching threads, so connections to the api are pooled and reused.
+    :param pool_size: The number of connections the pool should be able to keep open at the same time.
+    """
+    global _session, _session_pool_size
+    if _session is None:
+        _session = requests.Session()
+
+    if pool_size > _session_pool_size:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+        _session_pool_size = pool_size
+
+    return _session
+
+
+def fetch_news(api_key: str, start_date: datetime.date, end_date: datetime.date, keywords: list, language='en', search_title_only=False, max_articles=None, published_after: str = None, published_before: str = None, resume=False, query_info: dict = None):
     """
 Fetch news articles from the NewsAPI 'everything' endpoint, with the request parameters specified.
     :param api_key: The api key to use for the NewsAPI request.
@@ -13,6 +268,11 @@ Fetch news articles from the NewsAPI 'everything' endpoint, with the request par
     :param keywords: The list of keywords or phrases to search for in the article title and body.
     :param language: The language of the news.
     :param search_title_only: Only search for the keywords in the article title.
+    :param max_articles: The maximum number of articles to fetch. If None, the user is asked.
+    :param published_after: An ISO 8601 timestamp to search from instead of the start of start_date.
+    :param published_before: An ISO 8601 timestamp to search up to instead of the end of end_date.
+    :param resume: Continue from the checkpoint of a previous, unfinished run of the same query.
+    :param query_info: See `get_news`.
     :return: The list of articles obtained from the request.
     """
     if len(keywords) < 1:
@@ -36,16 +296,24 @@ Fetch news articles from the NewsAPI 'everything' endpoint, with the request par
     if search_title_only:
         params['searchIn'] = 'title'
 
-    return get_news(api_key, '/v2/everything', params)
+    if published_after is not None:
+        params['from'] = published_after
 
+    if published_before is not None:
+        params['to'] = published_before
 
-def fetch_top_headlines(api_key: str, country: str, category: str, keywords=None):
+    return get_news(api_key, '/v2/everything', params, max_articles=max_articles, resume=resume,
+                    query_info=query_info)
+
+
+def fetch_top_headlines(api_key: str, country: str, category: str, keywords=None, max_articles=None):
     """
 Fetch current trending news articles using the NewsAPI 'top-headlines' endpoint, with the request parameters specified.
     :param api_key: The api key to use for the NewsAPI request.
     :param country: The 2-letter ISO 3166-1 code of the country you want to get headlines for.
     :param category: The category you want to get headlines for.
     :param keywords: The list of keywords or phrases to search for in the article title and body.
+    :param max_articles: The maximum number of articles to fetch. If None, the user is asked.
     :return: The list of articles obtained from the request.
     """
     if len(country) != 2:
@@ -62,55 +330,196 @@ Fetch current trending news articles using the NewsAPI 'top-headlines' endpoint,
         if len(keywords) < 1:
             raise ValueError("newsapi: `keywords` must include at least 1 keyword.")
 
-        params['q'] = ' OR '.join(keywords),  # Combine multiple keywords with 'OR' for a broader search
+        params['q'] = ' OR '.join(keywords)  # Combine multiple keywords with 'OR' for a broader search
+
+    return get_news(api_key, '/v2/top-headlines', params, max_articles=max_articles)
+
 
-    return get_news(api_key, '/v2/top-headlines', params)
+def get_news(api_key: str, endpoint: str, params, max_articles=None, rate_limiter: RateLimiter = None,
+             max_workers=MAX_WORKERS, base_url=None, cache: ResponseCache = None, resume=False,
+             query_info: dict = None, checkpoint_dir: Path = CHECKPOINT_DIR) -> list | None:
+    """
+Fetch all the pages of a NewsAPI query. The first page is fetched to find the total number of results, then the
+remaining pages are fetched concurrently, with every request going through the rate limiter.
+Every fetched page is checkpointed to disk. If some pages still fail after retrying, nothing is returned, and the
+query can be continued later from the checkpoint with `resume`.
+    :param api_key: The api key to use for the NewsAPI request.
+    :param endpoint: The NewsAPI endpoint, e.g. '/v2/everything' or '/v2/top-headlines'.
+    :param params: The query parameters of the request (not modified).
+    :param max_articles: The maximum number of articles to fetch. If None, the user is asked.
+    :param rate_limiter: The rate limiter to share between requests. Defaults to the plan's quota.
+    :param max_workers: The maximum number of pages to fetch at the same time.
+    :param base_url: The NewsAPI server to send the requests to. Defaults to NEWSAPI_URL.
+    :param cache: The response cache to use. Defaults to the module's response cache (if enabled).
+    :param resume: Continue from the checkpoint of a previous, unfinished run of the same query.
+    :param query_info: If given, this dictionary is updated with the number of results of the query ('total_results')
+    and the number of articles requested ('total_to_get'), e.g. to know if the articles returned are all the results.
+    :param checkpoint_dir: The directory to checkpoint the pages to. Defaults to 'data/checkpoints/newsapi'.
+    :return: The list of articles obtained from the request.
+    """
+    params = dict(params, apiKey=api_key)
+    params.setdefault('pageSize', PAGE_SIZE)
+    rate_limiter = rate_limiter or default_rate_limiter
+    cache = cache or response_cache
 
+    checkpoint = Checkpoint(endpoint, params, checkpoint_dir)
+    if not resume:
+        checkpoint.clear()
+    elif not checkpoint.exists():
+        # The checkpoint is keyed by all the query parameters, so e.g. an end date defaulting to today does not match
+        # the one of a run interrupted on a previous day.
+        print(f"newsapi: No checkpoint found for this query, so it starts over. Use the same parameters (including"
+              f" the dates: from={params.get('from')}, to={params.get('to')}) as the interrupted run to resume it.")
 
-def get_news(api_key: str, endpoint: str, params) -> list | None:
-    params['apiKey'] = api_key
+    def request_page(page: int) -> dict:
+        news_data = checkpoint.load_page(page) if resume else None
+        if news_data is None:
+            news_data = get_page(base_url or NEWSAPI_URL, endpoint, params, page, rate_limiter, cache)
+            checkpoint.save_page(page, news_data)
+        return news_data
 
     try:
-        response = requests.get(f'https://newsapi.org{endpoint}', params=params)
+        try:
+            news_data = request_page(1)
+        except NewsAPIError as e:
+            print(f"newsapi: Failed to fetch news:\n{e.text}")
+            return None
 
-        if response.status_code == 200:
-            news_data = response.json()
-            articles = news_data.get('articles', [])
+        articles = news_data.get('articles', [])
 
-            total_results = news_data.get('totalResults')
-            print(f"newsapi: Found {total_results} articles matching your query.")
-            if total_results < 1:
-                return None
+        total_results = news_data.get('totalResults')
+        print(f"newsapi: Found {total_results} articles matching your query.")
+        if query_info is not None:
+            query_info.update(total_results=total_results, total_to_get=0)
+        if total_results < 1:
+            checkpoint.clear()
+            return None
 
+        total_to_get = checkpoint.load_total_to_get() if resume else None
+        if total_to_get is not None:
+            print(f"newsapi: Resuming the query from its checkpoint ({total_to_get} articles to get).")
+        elif max_articles is None:
             total_to_get = get_article_count_from_user(total_results)
-            pages_to_get = (total_to_get // 100) + 1
-
-            print(f"newsapi: Pages to fetch for this query: {pages_to_get}")
-            for i in range(2, pages_to_get + 1):
-                params['page'] = i
-                print(f"newsapi: fetching page {i} in 10 seconds (delay is too avoid getting rate limited by the api).")
-                time.sleep(10)
-                response = requests.get('https://newsapi.org/v2/everything', params=params)
-                if response.status_code == 200:
-                    news_data = response.json()
-                    articles.extend(news_data.get('articles', []))
-                else:
-                    print("newsapi: Failed to fetch additional pages of the request."
-                          " Only the first 100 articles were saved.")
-                    print(f"Error message:\n{response.text}")
-
-            print("newsapi: Number of articles fetched: ", len(articles))
-            filtered_articles = [a for a in articles if a['title'] != "[Removed]"]
-
-            return filtered_articles
         else:
-            print(f"newsapi: Failed to fetch news:\n{response.text}")
+            total_to_get = min(max_articles, total_results)
+        checkpoint.save_total_to_get(total_to_get)
+        if query_info is not None:
+            query_info['total_to_get'] = total_to_get
+
+        page_size = params['pageSize']
+        pages_to_get = -(-total_to_get // page_size)
+
+        print(f"newsapi: Pages to fetch for this query: {pages_to_get}")
+        failed_pages = []
+        if pages_to_get > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for page, page_articles in zip(range(2, pages_to_get + 1),
+                                               executor.map(lambda page: get_page_articles(request_page, page),
+                                                            range(2, pages_to_get + 1))):
+                    if page_articles is None:
+                        failed_pages.append(page)
+                    else:
+                        articles.extend(page_articles)
+
+        if failed_pages:
+            print(f"newsapi: {len(failed_pages)} of {pages_to_get} pages could not be fetched: {failed_pages}."
+                  f" The other pages were checkpointed, run again with --resume to fetch the rest.")
             return None
+
+        checkpoint.clear()
+        articles = articles[:total_to_get]
+        print("newsapi: Number of articles fetched: ", len(articles))
+        filtered_articles = [a for a in articles if a['title'] != "[Removed]"]
+
+        return filtered_articles
     except Exception as e:
         print(f"newsapi: An error occurred when fetching: {str(e)}")
         return None
 
 
+def get_page(base_url: str, endpoint: str, params: dict, page: int, rate_limiter: RateLimiter,
+             cache: ResponseCache = None) -> dict:
+    """
+Fetch one page of a query, from the cache if possible. Rate limited (429) and server error (5xx) responses, as well as
+connection errors, are retried with exponential backoff and jitter, honoring the Retry-After header if present.
+    :raise NewsAPIError: If the request fails for another reason, or still fails after MAX_RETRIES retries.
+    """
+    page_params = dict(params, page=page)
+    if cache is not None:
+        news_data = cache.get(endpoint, page_params)
+        if news_data is not None:
+            instrumentation.count('http_cache_hits')
+            return news_data
+
+    for attempt in range(MAX_RETRIES + 1):
+        instrumentation.count('http_wait_seconds', rate_limiter.acquire())
+        instrumentation.count('http_requests')
+        try:
+            response = get_session().get(f'{base_url}{endpoint}', params=page_params, timeout=REQUEST_TIMEOUT_SECONDS)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == MAX_RETRIES:
+                raise NewsAPIError(0, str(e))
+            retry_after = None
+        else:
+            if response.status_code == 200:
+                break
+            if response.status_code != 429 and response.status_code < 500 or attempt == MAX_RETRIES:
+                raise NewsAPIError(response.status_code, response.text)
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        print(f"newsapi: Page {page} failed (attempt {attempt + 1}), retrying in {delay:.1f} seconds.")
+        instrumentation.count('http_retries')
+        instrumentation.count('http_wait_seconds', delay)
+        time.sleep(delay)
+
+    news_data = response.json()
+    if cache is not None:
+        cache.put(endpoint, page_params, news_data)
+    return news_data
+
+
+def backoff_delay(attempt: int) -> float:
+    # Exponential backoff with full jitter.
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def parse_retry_after(retry_after: str | None) -> float | None:
+    # Retry-After is either a number of seconds or an HTTP date.
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def get_page_articles(request_page, page: int) -> list | None:
+    try:
+        return request_page(page).get('articles', [])
+    except NewsAPIError as e:
+        print(f"newsapi: Failed to fetch page {page} of the request.")
+        print(f"Error message:\n{e.text}")
+        return None
+
+
+def print_throughput_summary(results: list[tuple[str, int, float]]):
+    """
+Print the number of articles collected for every keyword set (or headline query), and how fast they were collected.
+    :param results: The (name, article count, seconds) of every keyword set.
+    """
+    print("\nCollection summary:")
+    print(f"{'Keyword set':<40} {'Articles':>10} {'Seconds':>10} {'Articles/s':>12}")
+    for set_name, article_count, seconds in results:
+        throughput = article_count / seconds if seconds > 0 else 0.0
+        print(f"{set_name:<40} {article_count:>10} {seconds:>10.1f} {throughput:>12.1f}")
+
+
 def get_article_count_from_user(total_results):
     n = min(100, total_results)
     while True:
@@ -0,0 +1,163 @@
+import math
+import zlib
+
+import numpy as np
+import pandas as pd
+import instrumentation
+
+EPSILON = 1e-4
+DELTA = 1e-3
+TOP_K = 1000
+NGRAM_SIZES = (2, 3)
+SEED = 370
+
+_NGRAM_MULTIPLIER = np.uint64(1000003)
+
+
+class CountMinSketch:
+    """
+Count-min sketch over 64-bit hashes: `depth` rows of `width` counters, each row indexed by its own multiply-shift
+hash. An estimate is never below the true count, and exceeds it by more than `epsilon` * (total count) with a
+probability of at most `delta`, for width = ceil(e / epsilon) and depth = ceil(ln(1 / delta)).
+    """
+
+    def __init__(self, epsilon=EPSILON, delta=DELTA, seed=SEED):
+        self.width = math.ceil(math.e / epsilon)
+        self.depth = math.ceil(math.log(1 / delta))
+        random_state = np.random.RandomState(seed)
+        # Odd multipliers, as required by multiply-shift hashing.
+        self.multipliers = (random_state.randint(0, 2 ** 63, size=self.depth, dtype=np.uint64) * np.uint64(2)
+                            + np.uint64(1))
+        self.increments = random_state.randint(0, 2 ** 63, size=self.depth, dtype=np.uint64)
+        self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+        self.total = 0
+
+    def _columns(self, hashes: np.ndarray) -> np.ndarray:
+        # The counter of every hash in every row, shape (depth, len(hashes)).
+        mixed = hashes[np.newaxis, :] * self.multipliers[:, np.newaxis] + self.increments[:, np.newaxis]
+        return ((mixed >> np.uint64(32)) % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, hashes: np.ndarray):
+        # Count one occurrence of every hash (hashes can repeat).
+        flat = self._columns(hashes) + (np.arange(self.depth) * self.width)[:, np.newaxis]
+        self.table += np.bincount(flat.ravel(), minlength=self.depth * self.width).reshape(self.depth, self.width)
+        self.total += len(hashes)
+
+    def estimate(self, hashes: np.ndarray) -> np.ndarray:
+        return self.table[np.arange(self.depth)[:, np.newaxis], self._columns(hashes)].min(axis=0)
+
+    @property
+    def nbytes(self) -> int:
+        return self.table.nbytes
+
+
+class TopicNgramCounter:
+    """
+Approximate n-gram (phrase) frequencies of each topic, in memory fixed in advance: a count-min sketch per topic, plus
+the `top_k` phrases with the highest estimated counts (the heavy hitters) of each topic.
+After every batch of articles, the phrases of the batch and the current heavy hitters of a topic are ranked by their
+estimated count, and only the best `top_k` are kept, so only their text is ever built and stored.
+    """
+
+    def __init__(self, ngram_sizes=NGRAM_SIZES, epsilon=EPSILON, delta=DELTA, top_k=TOP_K, seed=SEED):
+        self.ngram_sizes = ngram_sizes
+        self.epsilon = epsilon
+        self.delta = delta
+        self.top_k = top_k
+        self.seed = seed
+        self.sketches: dict = {}
+        self.heavy_hitters: dict = {}
+
+    def add_tokens(self, rows: np.ndarray, word_ids: np.ndarray, vocabulary: list[str], row_topics: pd.Series):
+        """
+Count the n-grams of a batch of tokenized articles (see tokenize_descriptions). N-grams do not cross articles.
+        :param rows: The row label of every token, in the order of the articles and of the words in their description.
+        :param word_ids: The word id of every token.
+        :param vocabulary: The word of each word id.
+        :param row_topics: The topic of each row, indexed by row label.
+        """
+        if len(rows) == 0:
+            return
+        # crc32 instead of hash(), so the hashes of a phrase are the same in every batch and every process.
+        used_words = np.unique(word_ids)
+        word_hashes = np.zeros(len(vocabulary), dtype=np.uint64)
+        word_hashes[used_words] = [zlib.crc32(vocabulary[word].encode('utf-8')) for word in used_words]
+        token_hashes = word_hashes[word_ids]
+
+        starts, hashes, sizes = [], [], []
+        for size in self.ngram_sizes:
+            if len(rows) < size:
+                continue
+            # The tokens of an article are contiguous, so an n-gram is in one article if its first and last are.
+            ngram_starts = np.flatnonzero(rows[:len(rows) - size + 1] == rows[size - 1:])
+            ngram_hashes = token_hashes[ngram_starts]
+            for offset in range(1, size):
+                ngram_hashes = ngram_hashes * _NGRAM_MULTIPLIER + token_hashes[ngram_starts + offset]
+            starts.append(ngram_starts)
+            hashes.append(ngram_hashes)
+            sizes.append(np.full(len(ngram_starts), size))
+        if not starts:
+            return
+        starts, hashes, sizes = np.concatenate(starts), np.concatenate(hashes), np.concatenate(sizes)
+
+        topic_codes, topics = pd.factorize(row_topics.loc[rows[starts]].to_numpy(), use_na_sentinel=False)
+        for code, topic in enumerate(topics):
+            in_topic = topic_codes == code
+            self._add_topic_ngrams(topic, hashes[in_topic], starts[in_topic], sizes[in_topic], word_ids, vocabulary)
+        instrumentation.count('ngrams', len(hashes))
+
+    def _add_topic_ngrams(self, topic, hashes: np.ndarray, starts: np.ndarray, sizes: np.ndarray,
+                          word_ids: np.ndarray, vocabulary: list[str]):
+        if topic not in self.sketches:
+            self.sketches[topic] = CountMinSketch(self.epsilon, self.delta, self.seed)
+            self.heavy_hitters[topic] = {}
+        sketch, heavy_hitters = self.sketches[topic], self.heavy_hitters[topic]
+        sketch.add(hashes)
+
+        batch_hashes, first_occurrence = np.unique(hashes, return_index=True)
+        known_hashes = np.fromiter(heavy_hitters, dtype=np.uint64, count=len(heavy_hitters))
+        candidates = np.union1d(batch_hashes, known_hashes)
+        estimates = sketch.estimate(candidates)
+        if len(candidates) > self.top_k:
+            best = np.argpartition(-estimates, self.top_k - 1)[:self.top_k]
+            candidates, estimates = candidates[best], estimates[best]
+
+        # Only the text of the phrases that just became heavy hitters is built, from their first occurrence.
+        new_hashes = candidates[~np.isin(candidates, known_hashes)]
+        occurrences = first_occurrence[np.searchsorted(batch_hashes, new_hashes)]
+        phrases = {ngram_hash: ' '.join(vocabulary[word] for word in word_ids[start:start + size])
+                   for ngram_hash, start, size in zip(new_hashes.tolist(), starts[occurrences], sizes[occurrences])}
+        self.heavy_hitters[topic] = {
+            ngram_hash: (phrases[ngram_hash] if ngram_hash in phrases else heavy_hitters[ngram_hash][0], estimate)
+            for ngram_hash, estimate in zip(candidates.tolist(), estimates.tolist())}
+
+    def phrase_freq_by_topic(self) -> dict:
+        """
+The candidate phrases are the heavy hitters of every topic. Every candidate is estimated in the sketch of every
+topic, and listed for each topic where its estimate is not 0, so the document frequency compute_topic_lang derives
+from these lists is not limited to the topics where the phrase is a heavy hitter (which would inflate its idf, more
+so the lower `top_k`). A count-min sketch never underestimates, so a phrase is listed for every topic using it: the
+document frequency can only be overestimated (on a hash collision in every row), and the idf underestimated.
+        :return: The candidate phrases of each topic with their estimated counts, in the same format as
+        count_word_freq_per_topic (topics sorted, phrases by decreasing count), so compute_topic_lang can score them.
+        """
+        candidates = {}
+        for heavy_hitters in self.heavy_hitters.values():
+            for ngram_hash, (phrase, _) in heavy_hitters.items():
+                candidates.setdefault(ngram_hash, phrase)
+        hashes = np.fromiter(candidates, dtype=np.uint64, count=len(candidates))
+        phrases = list(candidates.values())
+
+        phrase_freq_by_topic = {}
+        for topic in sorted(self.heavy_hitters, key=lambda t: (pd.isna(t), str(t))):
+            estimates = self.sketches[topic].estimate(hashes) if len(hashes) else np.zeros(0, dtype=np.int64)
+            used = np.flatnonzero(estimates > 0)
+            topic_phrases = sorted(zip([phrases[i] for i in used], estimates[used].tolist()),
+                                   key=lambda item: (-item[1], item[0]))
+            phrase_freq_by_topic[topic] = {phrase: int(count) for phrase, count in topic_phrases}
+        return phrase_freq_by_topic
+
+    @property
+    def nbytes(self) -> int:
+        # The memory used by the sketches, which is fixed once a topic is seen.
+        return sum(sketch.nbytes for sketch in self.sketches.values())
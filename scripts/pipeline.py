@@ -0,0 +1,317 @@
+import argparse
+import datetime
+import hashlib
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import instrumentation
+
+SCRIPTS_DIR = Path(__file__).parent
+CACHE_MANIFEST = '.pipeline_cache.json'
+HASH_BLOCK_SIZE = 1 << 20
+# The modules every stage reading article files (through json_to_columnar.read_table_chunks) depends on.
+READ_CODE_FILES = ['json_to_columnar.py', 'json_to_csv.py', 'article_store.py']
+
+
+class Stage:
+    """
+A step of the pipeline. `func` is called as func(*inputs, *outputs, **params) in a worker process, so it has to be a
+module-level function. A stage depends on the stages producing its inputs.
+If `cached`, the stage is skipped when the hash of its input files, parameters and code (`code_files`) is the same as
+on its last successful run and its outputs still have the content they had then.
+    """
+
+    def __init__(self, name: str, func, inputs: list, outputs: list, params: dict = None, code_files: list = (),
+                 cached=True):
+        self.name = name
+        self.func = func
+        self.inputs = [Path(p) for p in inputs]
+        self.outputs = [Path(p) for p in outputs]
+        self.params = params or {}
+        self.code_files = [SCRIPTS_DIR / f for f in code_files]
+        self.cached = cached
+        self.started = None
+
+    def key(self) -> str:
+        key_source = {
+            'stage': self.name,
+            'params': self.params,
+            'inputs': {str(p): file_hash(p) for p in self.inputs},
+            'code': {p.name: file_hash(p) for p in self.code_files}
+        }
+        return hashlib.sha256(json.dumps(key_source, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def file_hash(filepath: Path) -> str | None:
+    if not filepath.exists():
+        return None
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        while block := file.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run_stage(name: str, func, metrics_file, profile_dir, *args, **params):
+    # Runs in a worker process, so the metrics and profile of every stage are recorded separately (the worker may have
+    # run another stage before, hence the reset of its peak RSS).
+    instrumentation.reset_peak_rss()
+    with instrumentation.instrument(name, metrics_file, profile_dir):
+        func(*args, **params)
+
+
+# Stage functions (run in worker processes, so modules are imported in the function bodies).
+def run_collect(*outputs, api_key, keyword_sets, start_date, end_date, max_articles):
+    import collect_news
+    collect_news.collect_news(api_key,
+                              datetime.date.fromisoformat(start_date),
+                              datetime.date.fromisoformat(end_date),
+                              keyword_sets,
+                              max_articles=max_articles,
+                              incremental=True)
+
+
+def run_json_to_csv(articles_file, output_file):
+    from article_store import read_articles
+    from json_to_csv import articles_to_csv
+    articles_to_csv(read_articles(articles_file), output_file)
+
+
+def run_delete_duplicates(input_file, output_file, clusters_file, threshold):
+    # The cluster report is written next to the output, as '<output>_clusters.csv' (clusters_file).
+    from delete_duplicates import remove_duplicates
+    remove_duplicates(input_file, output_file, threshold=threshold)
+
+
+def run_sample(*files, per_stratum, total, seed):
+    # The input files (one per movie, named after it), then the sample and remainder files.
+    from annotation_sampler import PER_STRATUM, sample_articles
+    *input_files, sample_file, remainder_file = files
+    sample_articles(input_files, sample_file, remainder_file, per_stratum=per_stratum or PER_STRATUM, seed=seed,
+                    total=total)
+
+
+def run_word_frequency(annotated_file, output_file):
+    from compute_topic_word_frequency import count_word_freq_per_topic
+    with open(output_file, 'w', encoding='utf-8') as file:
+        json.dump(count_word_freq_per_topic(annotated_file), file, indent=4)
+
+
+def run_tfidf(word_frequency_file, output_file, num_words, show_scores):
+    from compute_topic_lang import TopicWordIndex
+    with open(word_frequency_file, 'r', encoding='utf-8') as file:
+        word_freq_by_topic = json.load(file)
+    top_words_by_topic = TopicWordIndex(word_freq_by_topic).top_words(num_words)
+    if not show_scores:
+        top_words_by_topic = {topic: list(top_words.keys()) for topic, top_words in top_words_by_topic.items()}
+    with open(output_file, 'w', encoding='utf-8') as file:
+        json.dump(top_words_by_topic, file, indent=4)
+
+
+def run_network(annotated_file, output_file):
+    import matplotlib
+    matplotlib.use('Agg')
+    from build_network_topic_coverage_per_movie import build_coverage_network, draw_graph
+    draw_graph(build_coverage_network(annotated_file), output_file)
+
+
+def build_stages(args) -> list[Stage]:
+    output_dir = Path(args.output_dir)
+    stages = []
+
+    articles_files = [Path(args.articles)] if args.articles else []
+    if args.api_key:
+        # Collection depends on NewsAPI, so it always runs; downstream stages are still skipped if nothing new was
+        # collected, since the content of the article store does not change.
+        with open(args.keyword_sets, 'r', encoding='utf-8') as file:
+            set_names = [name for keyword_set in json.load(file) for name in keyword_set]
+        store_files = [SCRIPTS_DIR.parent / 'data' / 'articles' / f'{name}_articles.jsonl' for name in set_names]
+        stages.append(Stage('collect', run_collect, [], store_files, cached=False,
+                            params={'api_key': args.api_key, 'keyword_sets': args.keyword_sets,
+                                    'start_date': args.start_date, 'end_date': args.end_date,
+                                    'max_articles': args.max_articles}))
+        if not articles_files:
+            articles_files = store_files
+
+    # Every article store is converted and deduplicated in its own stages (named after the store when there are
+    # several), and the sample is drawn from all of them at once, stratified by movie.
+    deduplicated_files = []
+    for articles_file in articles_files:
+        suffix = f'_{articles_file.stem.removesuffix("_articles")}' if len(articles_files) > 1 else ''
+        articles_csv = output_dir / f'{articles_file.stem}.csv'
+        deduplicated_csv = output_dir / f'{articles_file.stem}_deduplicated.csv'
+        stages.append(Stage(f'json_to_csv{suffix}', run_json_to_csv, [articles_file], [articles_csv],
+                            code_files=['pipeline.py', 'json_to_csv.py', 'article_store.py']))
+        stages.append(Stage(f'delete_duplicates{suffix}', run_delete_duplicates, [articles_csv],
+                            [deduplicated_csv, deduplicated_csv.with_name(f'{deduplicated_csv.stem}_clusters.csv')],
+                            params={'threshold': args.threshold},
+                            code_files=['pipeline.py', 'delete_duplicates.py', 'near_duplicates.py', *READ_CODE_FILES]))
+        deduplicated_files.append(deduplicated_csv)
+
+    if deduplicated_files and (args.sample_size or args.sample_total):
+        stages.append(Stage('sample', run_sample, deduplicated_files,
+                            [output_dir / 'sampled_data.csv', output_dir / 'data_remain.csv'],
+                            params={'per_stratum': args.sample_size, 'total': args.sample_total, 'seed': args.seed},
+                            code_files=['pipeline.py', 'annotation_sampler.py', *READ_CODE_FILES]))
+
+    # Annotation is done by hand on the deduplicated articles, so the analysis starts from the annotated file.
+    if args.annotated:
+        annotated_file = Path(args.annotated)
+        word_frequency_file = output_dir / 'word_frequencies_by_topic.json'
+        stages.append(Stage('word_frequency', run_word_frequency, [annotated_file], [word_frequency_file],
+                            code_files=['pipeline.py', 'compute_topic_word_frequency.py', 'token_corpus.py',
+                                        'ngram_sketch.py', *READ_CODE_FILES]))
+        stages.append(Stage('tfidf', run_tfidf, [word_frequency_file], [output_dir / 'tfidf_by_topic.json'],
+                            params={'num_words': args.num_words, 'show_scores': args.show_scores},
+                            code_files=['pipeline.py', 'compute_topic_lang.py', 'compute_topic_word_frequency.py']))
+        stages.append(Stage('network', run_network, [annotated_file], [output_dir / 'topic_coverage_by_movie.png'],
+                            code_files=['pipeline.py', 'build_network_topic_coverage_per_movie.py',
+                                        *READ_CODE_FILES]))
+
+    return stages
+
+
+def is_up_to_date(key: str, cached: dict | None) -> bool:
+    if cached is None or cached['key'] != key:
+        return False
+    return all(file_hash(Path(p)) == h for p, h in cached['outputs'].items())
+
+
+def run_pipeline(stages: list[Stage], cache_file: Path, workers=2, force=False, metrics_file=None,
+                 profile_dir=None) -> dict[str, str]:
+    """
+Run the stages in dependency order, running independent stages at the same time in up to `workers` processes.
+The metrics (and profiles) of the stages that run are recorded as described in instrumentation.py.
+    :return: The status of each stage: 'ran', 'cached', 'failed' or 'skipped' (a stage it depends on failed).
+    """
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    dependencies = {stage.name: {producers[p] for p in stage.inputs if p in producers} for stage in stages}
+    stages_by_name = {stage.name: stage for stage in stages}
+
+    manifest = {}
+    if cache_file.exists():
+        with open(cache_file, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+
+    status: dict[str, str] = {}
+    # The name of the stage of every future, and the key of the inputs, parameters and code it was started with.
+    running: dict = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while len(status) < len(stages):
+            for name, stage in stages_by_name.items():
+                if name in status or any(name == running_name for running_name, _ in running.values()):
+                    continue
+                if any(status.get(dep) in ('failed', 'skipped') for dep in dependencies[name]):
+                    status[name] = 'skipped'
+                    print(f"pipeline: Skipping '{name}' because a stage it depends on failed.")
+                    continue
+                if not all(status.get(dep) in ('ran', 'cached') for dep in dependencies[name]):
+                    continue
+
+                missing_inputs = [str(p) for p in stage.inputs if not p.exists()]
+                if missing_inputs:
+                    status[name] = 'failed'
+                    print(f"pipeline: '{name}' is missing its inputs: {missing_inputs}")
+                    continue
+
+                key = stage.key()
+                if stage.cached and not force and is_up_to_date(key, manifest.get(name)):
+                    status[name] = 'cached'
+                    print(f"pipeline: '{name}' is up to date, skipped.")
+                    continue
+
+                for output in stage.outputs:
+                    output.parent.mkdir(parents=True, exist_ok=True)
+                print(f"pipeline: Running '{name}'...")
+                future = executor.submit(run_stage, name, stage.func, metrics_file, profile_dir,
+                                         *stage.inputs, *stage.outputs, **stage.params)
+                running[future] = (name, key)
+                stage.started = time.perf_counter()
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, key = running.pop(future)
+                stage = stages_by_name[name]
+                try:
+                    future.result()
+                except Exception as e:
+                    status[name] = 'failed'
+                    print(f"pipeline: '{name}' failed: {e}")
+                    continue
+
+                status[name] = 'ran'
+                print(f"pipeline: '{name}' finished in {time.perf_counter() - stage.started:.1f} seconds.")
+                if stage.cached:
+                    # The key the stage started with: if its inputs changed while it was running, its outputs were
+                    # built from the old ones, so the next run must not find it up to date.
+                    manifest[name] = {'key': key,
+                                      'outputs': {str(p): file_hash(p) for p in stage.outputs}}
+                    with open(cache_file, 'w', encoding='utf-8') as file:
+                        json.dump(manifest, file, indent=4)
+
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the whole workflow (collect -> json_to_csv -> delete_duplicates -> sample ->"
+                    " [manual annotation] -> word frequency -> TF-IDF / coverage network) as a DAG of stages. A stage"
+                    " is skipped when its inputs, parameters and code did not change since its last run, and"
+                    " independent stages run in parallel.\n\n"
+                    "Example usage:\npython -m pipeline --annotated '../cleaned data/New annotated.csv'"
+                    " -o ../findings/pipeline",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output-dir", required=True, help="The directory to write the stage outputs to.")
+    parser.add_argument("--articles", default=None,
+                        help="The article store (.jsonl or .json) to convert and deduplicate for annotation.")
+    parser.add_argument("--annotated", default=None, help="The annotated articles csv file to analyze.")
+    parser.add_argument("-n", "--num-words", type=int, default=10,
+                        help="The number of words by highest TF-IDF score to output for each topic. Default is 10.")
+    parser.add_argument("--show-scores", action='store_true', help="Include the tf-idf score of each word.")
+    parser.add_argument("--threshold", type=float, default=0.8,
+                        help="The near-duplicate similarity threshold. Default is 0.8.")
+    sample_size = parser.add_mutually_exclusive_group()
+    sample_size.add_argument("--sample-size", type=int, default=None,
+                             help="Also sample this many deduplicated articles per movie and source to annotate.")
+    sample_size.add_argument("--sample-total", type=int, default=None,
+                             help="Also sample this many deduplicated articles in all to annotate, split between the"
+                                  " movies and sources in proportion to their number of articles.")
+    parser.add_argument("--seed", type=int, default=370, help="The seed of the annotation sample. Default is 370.")
+    parser.add_argument("-a", "--api-key", default=None, help="Your NewsAPI API key, to collect new articles first.")
+    parser.add_argument("-k", "--keyword-sets", default=None, help="The keyword sets to collect articles for.")
+    parser.add_argument("-s", "--start-date", default=datetime.date.today().isoformat(),
+                        help="The date the collection should start from. Default is today.")
+    parser.add_argument("-e", "--end-date", default=datetime.date.today().isoformat(),
+                        help="The date the collection should end with. Default is today.")
+    parser.add_argument("-m", "--max-articles", type=int, default=100,
+                        help="The maximum number of articles to collect for each keyword set. Default is 100.")
+    parser.add_argument("-w", "--workers", type=int, default=2,
+                        help="The number of stages that can run at the same time. Default is 2.")
+    parser.add_argument("-f", "--force", action='store_true', help="Run every stage, even if it is up to date.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.api_key and not args.keyword_sets:
+        parser.error("--api-key requires --keyword-sets.")
+
+    stages = build_stages(args)
+    if not stages:
+        parser.error("Nothing to run: give at least one of --articles, --annotated or --api-key.")
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with instrumentation.instrument('pipeline', args.metrics) as metrics:
+        status = run_pipeline(stages, output_dir / CACHE_MANIFEST, workers=args.workers, force=args.force,
+                              metrics_file=args.metrics, profile_dir=args.profile)
+        for stage_status in status.values():
+            metrics.count(f'stages_{stage_status}')
+    print(f"pipeline: {json.dumps(status)}")
+
+
+if __name__ == '__main__':
+    main()
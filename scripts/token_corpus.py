@@ -0,0 +1,177 @@
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import instrumentation
+from json_to_columnar import read_table_chunks
+
+CHUNK_SIZE = 50000
+TOKEN_DTYPE = np.int32
+
+# Replace punctuation with a space, normalize curly single quotes and expand ellipses.
+# (Curly double quotes become '"', which is itself replaced with a space.)
+PUNCTUATION_TABLE = str.maketrans({
+    **{c: ' ' for c in '()[],-.?!:;#&/"—“”'},
+    '‘': "'",
+    '’': "'",
+    '…': '...'
+})
+
+
+def remove_punctuation(article_description: str) -> str:
+    return article_description.replace('&quot;', '').translate(PUNCTUATION_TABLE)
+
+
+def tokenize_descriptions(descriptions: pd.Series) -> tuple[np.ndarray, np.ndarray, list[str]]:
+    """
+Vectorized remove_punctuation + lower + split of a series of descriptions. Missing descriptions are counted as the
+word 'nan', like str(nan) does.
+Punctuation only ever becomes spaces, so splitting on whitespace first and then cleaning every distinct
+whitespace-separated token once gives the same words, while only cleaning each distinct token once.
+    :return: The row label of every word, the id of every word, and the vocabulary (word of each id).
+    """
+    tokens = descriptions.fillna('nan').astype(str).str.split().explode().dropna()
+    token_codes, distinct_tokens = pd.factorize(tokens.to_numpy())
+
+    # Clean each distinct token, then factorize the resulting words into the chunk's vocabulary.
+    token_words = [remove_punctuation(token).lower().split() for token in distinct_tokens]
+    words_per_token = np.fromiter((len(words) for words in token_words), dtype=np.int64, count=len(token_words))
+    word_codes, vocabulary = pd.factorize(np.array([w for words in token_words for w in words], dtype=object))
+    token_word_start = np.concatenate(([0], np.cumsum(words_per_token)[:-1]))
+
+    # Expand every token occurrence into the ids of its words.
+    occurrence_lengths = words_per_token[token_codes]
+    occurrence = np.repeat(np.arange(len(token_codes)), occurrence_lengths)
+    occurrence_start = np.repeat(np.cumsum(occurrence_lengths) - occurrence_lengths, occurrence_lengths)
+    word_offsets = np.arange(len(occurrence)) - occurrence_start
+    word_ids = word_codes[token_word_start[token_codes][occurrence] + word_offsets]
+
+    return tokens.index.to_numpy()[occurrence], word_ids, list(vocabulary)
+
+
+class TokenCorpus:
+    """
+A tokenized set of articles, stored in a directory as:
+    vocabulary.json: the list of distinct words (the id of a word is its index),
+    token_ids.npy: the word id of every token, article after article,
+    offsets.npy: where the tokens of each article start in token_ids (plus the total number of tokens at the end),
+    topic_ids.npy / topics.json: the topic (annotation) id of each article and the list of topics,
+    movie_ids.npy / movies.json: the movie (ID column) id of each article and the list of movies.
+The arrays are memory mapped when loaded, so loading a corpus copies nothing but the vocabulary.
+    """
+
+    def __init__(self, directory, vocabulary: list[str], token_ids: np.ndarray, offsets: np.ndarray,
+                 topic_ids: np.ndarray, topics: list, movie_ids: np.ndarray, movies: list):
+        self.directory = directory
+        self.vocabulary = vocabulary
+        self.token_ids = token_ids
+        self.offsets = offsets
+        self.topic_ids = topic_ids
+        self.topics = topics
+        self.movie_ids = movie_ids
+        self.movies = movies
+
+    @property
+    def num_articles(self) -> int:
+        return len(self.offsets) - 1
+
+    def article_tokens(self, article: int) -> np.ndarray:
+        return self.token_ids[self.offsets[article]:self.offsets[article + 1]]
+
+    def tokens(self, start: int, end: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :return: The article number and the word id of every token of articles `start` to `end` (excluded).
+        """
+        lengths = np.diff(self.offsets[start:end + 1])
+        rows = np.repeat(np.arange(start, end), lengths)
+        return rows, np.asarray(self.token_ids[self.offsets[start]:self.offsets[end]])
+
+    def topic_labels(self) -> np.ndarray:
+        return np.array(self.topics, dtype=object)[self.topic_ids]
+
+    def movie_labels(self) -> np.ndarray:
+        return np.array(self.movies, dtype=object)[self.movie_ids]
+
+
+def intern(values: pd.Series, ids: dict) -> np.ndarray:
+    # Map every value to its id in `ids`, giving new values the next free id.
+    codes, uniques = pd.factorize(values.to_numpy(dtype=object), use_na_sentinel=False)
+    value_ids = np.array([ids.setdefault(None if pd.isna(v) else v, len(ids)) for v in uniques], dtype=np.int64)
+    return value_ids[codes] if len(codes) else np.zeros(0, dtype=np.int64)
+
+
+def build_corpus(articles_filepath, output_dir, chunksize=CHUNK_SIZE) -> TokenCorpus:
+    """
+Tokenize the descriptions of an annotated article file (csv, Parquet or Arrow) once, and save them as a token corpus.
+    :param articles_filepath: The path to the annotated articles (with 'ID', 'Annotation' and 'Description' columns).
+    :param output_dir: The directory to save the corpus to.
+    :return: The corpus, loaded back from the output directory.
+    """
+    word_ids_by_word: dict[str, int] = {}
+    topic_ids_by_topic: dict = {}
+    movie_ids_by_movie: dict = {}
+    token_id_chunks, length_chunks, topic_id_chunks, movie_id_chunks = [], [], [], []
+
+    for chunk in read_table_chunks(articles_filepath, columns=['ID', 'Annotation', 'Description'],
+                                   chunksize=chunksize):
+        rows, chunk_word_ids, chunk_vocabulary = tokenize_descriptions(chunk['Description'])
+        vocabulary_ids = np.array([word_ids_by_word.setdefault(w, len(word_ids_by_word)) for w in chunk_vocabulary],
+                                  dtype=TOKEN_DTYPE)
+        token_id_chunks.append(vocabulary_ids[chunk_word_ids] if len(chunk_word_ids) else np.zeros(0, TOKEN_DTYPE))
+        length_chunks.append(np.bincount(rows - chunk.index[0], minlength=len(chunk)))
+        topic_id_chunks.append(intern(chunk['Annotation'], topic_ids_by_topic))
+        movie_id_chunks.append(intern(chunk['ID'], movie_ids_by_movie))
+
+    lengths = np.concatenate(length_chunks) if length_chunks else np.zeros(0, dtype=np.int64)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    np.save(output_dir / 'token_ids.npy', np.concatenate(token_id_chunks or [np.zeros(0, TOKEN_DTYPE)]))
+    np.save(output_dir / 'offsets.npy', np.concatenate(([0], np.cumsum(lengths))).astype(np.int64))
+    np.save(output_dir / 'topic_ids.npy', np.concatenate(topic_id_chunks or [np.zeros(0)]).astype(np.int32))
+    np.save(output_dir / 'movie_ids.npy', np.concatenate(movie_id_chunks or [np.zeros(0)]).astype(np.int32))
+    for filename, values in [('vocabulary.json', word_ids_by_word), ('topics.json', topic_ids_by_topic),
+                             ('movies.json', movie_ids_by_movie)]:
+        with open(output_dir / filename, 'w', encoding='utf-8') as file:
+            json.dump(list(values.keys()), file, ensure_ascii=False)
+
+    return load_corpus(output_dir)
+
+
+def load_corpus(corpus_dir, mmap=True) -> TokenCorpus:
+    corpus_dir = Path(corpus_dir)
+    mmap_mode = 'r' if mmap else None
+    json_files = {}
+    for name in ['vocabulary', 'topics', 'movies']:
+        with open(corpus_dir / f'{name}.json', 'r', encoding='utf-8') as file:
+            json_files[name] = json.load(file)
+
+    return TokenCorpus(corpus_dir,
+                       json_files['vocabulary'],
+                       np.load(corpus_dir / 'token_ids.npy', mmap_mode=mmap_mode),
+                       np.load(corpus_dir / 'offsets.npy', mmap_mode=mmap_mode),
+                       np.load(corpus_dir / 'topic_ids.npy', mmap_mode=mmap_mode),
+                       json_files['topics'],
+                       np.load(corpus_dir / 'movie_ids.npy', mmap_mode=mmap_mode),
+                       json_files['movies'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tokenizes the descriptions of annotated articles once and saves them as a token corpus"
+                    " (vocabulary + memory-mappable token arrays), used by compute_topic_word_frequency.py"
+                    " and compute_topic_lang.py.")
+    parser.add_argument("-a", "--articles", required=True, help="The path to the annotated articles csv file.")
+    parser.add_argument("-o", "--output", required=True, help="The path to the output corpus directory.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.instrument('token_corpus', args.metrics, args.profile):
+        corpus = build_corpus(args.articles, args.output)
+        print(f"token_corpus: Saved {corpus.num_articles} articles, {len(corpus.token_ids)} tokens and"
+              f" {len(corpus.vocabulary)} distinct words to '{args.output}'.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+import argparse
+import json
+import zlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import instrumentation
+from delete_duplicates import find_column
+from json_to_columnar import read_table_chunks
+from token_corpus import tokenize_descriptions
+
+NUM_FEATURES = 1 << 18
+SMOOTHING = 0.1
+REVIEW_THRESHOLD = 0.6
+CHUNK_SIZE = 50000
+TEST_FRACTION = 0.2
+SEED = 370
+# The temperatures tried when calibrating the confidences, from sharpening them 10x to flattening them 10000x.
+TEMPERATURES = np.logspace(-1, 4, 201)
+# Annotations that are not topics (see build_network_topic_coverage_per_movie.py).
+EXCLUDED_LABELS = ['duplicate']
+
+_BIGRAM_MULTIPLIER = np.uint64(1000003)
+
+
+def article_texts(chunk: pd.DataFrame) -> pd.Series:
+    # The title and description of every article (the annotated files use 'Title', the collected ones 'title').
+    columns = [column for column in (find_column(chunk, 'title'), find_column(chunk, 'description')) if column]
+    if not columns:
+        raise ValueError(f"topic_classifier: The articles have no title or description column: {list(chunk.columns)}")
+    texts = chunk[columns[0]].fillna('').astype(str)
+    for column in columns[1:]:
+        texts = texts + ' ' + chunk[column].fillna('').astype(str)
+    return texts.reset_index(drop=True)
+
+
+def hashed_features(texts: pd.Series, num_features=NUM_FEATURES, bigrams=True) -> tuple[np.ndarray, np.ndarray]:
+    """
+Tokenize texts like compute_topic_word_frequency.py does, and hash every word (and every pair of consecutive words)
+into one of `num_features` buckets. crc32 is used instead of hash(), so the buckets are the same in every process.
+    :return: The position of the text of every feature occurrence, and the bucket of every occurrence.
+    """
+    rows, word_ids, vocabulary = tokenize_descriptions(texts)
+    word_hashes = np.fromiter((zlib.crc32(word.encode('utf-8')) for word in vocabulary), dtype=np.uint64,
+                              count=len(vocabulary))
+    hashes = word_hashes[word_ids]
+    buckets = hashes % np.uint64(num_features)
+    if not bigrams:
+        return rows, buckets.astype(np.int64)
+
+    same_text = rows[1:] == rows[:-1]
+    bigram_buckets = (hashes[:-1][same_text] * _BIGRAM_MULTIPLIER + hashes[1:][same_text]) % np.uint64(num_features)
+    return (np.concatenate((rows, rows[1:][same_text])),
+            np.concatenate((buckets, bigram_buckets)).astype(np.int64))
+
+
+class TopicClassifier:
+    """
+Multinomial naive Bayes over hashed word and bigram counts. Training and prediction are vectorized over whole
+chunks of articles: the per-class log-likelihoods are gathered for every feature occurrence at once and summed per
+article with np.bincount.
+Naive Bayes treats every word as independent evidence, so its raw posteriors are nearly always 0 or 1. The
+log-scores are divided by a `temperature` fitted on held-out articles (see calibrate) before the softmax, so a
+confidence of 0.6 means about 60% of such predictions are right.
+    """
+
+    def __init__(self, labels: list[str], log_prior: np.ndarray, log_likelihood: np.ndarray, bigrams=True,
+                 temperature=1.0):
+        self.labels = labels
+        self.log_prior = log_prior
+        self.log_likelihood = log_likelihood
+        self.bigrams = bigrams
+        self.temperature = temperature
+
+    @classmethod
+    def train(cls, texts: pd.Series, labels: pd.Series, num_features=NUM_FEATURES, smoothing=SMOOTHING,
+              bigrams=True) -> 'TopicClassifier':
+        label_codes, label_names = pd.factorize(labels.reset_index(drop=True), sort=True)
+        rows, buckets = hashed_features(texts, num_features, bigrams)
+
+        num_labels = len(label_names)
+        feature_counts = np.bincount(label_codes[rows] * num_features + buckets,
+                                     minlength=num_labels * num_features).reshape(num_labels, num_features)
+        log_likelihood = np.log(feature_counts + smoothing) - np.log(
+            feature_counts.sum(axis=1, keepdims=True) + smoothing * num_features)
+        log_prior = np.log(np.bincount(label_codes, minlength=num_labels) / len(label_codes))
+        return cls(list(label_names), log_prior, log_likelihood.astype(np.float32), bigrams)
+
+    def log_scores(self, texts: pd.Series) -> np.ndarray:
+        # The unnormalized log-posterior of every label, for every text.
+        rows, buckets = hashed_features(texts, self.log_likelihood.shape[1], self.bigrams)
+        scores = np.empty((len(texts), len(self.labels)))
+        for label in range(len(self.labels)):
+            scores[:, label] = self.log_prior[label] + np.bincount(rows, weights=self.log_likelihood[label, buckets],
+                                                                   minlength=len(texts))
+        return scores
+
+    def predict_proba(self, texts: pd.Series) -> np.ndarray:
+        return softmax(self.log_scores(texts) / self.temperature)
+
+    def calibrate(self, texts: pd.Series, labels: pd.Series, temperatures=TEMPERATURES) -> float:
+        """
+Set the temperature to the one giving the held-out articles the lowest negative log-likelihood of their labels.
+Articles labelled with a topic the model does not know are left out.
+        :return: The temperature.
+        """
+        label_codes = pd.Index(self.labels).get_indexer(labels.reset_index(drop=True))
+        known = label_codes != -1
+        scores = self.log_scores(texts.reset_index(drop=True)[known])
+        if len(scores) == 0:
+            return self.temperature
+        scores = scores - scores.max(axis=1, keepdims=True)
+        label_scores = scores[np.arange(len(scores)), label_codes[known]]
+        losses = [np.mean(np.log(np.exp(scores / temperature).sum(axis=1)) - label_scores / temperature)
+                  for temperature in temperatures]
+        self.temperature = float(temperatures[int(np.argmin(losses))])
+        return self.temperature
+
+    def predict(self, texts: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :return: The predicted label of every text, and the probability the model gives it (its confidence).
+        """
+        probabilities = self.predict_proba(texts)
+        best = probabilities.argmax(axis=1)
+        return np.array(self.labels, dtype=object)[best], probabilities[np.arange(len(best)), best]
+
+    def save(self, model_file):
+        np.savez_compressed(model_file, log_prior=self.log_prior, log_likelihood=self.log_likelihood,
+                            labels=np.array(self.labels), bigrams=self.bigrams, temperature=self.temperature)
+
+    @classmethod
+    def load(cls, model_file) -> 'TopicClassifier':
+        with np.load(model_file) as model:
+            # Models saved before calibration was added have no temperature.
+            temperature = float(model['temperature']) if 'temperature' in model else 1.0
+            return cls(model['labels'].tolist(), model['log_prior'], model['log_likelihood'], bool(model['bigrams']),
+                       temperature)
+
+
+def softmax(scores: np.ndarray) -> np.ndarray:
+    # Shifted by the best score of every row for stability.
+    probabilities = np.exp(scores - scores.max(axis=1, keepdims=True))
+    return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+
+def load_training_data(annotated_filepath) -> pd.DataFrame:
+    articles = pd.concat(read_table_chunks(annotated_filepath, columns=['Title', 'Description', 'Annotation']))
+    return articles[articles['Annotation'].notna() & ~articles['Annotation'].isin(EXCLUDED_LABELS)]
+
+
+def evaluate(articles: pd.DataFrame, test_fraction=TEST_FRACTION, threshold=REVIEW_THRESHOLD, seed=SEED,
+             **train_options) -> dict:
+    """
+Train on a seeded random split of the annotated articles, calibrate the confidences on the rest (the held-out
+articles), and measure the accuracy of the held-out predictions above the threshold and below it (the ones that
+would be reviewed).
+    :return: The calibrated temperature, and the accuracy and size of each part of the held-out articles.
+    """
+    test_mask = np.random.RandomState(seed).random_sample(len(articles)) < test_fraction
+    train, test = articles[~test_mask], articles[test_mask]
+    classifier = TopicClassifier.train(article_texts(train), train['Annotation'], **train_options)
+    temperature = classifier.calibrate(article_texts(test), test['Annotation'])
+    predicted, confidence = classifier.predict(article_texts(test))
+    correct = predicted == test['Annotation'].to_numpy()
+    confident = confidence >= threshold
+
+    def accuracy(mask: np.ndarray):
+        return round(float(correct[mask].mean()), 3) if mask.any() else None
+
+    return {
+        'train_articles': int(len(train)),
+        'test_articles': int(len(test)),
+        'temperature': round(temperature, 3),
+        'accuracy': accuracy(np.ones(len(correct), dtype=bool)),
+        'confident_fraction': round(float(confident.mean()), 3) if len(confident) else None,
+        'confident_accuracy': accuracy(confident),
+        'review_accuracy': accuracy(~confident),
+        'mean_confidence': round(float(confidence.mean()), 3) if len(confidence) else None
+    }
+
+
+def predict_file(classifier: TopicClassifier, articles_filepath, output_file, threshold=REVIEW_THRESHOLD,
+                 chunksize=CHUNK_SIZE) -> int:
+    """
+Add the predicted topic of every article, the confidence of the prediction and whether it needs to be reviewed
+(confidence below `threshold`) to a copy of an article csv (or Parquet / Arrow) file, one chunk at a time.
+    :return: The number of articles that need to be reviewed.
+    """
+    review_count = 0
+    header = True
+    for chunk in read_table_chunks(articles_filepath, chunksize=chunksize):
+        predicted, confidence = classifier.predict(article_texts(chunk))
+        chunk = chunk.assign(**{'Predicted Annotation': predicted, 'Confidence': confidence.round(4),
+                                'Needs Review': confidence < threshold})
+        review_count += int((confidence < threshold).sum())
+        chunk.to_csv(output_file, mode='w' if header else 'a', header=header, index=False)
+        header = False
+    return review_count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pre-annotates articles with one of the annotation topics. 'train' learns a naive Bayes model"
+                    " from an annotated file, 'predict' adds the predicted topic and its confidence to an article"
+                    " file, so only the low-confidence articles have to be annotated by hand.\n\n"
+                    "Example usage:\npython -m topic_classifier train -a '../cleaned data/New annotated.csv'"
+                    " -m ../data/topic_model.npz --evaluate\n"
+                    "python -m topic_classifier predict -m ../data/topic_model.npz -a ../data/articles/new.csv"
+                    " -o ../data/articles/new_predicted.csv",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train', help="Train a model on annotated articles.")
+    train_parser.add_argument("-a", "--articles", required=True, help="The path to the annotated articles file.")
+    train_parser.add_argument("-m", "--model", required=True, help="The path to save the model (.npz) to.")
+    train_parser.add_argument("--num-features", type=int, default=NUM_FEATURES,
+                              help=f"The number of hashed features. Default is {NUM_FEATURES}.")
+    train_parser.add_argument("--no-bigrams", action='store_true', help="Only use single words as features.")
+    train_parser.add_argument("--evaluate", action='store_true',
+                              help=f"Also report the accuracy, above and below the review threshold, of a model"
+                                   f" trained on a random {1 - TEST_FRACTION:.0%} of the articles, on the other"
+                                   f" {TEST_FRACTION:.0%}. The confidences are always calibrated on these"
+                                   f" {TEST_FRACTION:.0%}.")
+    train_parser.add_argument("-t", "--threshold", type=float, default=REVIEW_THRESHOLD,
+                              help=f"The review threshold to evaluate. Default is {REVIEW_THRESHOLD}.")
+
+    predict_parser = subparsers.add_parser('predict', help="Predict the topic of articles.")
+    predict_parser.add_argument("-m", "--model", required=True, help="The path to the model (.npz).")
+    predict_parser.add_argument("-a", "--articles", required=True,
+                                help="The path to the articles file (csv, Parquet or Arrow), with title and"
+                                     " description columns.")
+    predict_parser.add_argument("-o", "--output", required=True, help="The path to the output csv file.")
+    predict_parser.add_argument("-t", "--threshold", type=float, default=REVIEW_THRESHOLD,
+                                help=f"The confidence below which an article needs to be reviewed."
+                                     f" Default is {REVIEW_THRESHOLD}.")
+    for subparser in (train_parser, predict_parser):
+        instrumentation.add_arguments(subparser)
+    args = parser.parse_args()
+
+    with instrumentation.instrument(f'topic_classifier_{args.command}', args.metrics, args.profile):
+        if args.command == 'train':
+            articles = load_training_data(args.articles)
+            options = {'num_features': args.num_features, 'bigrams': not args.no_bigrams}
+            evaluation = evaluate(articles, threshold=args.threshold, **options)
+            if args.evaluate:
+                print(f"topic_classifier: Evaluation: {json.dumps(evaluation)}")
+            # The final model is trained on every article, with the temperature calibrated on the held-out ones.
+            classifier = TopicClassifier.train(article_texts(articles), articles['Annotation'], **options)
+            classifier.temperature = evaluation['temperature']
+            Path(args.model).parent.mkdir(parents=True, exist_ok=True)
+            classifier.save(args.model)
+            print(f"topic_classifier: Trained on {len(articles)} articles ({len(classifier.labels)} topics),"
+                  f" model saved to '{args.model}'.")
+        else:
+            classifier = TopicClassifier.load(args.model)
+            output_file = Path(args.output)
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            review_count = predict_file(classifier, args.articles, output_file, threshold=args.threshold)
+            print(f"topic_classifier: Predictions saved to '{output_file}', {review_count} articles need to be"
+                  f" reviewed.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+import argparse
+import bisect
+import heapq
+import json
+import math
+import os
+import sqlite3
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import instrumentation
+from json_to_columnar import read_table_chunks
+from token_corpus import remove_punctuation
+
+DEFAULT_NUM_WORDS = 10
+IDENTITY_COLUMNS = ['Source', 'ID', 'Author', 'Title']
+# The version of the layout of the state, so a state saved with another one is rebuilt.
+SCHEMA_VERSION = '3'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS articles (article_id TEXT PRIMARY KEY, topic TEXT NOT NULL, digest TEXT NOT NULL,
+                                     position REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS articles_by_topic ON articles (topic);
+CREATE TABLE IF NOT EXISTS article_words (article_id TEXT NOT NULL, word TEXT NOT NULL, count INTEGER NOT NULL,
+                                          rank INTEGER NOT NULL, PRIMARY KEY (article_id, word));
+CREATE TABLE IF NOT EXISTS topic_words (topic TEXT NOT NULL, word TEXT NOT NULL, count INTEGER NOT NULL,
+                                        PRIMARY KEY (topic, word));
+CREATE INDEX IF NOT EXISTS topic_words_by_word ON topic_words (word);
+CREATE TABLE IF NOT EXISTS document_frequency (word TEXT PRIMARY KEY, df INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS topic_rankings (topic TEXT NOT NULL, rank INTEGER NOT NULL, word TEXT NOT NULL,
+                                           score REAL NOT NULL, PRIMARY KEY (topic, rank));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+'''
+DROP_SCHEMA = '''
+DROP TABLE IF EXISTS articles;
+DROP TABLE IF EXISTS article_words;
+DROP TABLE IF EXISTS topic_words;
+DROP TABLE IF EXISTS document_frequency;
+DROP TABLE IF EXISTS topic_rankings;
+DELETE FROM meta WHERE key = 'file_signature';
+'''
+# The words of a topic by decreasing count, ties by first occurrence: the position of the first article of the topic
+# using the word in the articles file, then the word's rank in that article (most frequent first, ties by first
+# occurrence), like count_word_freq_per_topic orders them. With MIN, sqlite takes aw.rank from the first article.
+TOPIC_WORDS_QUERY = '''
+SELECT tw.word, tw.count, d.df, MIN(a.position) AS first_position, aw.rank AS first_rank
+FROM topic_words tw
+JOIN document_frequency d ON tw.word = d.word
+JOIN articles a ON a.topic = tw.topic
+JOIN article_words aw ON aw.article_id = a.article_id AND aw.word = tw.word
+WHERE tw.topic = ?
+GROUP BY tw.word
+ORDER BY tw.count DESC, first_position, first_rank
+'''
+
+
+def description_words(description) -> Counter:
+    # Same tokenization as compute_topic_word_frequency (a missing description counts as the word 'nan').
+    return Counter(remove_punctuation(str(description)).lower().split())
+
+
+class WordFreqState:
+    """
+Persistent word-frequency state of the annotated articles, in a sqlite database. It keeps the words of every article
+(by article identity), the word frequencies of every topic, the document frequency of every word (the number of
+topics that used it) and the top TF-IDF words of every topic.
+Articles are added, removed and relabelled as deltas: only the counts of the articles involved are updated, and only
+the rankings that can have changed are computed again (the topics whose counts changed, plus the topics using a word
+whose document frequency changed, or every topic if the number of topics changed).
+Ties are ranked by first occurrence in the articles file, so the rankings are the same as a full recompute with
+compute_topic_word_frequency and compute_topic_lang. Every article keeps a position that follows the order of the
+file: positions are floats, so an article inserted between two others gets a position between theirs and no other
+article moves.
+
+The cost of a sync and refresh, by part:
+- Reading the articles file and comparing it with the stored article identities and digests is O(corpus), but
+  it is skipped when the file has the same size and modification time as at the last sync.
+- The database writes are O(delta): the words of the added, removed, relabelled and edited articles, and the
+  positions of the added and moved articles. Only when the gaps between two positions run out of float precision
+  are all the positions renumbered, which is O(corpus).
+- A ranking is computed again from the words of its topic (O(topic)), only for the topics whose counts or tie
+  order changed and the topics using a word whose document frequency changed. When the number of topics changes,
+  the idf of every word changes, so every ranking is computed again (O(corpus)).
+    """
+
+    def __init__(self, db_filepath, num_words=DEFAULT_NUM_WORDS):
+        self.db = sqlite3.connect(db_filepath)
+        if self.db.execute("SELECT name FROM sqlite_master WHERE name = 'articles'").fetchone():
+            version = self.db.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+            if version is None or version[0] != SCHEMA_VERSION:
+                # Saved with another layout (ids, digests, positions), so it is emptied and rebuilt by the next sync.
+                self.db.executescript(DROP_SCHEMA)
+        self.db.executescript(SCHEMA)
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)", (SCHEMA_VERSION,))
+        self.num_words = num_words
+        self.changed_topics: set[str] = set()
+        self.changed_df_words: set[str] = set()
+        self.num_topics_before = self.num_topics()
+
+        stored_num_words = self.db.execute("SELECT value FROM meta WHERE key = 'num_words'").fetchone()
+        if stored_num_words is None or int(stored_num_words[0]) != num_words:
+            # The stored rankings have another length, so they all have to be computed again.
+            self.changed_topics.update(self.topics())
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('num_words', ?)", (str(num_words),))
+
+    def topics(self) -> list[str]:
+        return [row[0] for row in self.db.execute("SELECT DISTINCT topic FROM topic_words ORDER BY topic")]
+
+    def num_topics(self) -> int:
+        return self.db.execute("SELECT COUNT(DISTINCT topic) FROM topic_words").fetchone()[0]
+
+    def add_article(self, article_id: str, topic: str, description, digest: str = '', position: float = 0.0):
+        words = description_words(description)
+        self.db.execute("INSERT INTO articles VALUES (?, ?, ?, ?)", (article_id, topic, digest, position))
+        self.db.executemany("INSERT INTO article_words VALUES (?, ?, ?, ?)",
+                            [(article_id, word, count, rank)
+                             for rank, (word, count) in enumerate(words.most_common())])
+        self._add_topic_counts(topic, words.most_common())
+
+    def remove_article(self, article_id: str):
+        topic = self._article_topic(article_id)
+        words = self._article_words(article_id)
+        self.db.execute("DELETE FROM articles WHERE article_id = ?", (article_id,))
+        self.db.execute("DELETE FROM article_words WHERE article_id = ?", (article_id,))
+        self._add_topic_counts(topic, [(word, -count) for word, count in words])
+
+    def relabel_article(self, article_id: str, new_topic: str):
+        old_topic = self._article_topic(article_id)
+        if old_topic == new_topic:
+            return
+        # The words of the article do not change, so they are moved between topics without tokenizing it again.
+        words = self._article_words(article_id)
+        self.db.execute("UPDATE articles SET topic = ? WHERE article_id = ?", (new_topic, article_id))
+        self._add_topic_counts(old_topic, [(word, -count) for word, count in words])
+        self._add_topic_counts(new_topic, words)
+
+    def _article_topic(self, article_id: str) -> str:
+        return self.db.execute("SELECT topic FROM articles WHERE article_id = ?", (article_id,)).fetchone()[0]
+
+    def _article_words(self, article_id: str) -> list[tuple[str, int]]:
+        return self.db.execute("SELECT word, count FROM article_words WHERE article_id = ? ORDER BY rank",
+                               (article_id,)).fetchall()
+
+    def _add_topic_counts(self, topic: str, word_deltas):
+        self.changed_topics.add(topic)
+        for word, delta in word_deltas:
+            row = self.db.execute("SELECT count FROM topic_words WHERE topic = ? AND word = ?",
+                                  (topic, word)).fetchone()
+            old_count = row[0] if row else 0
+            new_count = old_count + delta
+
+            if new_count > 0 and old_count > 0:
+                self.db.execute("UPDATE topic_words SET count = ? WHERE topic = ? AND word = ?",
+                                (new_count, topic, word))
+            elif new_count > 0:
+                self.db.execute("INSERT INTO topic_words VALUES (?, ?, ?)", (topic, word, new_count))
+                self._add_document_frequency(word, 1)
+            elif old_count > 0:
+                self.db.execute("DELETE FROM topic_words WHERE topic = ? AND word = ?", (topic, word))
+                self._add_document_frequency(word, -1)
+
+    def _add_document_frequency(self, word: str, delta: int):
+        self.changed_df_words.add(word)
+        self.db.execute("INSERT INTO document_frequency VALUES (?, ?)"
+                        " ON CONFLICT (word) DO UPDATE SET df = df + excluded.df", (word, delta))
+        self.db.execute("DELETE FROM document_frequency WHERE word = ? AND df <= 0", (word,))
+
+    def refresh_rankings(self) -> set[str]:
+        """
+Compute the top TF-IDF words again for the topics affected by the deltas applied since the last refresh, and commit.
+        :return: The topics whose rankings were computed again.
+        """
+        num_topics = self.num_topics()
+        if num_topics != self.num_topics_before:
+            # idf = log(<number of topics> / df) changed for every word.
+            affected_topics = set(self.topics())
+        else:
+            affected_topics = set(self.changed_topics)
+            words = list(self.changed_df_words)
+            for i in range(0, len(words), 500):
+                batch = words[i:i + 500]
+                affected_topics.update(row[0] for row in self.db.execute(
+                    f"SELECT DISTINCT topic FROM topic_words WHERE word IN ({','.join('?' * len(batch))})", batch))
+
+        self.db.execute("DELETE FROM topic_rankings WHERE topic NOT IN (SELECT DISTINCT topic FROM topic_words)")
+        for topic in affected_topics:
+            self.db.execute("DELETE FROM topic_rankings WHERE topic = ?", (topic,))
+            scores = [(word, count * math.log(num_topics / df))
+                      for word, count, df, _, _ in self.db.execute(TOPIC_WORDS_QUERY, (topic,))]
+            # Ties keep the order of the topic's word frequencies, like compute_topic_lang.
+            top_words = heapq.nlargest(self.num_words, scores, key=lambda item: item[1])
+            self.db.executemany("INSERT INTO topic_rankings VALUES (?, ?, ?, ?)",
+                                [(topic, rank, word, score) for rank, (word, score) in enumerate(top_words)])
+
+        self.db.commit()
+        self.changed_topics.clear()
+        self.changed_df_words.clear()
+        self.num_topics_before = num_topics
+        return affected_topics
+
+    def sync(self, articles_filepath) -> dict[str, int]:
+        """
+Bring the state up to date with an annotated article file, by applying the add / remove / relabel deltas between the
+file and the state. An article whose description changed is removed and added again. Nothing is read if the file
+did not change since the last sync.
+        :return: The number of articles of each kind of delta.
+        """
+        deltas = {'added': 0, 'removed': 0, 'relabelled': 0, 'changed': 0, 'moved': 0}
+        file_stat = os.stat(articles_filepath)
+        signature = f'{file_stat.st_size}:{file_stat.st_mtime_ns}'
+        stored_signature = self.db.execute("SELECT value FROM meta WHERE key = 'file_signature'").fetchone()
+        if stored_signature is not None and stored_signature[0] == signature:
+            return deltas
+
+        stored = {article_id: (topic, digest, position) for article_id, topic, digest, position
+                  in self.db.execute("SELECT article_id, topic, digest, position FROM articles")}
+        # The id, topic and stored position (None if it has to be placed) of every article, in file order.
+        file_order: list[tuple[str, str, float | None]] = []
+        pending = {}
+        occurrences: dict[int, int] = {}
+
+        for chunk in read_table_chunks(articles_filepath, columns=IDENTITY_COLUMNS + ['Annotation', 'Description']):
+            digests = pd.util.hash_pandas_object(chunk['Description'].astype(str), index=False).to_numpy()
+            for article_id, topic, description, digest in zip(article_ids(chunk, occurrences), chunk['Annotation'],
+                                                              chunk['Description'], digests.tolist()):
+                topic = str(topic)
+                digest = f'{digest:016x}'
+                if article_id not in stored:
+                    pending[article_id] = (topic, description, digest)
+                    file_order.append((article_id, topic, None))
+                    deltas['added'] += 1
+                elif stored[article_id][1] != digest:
+                    self.remove_article(article_id)
+                    pending[article_id] = (topic, description, digest)
+                    file_order.append((article_id, topic, None))
+                    deltas['changed'] += 1
+                else:
+                    if stored[article_id][0] != topic:
+                        self.relabel_article(article_id, topic)
+                        deltas['relabelled'] += 1
+                    file_order.append((article_id, topic, stored[article_id][2]))
+
+        removed_ids = stored.keys() - {article_id for article_id, _, _ in file_order}
+        for article_id in removed_ids:
+            self.remove_article(article_id)
+            deltas['removed'] += 1
+
+        positions, kept = place_articles([old_position for _, _, old_position in file_order])
+        updated = []
+        for index, ((article_id, topic, old_position), position) in enumerate(zip(file_order, positions)):
+            if article_id in pending:
+                topic, description, digest = pending[article_id]
+                self.add_article(article_id, topic, description, digest, position)
+                continue
+            if position != old_position:
+                updated.append((position, article_id))
+            if index not in kept:
+                # Only an article that changed places can change which article of its topic first used a word, the
+                # kept articles are still in the same order.
+                self.changed_topics.add(topic)
+                deltas['moved'] += 1
+        self.db.executemany("UPDATE articles SET position = ? WHERE article_id = ?", updated)
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('file_signature', ?)", (signature,))
+        return deltas
+
+    def word_freq_by_topic(self) -> dict[str, dict[str, int]]:
+        word_freq_by_topic = {}
+        for topic in self.topics():
+            word_freq_by_topic[topic] = {word: count for word, count, *_
+                                         in self.db.execute(TOPIC_WORDS_QUERY, (topic,))}
+        return word_freq_by_topic
+
+    def top_words_by_topic(self, show_scores=False) -> dict[str, list[str] | dict[str, float]]:
+        top_words_by_topic = {}
+        for topic in self.topics():
+            top_words = self.db.execute("SELECT word, score FROM topic_rankings WHERE topic = ? ORDER BY rank",
+                                        (topic,)).fetchall()
+            top_words_by_topic[topic] = dict(top_words) if show_scores else [word for word, _ in top_words]
+        return top_words_by_topic
+
+    def close(self):
+        self.db.close()
+
+
+def article_ids(chunk: pd.DataFrame, occurrences: dict[int, int]) -> list[str]:
+    # An article is identified by its source, movie, author and title. Identical rows (e.g. the ones annotated as
+    # 'duplicate') are told apart by their occurrence number, counted across the chunks in occurrences.
+    identities = pd.util.hash_pandas_object(chunk[IDENTITY_COLUMNS].astype(str), index=False).to_numpy()
+    ids = []
+    for identity in identities.tolist():
+        occurrence = occurrences.get(identity, 0)
+        occurrences[identity] = occurrence + 1
+        ids.append(f'{identity:016x}#{occurrence}')
+    return ids
+
+
+def place_articles(old_positions: list[float | None]) -> tuple[list[float], set[int]]:
+    """
+Give positions that follow the file order to the articles of a file, changing as few stored positions as possible:
+the longest increasing run of stored positions is kept, and the other articles get positions between their kept
+neighbours. If no float fits between two neighbours, every article is renumbered.
+    :param old_positions: The stored position of every article in file order, None for the articles to add.
+    :return: The new positions, and the indices of the articles that kept their position.
+    """
+    # Longest increasing subsequence of the stored positions (patience sorting).
+    tails, tail_indices, previous = [], [], [-1] * len(old_positions)
+    for index, position in enumerate(old_positions):
+        if position is None:
+            continue
+        slot = bisect.bisect_left(tails, position)
+        if slot == len(tails):
+            tails.append(position)
+            tail_indices.append(index)
+        else:
+            tails[slot] = position
+            tail_indices[slot] = index
+        previous[index] = tail_indices[slot - 1] if slot else -1
+    kept = set()
+    index = tail_indices[-1] if tail_indices else -1
+    while index != -1:
+        kept.add(index)
+        index = previous[index]
+
+    positions = [old_positions[index] if index in kept else None for index in range(len(old_positions))]
+    start = 0
+    while start < len(positions):
+        if positions[start] is not None:
+            start += 1
+            continue
+        end = start
+        while end < len(positions) and positions[end] is None:
+            end += 1
+        low = positions[start - 1] if start else None
+        high = positions[end] if end < len(positions) else None
+        count = end - start
+        if low is None and high is None:
+            gap = np.arange(count, dtype=float)
+        elif low is None:
+            gap = np.arange(-count, 0, dtype=float) + high
+        elif high is None:
+            gap = np.arange(1, count + 1, dtype=float) + low
+        else:
+            gap = low + (high - low) * np.arange(1, count + 1) / (count + 1)
+        positions[start:end] = gap.tolist()
+        start = end
+
+    if any(later <= earlier for earlier, later in zip(positions, positions[1:])):
+        return [float(index) for index in range(len(positions))], kept
+    return positions, kept
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Updates a persistent word-frequency state from an annotated article file, applying only the"
+                    " articles that were added, removed, relabelled or edited since the last run, and prints the"
+                    " top TF-IDF words of each topic (like compute_topic_lang.py).")
+    parser.add_argument("-a", "--articles", required=True, help="The path to the annotated articles csv file.")
+    parser.add_argument("-s", "--state", required=True, help="The path to the sqlite state file (created if needed).")
+    parser.add_argument("-n", "--num-words", type=int, default=DEFAULT_NUM_WORDS,
+                        help=f"The number of words by highest TF-IDF score to keep for each topic."
+                             f" Default is {DEFAULT_NUM_WORDS}.")
+    parser.add_argument("--show-scores", action='store_true', default=False,
+                        help="Show the tf-idf score for each word.")
+    parser.add_argument("--word-counts", default=None,
+                        help="Also save the word frequency of each topic to this json file.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.instrument('word_freq_state', args.metrics, args.profile):
+        state = WordFreqState(args.state, num_words=args.num_words)
+        deltas = state.sync(args.articles)
+        refreshed_topics = state.refresh_rankings()
+        print(f"word_freq_state: Applied {deltas}, refreshed the rankings of {len(refreshed_topics)} topics.")
+
+        if args.word_counts:
+            output_file = Path(args.word_counts)
+            output_file.parent.mkdir(exist_ok=True, parents=True)
+            with open(output_file, 'w', encoding='utf-8') as file:
+                json.dump(state.word_freq_by_topic(), file, indent=4)
+
+        print(json.dumps(state.top_words_by_topic(args.show_scores), indent=4))
+        state.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+from coverage_timeseries import CoverageSeries
+
+
+def articles(urls, topic):
+    return [{'url': url, 'publishedAt': '2023-10-20T12:00:00Z', 'ID': 'Killers of the Flower Moon',
+             'source': {'name': 'Variety'}, 'Annotation': topic} for url in urls]
+
+
+def test_numeric_labels_merge_after_save_and_load(tmp_path):
+    coverage_file = tmp_path / 'coverage.npz'
+    series = CoverageSeries()
+    assert series.add_articles(articles(['a', 'b'], 3)) == 2
+    series.save(coverage_file)
+
+    series = CoverageSeries.load(coverage_file)
+    assert series.add_articles(articles(['c'], 3)) == 1
+    series.save(coverage_file)
+
+    rollup = CoverageSeries.load(coverage_file).rollup(by=('topic',))
+    assert rollup.to_dict() == {'3': 3}
+    assert CoverageSeries.load(coverage_file).rollup(by=('topic',), topic=3).sum() == 3
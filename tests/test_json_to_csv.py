@@ -0,0 +1,21 @@
+import pandas as pd
+
+from json_to_csv import ARTICLE_COLUMNS, articles_to_csv
+
+
+def test_fields_of_later_batches_are_kept(tmp_path):
+    output_file = tmp_path / 'articles.csv'
+    articles = [{'source': {'id': None, 'name': 'Variety'}, 'title': 'first'},
+                {'source': {'id': None, 'name': 'Variety'}, 'title': 'second', 'Annotation': 'plot'}]
+    assert articles_to_csv(iter(articles), output_file, batch_size=1) == 2
+
+    df = pd.read_csv(output_file)
+    assert list(df.columns) == ['title', 'source.id', 'source.name', 'Annotation']
+    assert df['title'].tolist() == ['first', 'second']
+    assert df['Annotation'].isna().tolist() == [True, False]
+
+
+def test_no_articles_writes_a_header(tmp_path):
+    output_file = tmp_path / 'articles.csv'
+    assert articles_to_csv(iter([]), output_file) == 0
+    assert list(pd.read_csv(output_file).columns) == ARTICLE_COLUMNS